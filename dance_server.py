@@ -8,13 +8,12 @@ import os
 import sys
 import json
 import uuid
-import subprocess
-import shutil
 from pathlib import Path
 from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 import tempfile
 import threading
+import queue
 import time
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
@@ -22,9 +21,18 @@ from flask import send_from_directory
 # Add external directory to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'external'))
 
+import instrumentation
+from job_store import JobStore
+
 # Import dance generation function with error handling
 try:
     from single_music_generator import generate_dance_from_single_file
+    from data.audio_extraction.feature_cache import FeatureCache
+    from model.samplers import get_sampler
+    import model_registry
+    import motion_export
+    import fast_render
+    from motion_format import MotionFile
     DANCE_GENERATION_AVAILABLE = True
 except ImportError as e:
     print(f"Warning: Could not import dance generation module: {e}")
@@ -42,187 +50,214 @@ CORS(app)  # Enable CORS for frontend integration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 MOTION_FOLDER = 'motions'
-FBX_OUTPUT_FOLDER = 'fbx_outputs'
+EXPORT_FOLDER = 'motion_exports'
+# Animation formats written next to every motion, served from /api/download/<id>/<format>
+EXPORT_FORMATS = ('bvh', 'glb')
 ALLOWED_EXTENSIONS = {'wav', 'mp3', 'flac', 'm4a'}
 
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'external', 'checkpoint.pt')
+
 # Ensure directories exist
-for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER, MOTION_FOLDER, FBX_OUTPUT_FOLDER]:
+for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER, MOTION_FOLDER, EXPORT_FOLDER]:
     Path(folder).mkdir(parents=True, exist_ok=True)
 
-# Store generation status
-generation_status = {}
+# Jobs and the files of uploads / generations are tracked in SQLite, shared by all worker processes
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'jobs.db')
+# Files of finished generations and uploads are evicted after JOB_TTL_HOURS without use, or earlier,
+# least recently used first, once they take more than STORAGE_MAX_MB
+JOB_TTL_HOURS = float(os.getenv('JOB_TTL_HOURS', '24'))
+STORAGE_MAX_MB = int(os.getenv('STORAGE_MAX_MB', '10240'))
+SWEEP_INTERVAL_S = float(os.getenv('SWEEP_INTERVAL_S', '300'))
+# Jobs without progress for this long are marked as failed (their worker died)
+STALE_JOB_S = float(os.getenv('STALE_JOB_S', '3600'))
+
+job_store = JobStore(JOB_DB_PATH)
+job_store.start_sweeper(SWEEP_INTERVAL_S, JOB_TTL_HOURS * 3600, STORAGE_MAX_MB * 1024 * 1024, STALE_JOB_S)
+
+# Feature types whose models are loaded at startup (comma separated, empty to load on first use)
+PRELOAD_MODELS = [m for m in os.getenv('PRELOAD_MODELS', 'jukebox').split(',') if m]
+# Set CPU_BACKEND=1 to run the decoder int8-quantized on CPU hosts (kept only if it passes the parity check)
+CPU_BACKEND = os.getenv('CPU_BACKEND', '0') == '1'
+
+if DANCE_GENERATION_AVAILABLE:
+    model_registry.configure_models(cpu_backend=CPU_BACKEND)
+
+def preload_models():
+    """Load the EDGE models (and jukebox weights) once so requests only pay for sampling"""
+    try:
+        model_registry.warmup(
+            PRELOAD_MODELS,
+            checkpoint_path=CHECKPOINT_PATH
+        )
+        print(f"Preloaded models: {PRELOAD_MODELS}")
+    except Exception as e:
+        print(f"Model preload failed, models will load on first use: {e}")
+
+if DANCE_GENERATION_AVAILABLE and PRELOAD_MODELS:
+    # Warm up in the background so the server can answer health checks immediately
+    threading.Thread(target=preload_models, daemon=True).start()
+
+# Generation concurrency: at most MAX_CONCURRENT_JOBS jobs run at once, up to MAX_QUEUED_JOBS wait,
+# and the diffusion sampling of running jobs is merged into batches of up to MAX_BATCH_WINDOWS windows
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '2'))
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', '16'))
+MAX_BATCH_WINDOWS = int(os.getenv('MAX_BATCH_WINDOWS', '64'))
+MAX_BATCH_WAIT_MS = float(os.getenv('MAX_BATCH_WAIT_MS', '50'))
+# Sampling requests (one per chunk of windows) waiting for a batch, submitters block beyond this
+MAX_BATCH_QUEUE = int(os.getenv('MAX_BATCH_QUEUE', '32'))
+# Songs are denoised CHUNK_WINDOWS 5 second windows at a time, so memory does not grow with song
+# length; a request may set sample_length (seconds) to dance to a random crop instead of the whole song
+CHUNK_WINDOWS = int(os.getenv('CHUNK_WINDOWS', '16'))
+# Motions are saved as .motion files, MOTION_DTYPE=float16 halves the size of their rotations
+MOTION_DTYPE = os.getenv('MOTION_DTYPE', 'float32')
+
+# Rendering rasterizes in the job's thread; RENDER_WORKERS > 1 moves it to a shared pool of that many
+# spawned processes (run under gunicorn / wsgi.py then, spawned processes re-import the main module)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '1'))
+
+if DANCE_GENERATION_AVAILABLE:
+    fast_render.configure(workers=RENDER_WORKERS)
+    model_registry.configure_scheduler(
+        max_batch_size=MAX_BATCH_WINDOWS, max_wait=MAX_BATCH_WAIT_MS / 1000, max_queue=MAX_BATCH_QUEUE
+    )
+
+# Extracted audio features are cached by audio content, so re-uploads skip feature extraction
+FEATURE_CACHE_DIR = os.getenv('FEATURE_CACHE_DIR', 'feature_cache')
+FEATURE_CACHE_MAX_MB = int(os.getenv('FEATURE_CACHE_MAX_MB', '2048'))
+feature_cache = (
+    FeatureCache(os.path.abspath(FEATURE_CACHE_DIR), max_bytes=FEATURE_CACHE_MAX_MB * 1024 * 1024)
+    if DANCE_GENERATION_AVAILABLE else None
+)
+
+job_queue = queue.Queue(maxsize=MAX_QUEUED_JOBS)
+
+def generation_worker():
+    """Run queued generation jobs one at a time"""
+    while True:
+        generation_id, audio_file_path, params = job_queue.get()
+        try:
+            generate_dance_async(generation_id, audio_file_path, params)
+        except Exception as e:
+            # a failing job must not take a worker thread down with it
+            print(f"Generation worker error for {generation_id}: {e}")
+        finally:
+            job_queue.task_done()
+
+for _ in range(MAX_CONCURRENT_JOBS):
+    threading.Thread(target=generation_worker, daemon=True).start()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def convert_audio_to_wav(input_path, output_path):
-    """Convert audio file to WAV format using ffmpeg"""
-    try:
-        cmd = [
-            'ffmpeg', '-i', input_path, 
-            '-ar', '44100',  # Sample rate
-            '-ac', '2',      # Stereo
-            '-y',            # Overwrite output file
-            output_path
-        ]
-        subprocess.run(cmd, check=True, capture_output=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg error: {e}")
-        return False
-    except FileNotFoundError:
-        print("FFmpeg not found. Please install ffmpeg.")
-        return False
+# Progress range (percent) covered by each pipeline stage, steps within a stage
+# (e.g. denoising steps) advance through the range proportionally
+STAGE_PROGRESS = {
+    'model_load': (10, 20, 'Loading AI model...'),
+    'decode': (20, 25, 'Decoding audio...'),
+    'slice': (25, 30, 'Slicing audio...'),
+    'features': (30, 50, 'Extracting audio features...'),
+    'sample': (50, 50, 'Waiting for the dance generator...'),
+    'denoise': (50, 80, 'Generating dance...'),
+    'fk': (80, 82, 'Computing poses...'),
+    'render': (82, 99, 'Rendering dance video...'),
+    'export': (99, 99, 'Exporting animation files...'),
+}
 
-def update_progress_gradually(generation_id, start_progress, end_progress, duration_seconds):
-    """Gradually update progress over time to show activity during long operations"""
-    start_time = time.time()
-    
-    while time.time() - start_time < duration_seconds:
-        if generation_id not in generation_status:
-            break
-            
-        elapsed = time.time() - start_time
-        progress_fraction = elapsed / duration_seconds
-        current_progress = start_progress + (end_progress - start_progress) * progress_fraction
-        
-        # Only update if the status hasn't moved beyond our target
-        if generation_status[generation_id]['progress'] < end_progress:
-            generation_status[generation_id]['progress'] = min(int(current_progress), end_progress)
-        
-        time.sleep(2)  # Update every 2 seconds
+def make_progress_callback(generation_id):
+    """Map the stage / step progress reported by the pipeline onto the job status"""
+    last = {'progress': 10, 'stage': None}
+    def on_progress(stage_name, done, total):
+        if stage_name not in STAGE_PROGRESS:
+            return
+        start, end, message = STAGE_PROGRESS[stage_name]
+        progress = int(start + (end - start) * done / max(total, 1))
+        # progress never moves backwards, e.g. when the wait for a sampling batch ends;
+        # the job is only written when something visible changed
+        if progress > last['progress'] or (progress == last['progress'] and stage_name != last['stage']):
+            last['progress'], last['stage'] = progress, stage_name
+            job_store.update_job(generation_id, progress=progress, message=message, stage=stage_name)
+    return on_progress
 
 def generate_dance_async(generation_id, audio_file_path, params):
     """Asynchronously generate dance from audio file"""
+    # Stage timings and step progress reported by the pipeline land in this trace
+    trace = instrumentation.Trace(generation_id, on_progress=make_progress_callback(generation_id))
+    start_time = time.time()
+    job = None
     try:
-        generation_status[generation_id]['status'] = 'processing'
-        generation_status[generation_id]['progress'] = 10
-        generation_status[generation_id]['message'] = 'Starting dance generation...'
-        
-        # Convert to WAV if needed
-        file_ext = os.path.splitext(audio_file_path)[1].lower()
-        if file_ext != '.wav':
-            wav_path = os.path.splitext(audio_file_path)[0] + '.wav'
-            generation_status[generation_id]['progress'] = 20
-            generation_status[generation_id]['message'] = 'Converting audio format...'
-            
-            if not convert_audio_to_wav(audio_file_path, wav_path):
-                raise Exception("Failed to convert audio to WAV format")
-            audio_file_path = wav_path
-        
-        generation_status[generation_id]['progress'] = 30
-        generation_status[generation_id]['message'] = 'Extracting audio features...'
-        
-        # Change to external directory for EDGE model execution
-        original_cwd = os.getcwd()
-        external_dir = os.path.join(os.path.dirname(__file__), 'external')
-        os.chdir(external_dir)
-        
-        try:
-            # Convert audio file path to absolute path since we're changing directories
-            abs_audio_path = os.path.abspath(os.path.join(original_cwd, audio_file_path))
-            abs_output_dir = os.path.abspath(os.path.join(original_cwd, OUTPUT_FOLDER))
-            abs_motion_dir = os.path.abspath(os.path.join(original_cwd, MOTION_FOLDER))
-            
-            # Update progress before model generation
-            generation_status[generation_id]['progress'] = 50
-            generation_status[generation_id]['message'] = 'Loading AI model and generating dance...'
+        job = job_store.get_job(generation_id)
+        if job is None:
+            print(f"Generation {generation_id} was deleted while it was queued")
+            return
+        instrumentation.observe('queue_wait', start_time - job['created_at'])
+        job_store.update_job(generation_id, status='processing', progress=10, message='Starting dance generation...')
+        
+        with instrumentation.use_traces(trace):
+            # every generation writes into its own directories, so finding its files never scans
+            # the outputs of other generations; paths are absolute so no job depends on the cwd
+            output_dir = os.path.abspath(os.path.join(OUTPUT_FOLDER, generation_id))
+            motion_dir = os.path.abspath(os.path.join(MOTION_FOLDER, generation_id))
             
-            # Start gradual progress update in background
-            progress_thread = threading.Thread(
-                target=update_progress_gradually, 
-                args=(generation_id, 50, 80, 120)  # Gradually go from 50% to 80% over 2 minutes
-            )
-            progress_thread.daemon = True
-            progress_thread.start()
-            
-            # Generate dance using the EDGE model
+            # Generate dance using the EDGE model, batching the sampling with other running jobs;
+            # the upload is decoded once, in memory, whatever its format
+            feature_type = params.get('feature_type', 'jukebox')
+            scheduler = None
+            if DANCE_GENERATION_AVAILABLE:
+                # the first job of a feature type loads its model here
+                with instrumentation.stage('model_load'):
+                    scheduler = model_registry.get_scheduler(feature_type, CHECKPOINT_PATH)
             result = generate_dance_from_single_file(
-                audio_file_path=abs_audio_path,
-                output_dir=abs_output_dir,
-                motion_save_dir=abs_motion_dir,
-                checkpoint_path='checkpoint.pt',  # Now relative to external directory
-                feature_type=params.get('feature_type', 'jukebox'),
-                generation_id=generation_id
+                audio_file_path=os.path.abspath(audio_file_path),
+                output_dir=output_dir,
+                motion_save_dir=motion_dir,
+                checkpoint_path=CHECKPOINT_PATH,
+                feature_type=feature_type,
+                generation_id=generation_id,
+                scheduler=scheduler,
+                feature_cache=feature_cache,
+                sampler=params.get('sampler'),
+                sample_length=params.get('sample_length'),
+                chunk_size=CHUNK_WINDOWS or None,
+                motion_dtype=MOTION_DTYPE
             )
-        finally:
-            # Always return to original directory
-            os.chdir(original_cwd)
-        
-        generation_status[generation_id]['progress'] = 85
-        generation_status[generation_id]['message'] = 'Finalizing dance video...'
-        
-        # Skip FBX conversion for now (can be enabled later if needed)
-        fbx_path = None
-        # if params.get('generate_fbx', False) and result.get('motion_path'):
-        #     fbx_path = convert_motion_to_fbx(result['motion_path'], generation_id)
-        
-        generation_status[generation_id]['progress'] = 100
-        generation_status[generation_id]['status'] = 'completed'
-        generation_status[generation_id]['message'] = 'Dance generation completed!'
-        
-        # Find the actual generated files
-        # Use first 8 characters of generation_id for file lookup (matching single_music_generator)
-        short_generation_id = generation_id[:8]
-        video_files = list(Path(OUTPUT_FOLDER).glob(f"*{short_generation_id}*.mp4"))
-        motion_files = list(Path(MOTION_FOLDER).glob(f"*{short_generation_id}*.pkl"))
-        
-        video_path = str(video_files[0]) if video_files else result.get('video_path')
-        motion_path = str(motion_files[0]) if motion_files else result.get('motion_path')
-        
-        generation_status[generation_id]['result'] = {
-            'video_path': video_path,
-            'motion_path': motion_path,
-            'fbx_path': fbx_path,
-            'generation_id': generation_id,
-            'video_filename': os.path.basename(video_path) if video_path else None
-        }
         
-    except Exception as e:
-        generation_status[generation_id]['status'] = 'error'
-        generation_status[generation_id]['message'] = f'Error: {str(e)}'
-        generation_status[generation_id]['error'] = str(e)
-        print(f"Generation error for {generation_id}: {e}")
-
-def convert_motion_to_fbx(motion_path, generation_id):
-    """Convert motion data to FBX format using SMPL-to-FBX converter"""
-    try:
-        # Create temporary directory for this conversion
-        temp_motion_dir = os.path.join(MOTION_FOLDER, f'temp_{generation_id}')
-        Path(temp_motion_dir).mkdir(parents=True, exist_ok=True)
-        
-        # Copy motion file to temporary directory
-        temp_motion_path = os.path.join(temp_motion_dir, os.path.basename(motion_path))
-        shutil.copy2(motion_path, temp_motion_path)
-        
-        # Output directory for FBX
-        fbx_output_dir = os.path.join(FBX_OUTPUT_FOLDER, generation_id)
-        Path(fbx_output_dir).mkdir(parents=True, exist_ok=True)
-        
-        # Run SMPL-to-FBX conversion
-        convert_script = os.path.join('external', 'SMPL-to-FBX', 'Convert.py')
-        fbx_source = os.path.join('external', 'SMPL-to-FBX', 'ybot.fbx')
-        
-        if os.path.exists(convert_script) and os.path.exists(fbx_source):
-            cmd = [
-                'python3', convert_script,
-                '--input_dir', temp_motion_dir,
-                '--fbx_source_path', fbx_source,
-                '--output_dir', fbx_output_dir
-            ]
-            
-            subprocess.run(cmd, check=True, cwd='external')
-            
-            # Find the generated FBX file
-            fbx_files = list(Path(fbx_output_dir).glob('*.fbx'))
-            if fbx_files:
-                return str(fbx_files[0])
-        
-        return None
+        video_path = result.get('video_path')
+        motion_path = result.get('motion_path')
+        
+        # BVH / glTF export runs in-process and takes milliseconds, unlike the FBX SDK round trip
+        export_paths = {}
+        if motion_path and params.get('export_formats'):
+            with instrumentation.use_traces(trace), instrumentation.stage('export'):
+                export_paths = motion_export.export_motion(
+                    motion_path, os.path.abspath(os.path.join(EXPORT_FOLDER, generation_id)), params['export_formats']
+                )
+        
+        for kind, path in [('video', video_path), ('motion', motion_path), *export_paths.items()]:
+            if path:
+                job_store.add_artifact(generation_id, kind, path)
+        
+        job_store.update_job(
+            generation_id,
+            status='completed',
+            progress=100,
+            message='Dance generation completed!',
+            result={
+                'video_path': video_path,
+                'motion_path': motion_path,
+                'export_paths': export_paths,
+                'generation_id': generation_id,
+                # relative to OUTPUT_FOLDER, for /outputs/<path>
+                'video_filename': os.path.relpath(video_path, os.path.abspath(OUTPUT_FOLDER)) if video_path else None
+            }
+        )
         
     except Exception as e:
-        print(f"FBX conversion error: {e}")
-        return None
+        job_store.update_job(generation_id, status='error', message=f'Error: {str(e)}', error=str(e))
+        print(f"Generation error for {generation_id}: {e}")
+    finally:
+        if job is not None:
+            instrumentation.observe('generation_total', time.time() - start_time)
+            job_store.update_job(generation_id, timings=trace.summary())
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -245,6 +280,7 @@ def upload_file():
         filename = secure_filename(f"{upload_id}_{file.filename}")
         file_path = os.path.join(UPLOAD_FOLDER, filename)
         file.save(file_path)
+        job_store.add_artifact(upload_id, 'upload', file_path)
         
         return jsonify({
             'upload_id': upload_id,
@@ -270,43 +306,51 @@ def generate_dance():
             return jsonify({'error': 'Upload ID required'}), 400
         
         # Find uploaded file
-        upload_files = list(Path(UPLOAD_FOLDER).glob(f"{upload_id}_*"))
-        print(f"DEBUG: Looking for files matching pattern: {upload_id}_*")
-        print(f"DEBUG: Found upload files: {upload_files}")
-        
-        if not upload_files:
-            # List all files in upload folder for debugging
-            all_files = list(Path(UPLOAD_FOLDER).glob("*"))
-            print(f"DEBUG: All files in upload folder: {all_files}")
+        audio_file_path = job_store.find_artifact(upload_id, 'upload')
+        print(f"DEBUG: Found upload file: {audio_file_path}")
+        
+        if not audio_file_path or not os.path.exists(audio_file_path):
             return jsonify({'error': 'Uploaded file not found'}), 404
         
-        audio_file_path = str(upload_files[0])
+        job_store.touch(upload_id)
         generation_id = str(uuid.uuid4())
         
-        # Initialize generation status
-        generation_status[generation_id] = {
-            'status': 'queued',
-            'progress': 0,
-            'message': 'Generation queued...',
-            'upload_id': upload_id,
-            'created_at': time.time()
-        }
-        
         # Extract generation parameters
         params = {
             'feature_type': data.get('feature_type', 'jukebox'),
-            'generate_fbx': data.get('generate_fbx', True),
+            'export_formats': data.get('export_formats', list(EXPORT_FORMATS)),
             'dance_style': data.get('dance_style', 'freestyle'),
             'skill_level': data.get('skill_level', 3)
         }
         
-        # Start generation in background thread
-        thread = threading.Thread(
-            target=generate_dance_async, 
-            args=(generation_id, audio_file_path, params)
-        )
-        thread.daemon = True
-        thread.start()
+        # Sampler choice trades quality for latency, e.g. {"sampler": "dpm++", "steps": 15} for previews
+        if DANCE_GENERATION_AVAILABLE:
+            try:
+                params['sampler'] = get_sampler(
+                    data.get('sampler', 'ddim'), data.get('steps'), data.get('eta')
+                )
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid sampler settings: {e}'}), 400
+        
+        if not isinstance(params['export_formats'], list) or not set(params['export_formats']) <= set(EXPORT_FORMATS):
+            return jsonify({'error': f'export_formats must be a list of {list(EXPORT_FORMATS)}'}), 400
+        
+        if data.get('sample_length') is not None:
+            try:
+                params['sample_length'] = float(data['sample_length'])
+                if not params['sample_length'] >= 5:
+                    raise ValueError('sample_length must be at least 5 seconds')
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid sample_length: {e}'}), 400
+        
+        job_store.create_job(generation_id, upload_id, message='Generation queued...')
+        
+        # Queue generation for the worker threads
+        try:
+            job_queue.put_nowait((generation_id, audio_file_path, params))
+        except queue.Full:
+            job_store.delete_job(generation_id)
+            return jsonify({'error': 'Server is busy, please try again later'}), 503
         
         return jsonify({
             'generation_id': generation_id,
@@ -316,32 +360,47 @@ def generate_dance():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms per pipeline stage (seconds) and current queue state"""
+    return jsonify({
+        'stages': instrumentation.snapshot(),
+        'jobs': job_store.status_counts(),
+        'queue': {
+            'queued': job_queue.qsize(),
+            'max_queued': MAX_QUEUED_JOBS,
+            'max_concurrent': MAX_CONCURRENT_JOBS
+        },
+        'peak_rss_mb': round(instrumentation.peak_rss_mb(), 1)
+    })
+
 @app.route('/api/status/<generation_id>', methods=['GET'])
 def get_generation_status(generation_id):
     """Get status of dance generation"""
-    if generation_id not in generation_status:
+    status = job_store.get_job(generation_id)
+    if status is None:
         return jsonify({'error': 'Generation ID not found'}), 404
     
-    status = generation_status[generation_id].copy()
     return jsonify(status)
 
 @app.route('/api/download/<generation_id>/<file_type>', methods=['GET'])
 def download_file(generation_id, file_type):
     """Download generated files"""
     try:
-        if generation_id not in generation_status:
+        status = job_store.get_job(generation_id)
+        if status is None:
             return jsonify({'error': 'Generation ID not found'}), 404
         
-        status = generation_status[generation_id]
         if status['status'] != 'completed':
             return jsonify({'error': 'Generation not completed'}), 400
         
-        result = status.get('result', {})
+        result = status['result'] or {}
+        job_store.touch(generation_id)
         
         if file_type == 'video' and result.get('video_path'):
             return send_file(result['video_path'], as_attachment=True)
-        elif file_type == 'fbx' and result.get('fbx_path'):
-            return send_file(result['fbx_path'], as_attachment=True)
+        elif file_type in result.get('export_paths', {}):
+            return send_file(result['export_paths'][file_type], as_attachment=True)
         elif file_type == 'motion' and result.get('motion_path'):
             return send_file(result['motion_path'], as_attachment=True)
         else:
@@ -350,21 +409,44 @@ def download_file(generation_id, file_type):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/motion/<generation_id>', methods=['GET'])
+def get_motion_frames(generation_id):
+    """Frames [start, stop) of a generated motion as JSON, read without loading the whole file"""
+    try:
+        status = job_store.get_job(generation_id)
+        if status is None:
+            return jsonify({'error': 'Generation ID not found'}), 404
+        
+        motion_path = (status['result'] or {}).get('motion_path')
+        if not motion_path or not motion_path.endswith('.motion'):
+            return jsonify({'error': 'Motion not available'}), 404
+        
+        motion = MotionFile(motion_path)
+        start = request.args.get('start', 0, type=int)
+        stop = request.args.get('stop', len(motion), type=int)
+        if start < 0 or stop < start:
+            return jsonify({'error': 'Invalid frame range'}), 400
+        frames = {
+            'fps': motion.fps,
+            'frames': len(motion),
+            'start': start,
+            'stop': min(stop, len(motion)),
+            'smpl_poses': motion.poses(start, stop).tolist(),
+            'smpl_trans': motion.trans(start, stop).tolist()
+        }
+        if request.args.get('joints') == '1':
+            frames['joints'] = motion.joints(start, stop).tolist()
+        return jsonify(frames)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/cleanup/<generation_id>', methods=['DELETE'])
 def cleanup_generation(generation_id):
     """Clean up files for a generation"""
     try:
-        if generation_id in generation_status:
-            # Remove files
-            status = generation_status[generation_id]
-            result = status.get('result', {})
-            
-            for file_path in [result.get('video_path'), result.get('motion_path'), result.get('fbx_path')]:
-                if file_path and os.path.exists(file_path):
-                    os.remove(file_path)
-            
-            # Remove from status tracking
-            del generation_status[generation_id]
+        # Remove the files and the job
+        job_store.delete_job(generation_id)
             
         return jsonify({'message': 'Cleanup completed'})
         
@@ -380,7 +462,7 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'active_generations': len([g for g in generation_status.values() if g['status'] in ['queued', 'processing']])
+        'active_generations': sum(count for status, count in job_store.status_counts().items() if status in ('queued', 'processing'))
     })
 
 @app.route('/outputs/<path:filename>')
@@ -414,6 +496,7 @@ if __name__ == '__main__':
     print("POST /api/generate - Start dance generation")
     print("GET  /api/status/<id> - Check generation status")
     print("GET  /api/download/<id>/<type> - Download generated files")
+    print("GET  /api/motion/<id>?start=&stop= - Frames of a generated motion")
     print("GET  /api/health - Health check")
     
     # In container / Render this will be replaced by gunicorn, but keep for local fallback
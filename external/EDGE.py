@@ -1,24 +1,30 @@
+import copy
 import multiprocessing
 import os
-import pickle
+import warnings
 from functools import partial
 from pathlib import Path
 
 import torch
 import torch.nn.functional as F
-import wandb
-from accelerate import Accelerator, DistributedDataParallelKwargs
-from accelerate.state import AcceleratorState
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from dataset.dance_dataset import AISTPPDataset
-from dataset.preprocess import increment_path
-from model.adan import Adan
+from dataset.preprocess import Normalizer, increment_path
 from model.diffusion import GaussianDiffusion
 from model.model import DanceDecoder
 from vis import SMPLSkeleton
 
+POS_DIM = 3
+ROT_DIM = 24 * 6  # 24 joints, 6dof
+REPR_DIM = POS_DIM + ROT_DIM + 4
+HORIZON = 5 * 30  # 5 seconds at 30 FPS
+
+# marker and version of the slim artifacts written by export_inference_checkpoint
+INFERENCE_FORMAT = "edge-inference"
+INFERENCE_VERSION = 1
+
 
 def wrap(x):
     return {f"module.{key}": value for key, value in x.items()}
@@ -28,6 +34,70 @@ def maybe_wrap(x, num):
     return x if num == 1 else wrap(x)
 
 
+def build_decoder(feature_type):
+    return DanceDecoder(
+        nfeats=REPR_DIM,
+        seq_len=HORIZON,
+        latent_dim=512,
+        ff_size=1024,
+        num_layers=8,
+        num_heads=8,
+        dropout=0.1,
+        cond_feature_dim=35 if feature_type == "baseline" else 4800,
+        activation=F.gelu,
+    )
+
+
+def build_diffusion(model, smpl):
+    return GaussianDiffusion(
+        model,
+        HORIZON,
+        REPR_DIM,
+        smpl,
+        schedule="cosine",
+        n_timestep=1000,
+        predict_epsilon=False,
+        loss_type="l2",
+        use_p2=False,
+        cond_drop_prob=0.25,
+        guidance_weight=2,
+    )
+
+
+def inference_checkpoint_path(checkpoint_path):
+    """Where the slim inference artifact of a training checkpoint is exported to."""
+    if checkpoint_path.endswith(".inference.pt"):
+        return checkpoint_path
+    return os.path.splitext(checkpoint_path)[0] + ".inference.pt"
+
+
+def export_inference_checkpoint(checkpoint_path, out_path=None, dtype=None):
+    """
+    Write the EMA weights (cast to `dtype` if given, e.g. torch.float16) and
+    the normalizer's scaler parameters of a training checkpoint to a slim
+    artifact for EDGE.from_inference_checkpoint. Returns the artifact path.
+    """
+    if out_path is None:
+        out_path = inference_checkpoint_path(checkpoint_path)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    state_dict = {
+        key: value.to(dtype) if dtype is not None and value.is_floating_point() else value
+        for key, value in checkpoint["ema_state_dict"].items()
+    }
+    feature_dim = state_dict["cond_projection.weight"].shape[1]
+    torch.save(
+        {
+            "format": INFERENCE_FORMAT,
+            "version": INFERENCE_VERSION,
+            "feature_type": "baseline" if feature_dim == 35 else "jukebox",
+            "state_dict": state_dict,
+            "normalizer": checkpoint["normalizer"].state_dict(),
+        },
+        out_path,
+    )
+    return out_path
+
+
 class EDGE:
     def __init__(
         self,
@@ -38,21 +108,20 @@ class EDGE:
         learning_rate=4e-4,
         weight_decay=0.02,
     ):
+        from accelerate import Accelerator, DistributedDataParallelKwargs
+        from accelerate.state import AcceleratorState
+
+        from model.adan import Adan
+
         ddp_kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
         self.accelerator = Accelerator(kwargs_handlers=[ddp_kwargs])
+        self.device = self.accelerator.device
         state = AcceleratorState()
         num_processes = state.num_processes
-        use_baseline_feats = feature_type == "baseline"
+        self.feature_type = feature_type
 
-        pos_dim = 3
-        rot_dim = 24 * 6  # 24 joints, 6dof
-        self.repr_dim = repr_dim = pos_dim + rot_dim + 4
-
-        feature_dim = 35 if use_baseline_feats else 4800
-
-        horizon_seconds = 5
-        FPS = 30
-        self.horizon = horizon = horizon_seconds * FPS
+        self.repr_dim = REPR_DIM
+        self.horizon = HORIZON
 
         self.accelerator.wait_for_everyone()
 
@@ -63,32 +132,9 @@ class EDGE:
             )
             self.normalizer = checkpoint["normalizer"]
 
-        model = DanceDecoder(
-            nfeats=repr_dim,
-            seq_len=horizon,
-            latent_dim=512,
-            ff_size=1024,
-            num_layers=8,
-            num_heads=8,
-            dropout=0.1,
-            cond_feature_dim=feature_dim,
-            activation=F.gelu,
-        )
-
+        model = build_decoder(feature_type)
         smpl = SMPLSkeleton(self.accelerator.device)
-        diffusion = GaussianDiffusion(
-            model,
-            horizon,
-            repr_dim,
-            smpl,
-            schedule="cosine",
-            n_timestep=1000,
-            predict_epsilon=False,
-            loss_type="l2",
-            use_p2=False,
-            cond_drop_prob=0.25,
-            guidance_weight=2,
-        )
+        diffusion = build_diffusion(model, smpl)
 
         print(
             "Model has {} parameters".format(sum(y.numel() for y in model.parameters()))
@@ -107,6 +153,86 @@ class EDGE:
                 )
             )
 
+    @classmethod
+    def from_inference_checkpoint(
+        cls, checkpoint_path, device=None, dtype=torch.float32, cpu_backend=False
+    ):
+        """
+        Eval-only EDGE from an export_inference_checkpoint artifact. The file
+        is memory-mapped and its tensors are assigned into a decoder built on
+        the meta device, so weights are neither randomly initialized nor
+        copied (unless cast to `dtype`, None keeps the stored dtype). No
+        Accelerator or optimizer is created. With `cpu_backend` the decoder
+        is switched to `use_cpu_backend` when running on CPU.
+        """
+        checkpoint = torch.load(
+            checkpoint_path, map_location="cpu", mmap=True, weights_only=True
+        )
+        if checkpoint.get("format") != INFERENCE_FORMAT:
+            raise ValueError(f"{checkpoint_path} is not an inference checkpoint")
+        if checkpoint["version"] > INFERENCE_VERSION:
+            raise ValueError(
+                f"{checkpoint_path} has version {checkpoint['version']}, "
+                f"this code reads up to {INFERENCE_VERSION}"
+            )
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        self = cls.__new__(cls)
+        self.accelerator = None
+        self.optim = None
+        self.device = torch.device(device)
+        self.feature_type = checkpoint["feature_type"]
+        self.repr_dim = REPR_DIM
+        self.horizon = HORIZON
+        self.normalizer = Normalizer.from_state(checkpoint["normalizer"])
+
+        with torch.device("meta"):
+            model = build_decoder(self.feature_type)
+        diffusion = build_diffusion(model, SMPLSkeleton(self.device))
+        # the EMA copy of the weights is only used for training
+        diffusion.master_model = None
+        state_dict = {
+            key: value.to(dtype) if dtype is not None and value.is_floating_point() else value
+            for key, value in checkpoint["state_dict"].items()
+        }
+        model.load_state_dict(state_dict, assign=True)
+        self.model = model
+        self.diffusion = diffusion.to(self.device)
+        self.eval()
+        if cpu_backend and self.device.type == "cpu":
+            self.use_cpu_backend()
+        return self
+
+    def use_cpu_backend(self, quantized=True, compiled=False, tolerance=0.05, max_tolerance=0.2):
+        """
+        Swap in the int8 / compiled CPU decoder (see model/cpu_backend.py).
+        The rewritten decoder is compared to the float one first and dropped,
+        keeping the float model, if joint positions move by more than
+        `tolerance` meters on average or any joint by more than `max_tolerance`
+        meters. Returns whether the backend is in use.
+        """
+        from model.cpu_backend import parity_check, prepare_cpu_inference
+
+        assert self.device.type == "cpu", "the CPU backend only runs on CPU"
+        reference = self.diffusion.model
+        candidate = prepare_cpu_inference(
+            copy.deepcopy(reference), self.horizon, quantized=quantized, compiled=compiled
+        )
+        self.parity = parity_check(reference, candidate, self.diffusion, self.normalizer)
+        print(f"CPU backend parity: {self.parity}")
+        mean_error, max_error = self.parity["mean_joint_error"], self.parity["max_joint_error"]
+        if mean_error > tolerance or max_error > max_tolerance:
+            warnings.warn(
+                f"CPU backend moves joints by {mean_error:.3f} m on average and up to "
+                f"{max_error:.3f} m (tolerance {tolerance} m / {max_tolerance} m), "
+                "keeping the float model"
+            )
+            return False
+        self.diffusion.model = candidate
+        self.model = candidate
+        return True
+
     def eval(self):
         self.diffusion.eval()
 
@@ -117,38 +243,31 @@ class EDGE:
         return self.accelerator.prepare(*objects)
 
     def train_loop(self, opt):
-        # load datasets
-        train_tensor_dataset_path = os.path.join(
-            opt.processed_data_dir, f"train_tensor_dataset.pkl"
-        )
-        test_tensor_dataset_path = os.path.join(
-            opt.processed_data_dir, f"test_tensor_dataset.pkl"
-        )
-        if (
-            not opt.no_cache
-            and os.path.isfile(train_tensor_dataset_path)
-            and os.path.isfile(test_tensor_dataset_path)
-        ):
-            train_dataset = pickle.load(open(train_tensor_dataset_path, "rb"))
-            test_dataset = pickle.load(open(test_tensor_dataset_path, "rb"))
-        else:
+        import wandb
+
+        # load datasets, packed into memory-mapped stores on first use (by the main process)
+        # the other processes then open the finished stores
+        rebuild = self.accelerator.is_main_process
+        with self.accelerator.main_process_first():
             train_dataset = AISTPPDataset(
                 data_path=opt.data_path,
                 backup_path=opt.processed_data_dir,
                 train=True,
-                force_reload=opt.force_reload,
+                feature_type=opt.feature_type,
+                force_reload=opt.force_reload and rebuild,
+                feature_dtype=opt.feature_dtype,
+                force_store=opt.no_cache and rebuild,
             )
             test_dataset = AISTPPDataset(
                 data_path=opt.data_path,
                 backup_path=opt.processed_data_dir,
                 train=False,
+                feature_type=opt.feature_type,
                 normalizer=train_dataset.normalizer,
-                force_reload=opt.force_reload,
+                force_reload=opt.force_reload and rebuild,
+                feature_dtype=opt.feature_dtype,
+                force_store=opt.no_cache and rebuild,
             )
-            # cache the dataset in case
-            if self.accelerator.is_main_process:
-                pickle.dump(train_dataset, open(train_tensor_dataset_path, "wb"))
-                pickle.dump(test_dataset, open(test_tensor_dataset_path, "wb"))
 
         # set normalizer
         self.normalizer = test_dataset.normalizer
@@ -266,14 +385,37 @@ class EDGE:
             wandb.run.finish()
 
     def render_sample(
-        self, data_tuple, label, render_dir, render_count=-1, fk_out=None, render=True
+        self,
+        data_tuple,
+        label,
+        render_dir,
+        render_count=-1,
+        fk_out=None,
+        render=True,
+        samples=None,
+        sampler=None,
+        chunk_size=None,
+        motion_dtype="float32",
+        audio=None,
     ):
+        # samples: optional already-denoised (normalized) motion, e.g. from the
+        # batch scheduler, in which case only unnormalize / FK / render runs here;
+        # a list of consecutive chunks of windows is rendered as a whole
+        # sampler: model.samplers.Sampler used to denoise, defaults to 50 step DDIM
+        # chunk_size: denoise at most this many windows at a time, None for all at once
+        # motion_dtype: float32 or float16 rotations in the .motion files written to fk_out
+        # audio: (path, offset in seconds) of the source audio to mux in, in which case
+        # the wav names in data_tuple only name the outputs
         _, cond, wavname = data_tuple
         assert len(cond.shape) == 3
         if render_count < 0:
             render_count = len(cond)
         shape = (render_count, self.horizon, self.repr_dim)
-        cond = cond.to(self.accelerator.device)
+        if isinstance(samples, (list, tuple)):
+            shape = list(samples)
+        elif samples is not None:
+            shape = samples[:render_count]
+        cond = cond.to(self.device)
         self.diffusion.render_sample(
             shape,
             cond[:render_count],
@@ -284,5 +426,9 @@ class EDGE:
             sound=True,
             mode="long",
             fk_out=fk_out,
-            render=render
+            render=render,
+            sampler=sampler,
+            chunk_size=chunk_size,
+            motion_dtype=motion_dtype,
+            audio=audio,
         )
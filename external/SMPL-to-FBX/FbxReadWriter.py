@@ -133,7 +133,7 @@ class FbxReadWrite(object):
     def writeFbx(self, write_base: str, filename: str):
         if os.path.isdir(write_base) == False:
             os.makedirs(write_base, exist_ok=True)
-        write_path = os.path.join(write_base, filename.replace(".pkl", ""))
+        write_path = os.path.join(write_base, os.path.splitext(filename)[0])
         lResult = SaveScene(self.lSdkManager, self.lScene, write_path)
 
         if lResult == False:
@@ -1,9 +1,9 @@
-import glob
 import os
-import pickle
+import sys
 from typing import Dict, Tuple
 
-import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from motion_format import load_motion, motion_paths
 
 
 class SmplObjects(object):
@@ -35,22 +35,13 @@ class SmplObjects(object):
     ]
 
     def __init__(self, read_path):
-        self.files = {}
-
-        paths = sorted(glob.glob(os.path.join(read_path, "*.pkl")))
-        for path in paths:
-            filename = path.split("/")[-1]
-            with open(path, "rb") as fp:
-                data = pickle.load(fp)
-            self.files[filename] = {
-                "smpl_poses": data["smpl_poses"],
-                "smpl_trans": data["smpl_trans"],
-            }
-        self.keys = [key for key in self.files.keys()]
+        # motions are read on access, so a large directory is not loaded up front
+        self.paths = {os.path.basename(path): path for path in motion_paths(read_path)}
+        self.keys = [key for key in self.paths.keys()]
 
     def __len__(self):
         return len(self.keys)
 
     def __getitem__(self, idx: int) -> Tuple[str, Dict]:
         key = self.keys[idx]
-        return key, self.files[key]
+        return key, load_motion(self.paths[key])
@@ -26,7 +26,14 @@ def parse_train_opt():
         "--force_reload", action="store_true", help="force reloads the datasets"
     )
     parser.add_argument(
-        "--no_cache", action="store_true", help="don't reuse / cache loaded dataset"
+        "--no_cache", action="store_true", help="rebuild the packed dataset stores"
+    )
+    parser.add_argument(
+        "--feature_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16"],
+        help="dtype audio features are packed with, float16 halves the store",
     )
     parser.add_argument(
         "--save_interval",
@@ -73,10 +80,17 @@ def parse_test_opt():
         default="eval/motions",
         help="Where to save the motions",
     )
+    parser.add_argument(
+        "--motion_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16"],
+        help="Precision of the rotations in the saved motions",
+    )
     parser.add_argument(
         "--cache_features",
         action="store_true",
-        help="Save the jukebox features for later reuse",
+        help="Save the computed features in the feature cache for later reuse",
     )
     parser.add_argument(
         "--no_render",
@@ -86,13 +100,38 @@ def parse_test_opt():
     parser.add_argument(
         "--use_cached_features",
         action="store_true",
-        help="Use precomputed features instead of music folder",
+        help="Reuse features from the feature cache instead of recomputing them",
+    )
+    parser.add_argument(
+        "--feature_mode",
+        type=str,
+        default="track",
+        choices=["track", "slice"],
+        help="Extract features once over the whole track, or once per slice",
+    )
+    parser.add_argument(
+        "--validate_features",
+        action="store_true",
+        help="Compare whole-track features against per-slice features",
     )
     parser.add_argument(
         "--feature_cache_dir",
         type=str,
         default="cached_features/",
-        help="Where to save/load the features",
+        help="Feature cache directory",
+    )
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="ddim",
+        choices=["ddim", "dpm++"],
+        help="Diffusion sampler",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=None, help="Sampling steps (sampler default if unset)"
+    )
+    parser.add_argument(
+        "--eta", type=float, default=None, help="DDIM noise scale, 0 is deterministic"
     )
     opt = parser.parse_args()
     return opt
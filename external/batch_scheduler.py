@@ -0,0 +1,165 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+from instrumentation import current_traces, use_traces
+from model.samplers import DDIMSampler
+
+# queued by `close`, ends the sampling thread
+_STOP = object()
+
+
+class _Job:
+    def __init__(self, cond, sampler, prefix=None):
+        self.cond = cond
+        self.sampler = sampler
+        self.prefix = prefix
+        # timing / progress of the submitting job follow it onto the sampling thread
+        self.traces = current_traces()
+        self.future = Future()
+
+    def __len__(self):
+        return len(self.cond)
+
+
+class BatchScheduler:
+    """
+    Merges the diffusion sampling of concurrent generation jobs.
+
+    Jobs submitted within `max_wait` seconds of each other are packed into a
+    single `long_ddim_sample` call of at most `max_batch_size` windows. Each
+    job keeps its own overlap stitching (see the `segments` argument of
+    `GaussianDiffusion.long_ddim_sample`) and gets back only its own rows.
+    Only jobs with the same sampler configuration share a batch. A job can
+    carry a `prefix`, the end of its previous chunk of windows (see
+    `model.samplers.sample_in_chunks`), to continue from.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.05, max_queue=32):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        # jobs that did not fit into (or could not join) earlier batches, oldest first
+        self._pending = deque()
+        self.closed = False
+        # set on the sampling thread once it has taken _STOP off the queue
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, cond, sampler=None, prefix=None):
+        """
+        Queue a (windows x horizon x feature_dim) conditioning tensor to be
+        denoised with `sampler` (default DDIM), returns a Future of its samples.
+        `prefix` is clean motion to inpaint into the first frames of the job.
+        """
+        assert len(cond.shape) == 3
+        if self.closed:
+            raise RuntimeError("the batch scheduler is closed")
+        job = _Job(cond, sampler if sampler is not None else DDIMSampler(), prefix)
+        self._queue.put(job)
+        return job.future
+
+    def sample(self, cond, sampler=None, prefix=None):
+        return self.submit(cond, sampler, prefix).result()
+
+    def close(self):
+        """Stop the sampling thread once the jobs submitted so far are sampled."""
+        self.closed = True
+        self._queue.put(_STOP)
+
+    def _fits(self, batch, size, job):
+        return (
+            job.sampler.key == batch[0].sampler.key
+            and size + len(job) <= self.max_batch_size
+        )
+
+    def _next_batch(self):
+        if self._pending:
+            job = self._pending.popleft()
+        elif self._stopping:
+            return None
+        else:
+            job = self._queue.get()
+            if job is _STOP:
+                return None
+        batch, size = [job], len(job)
+        for job in list(self._pending):
+            if self._fits(batch, size, job):
+                self._pending.remove(job)
+                batch.append(job)
+                size += len(job)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is _STOP:
+                self._stopping = True
+                break
+            if not self._fits(batch, size, job):
+                self._pending.append(job)
+                continue
+            batch.append(job)
+            size += len(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                with use_traces(*(trace for job in batch for trace in job.traces)):
+                    samples = self._sample(batch)
+            except Exception as e:
+                for job in batch:
+                    job.future.set_exception(e)
+                continue
+            for job, job_samples in zip(batch, samples):
+                job.future.set_result(job_samples)
+        # jobs that raced with close
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not _STOP:
+                job.future.set_exception(RuntimeError("the batch scheduler is closed"))
+
+    @torch.no_grad()
+    def _sample(self, batch):
+        device = self.model.device
+        sizes = [len(job) for job in batch]
+        segments, start = [], 0
+        for size in sizes:
+            segments.append((start, start + size))
+            start += size
+        cond = torch.cat([job.cond.to(device) for job in batch], dim=0)
+        prefixes = {
+            start: job.prefix
+            for job, (start, _) in zip(batch, segments)
+            if job.prefix is not None
+        }
+        shape = (len(cond), self.model.horizon, self.model.repr_dim)
+        samples = (
+            self.model.diffusion.long_ddim_sample(
+                shape,
+                cond,
+                segments=segments,
+                sampler=batch[0].sampler,
+                prefixes=prefixes,
+            )
+            .detach()
+            .cpu()
+        )
+        return torch.split(samples, sizes, dim=0)
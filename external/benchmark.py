@@ -0,0 +1,373 @@
+"""
+Micro-benchmarks of the generation pipeline, on CPU or GPU, with randomly
+initialized models at the production config and synthetic inputs, so no
+checkpoint or jukebox weights are needed.
+
+    python benchmark.py --out bench.json                 # run everything
+    python benchmark.py --cases fk normalizer            # a subset
+    python benchmark.py --baseline bench.json --write-baseline   # record a baseline
+    python benchmark.py --baseline bench.json --out new.json
+
+With --baseline, every result is compared to the same result in an earlier
+output file and the run exits with status 1 if any got slower by more than
+--tolerance. Baselines are only comparable on the same machine and settings,
+so none is shipped: record one with --write-baseline first (on the reference
+commit), which stores the run at --baseline instead of comparing. Results of
+cases not run are kept, so a baseline can be recorded a subset at a time.
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from data.audio_extraction import baseline_features
+from dataset.preprocess import Normalizer
+from model.cpu_backend import prepare_cpu_inference
+from model.diffusion import GaussianDiffusion
+from model.model import DanceDecoder
+from model.samplers import DDIMSampler
+from vis import SMPLSkeleton, skeleton_render
+
+# production config, see EDGE.__init__
+HORIZON = 150
+REPR_DIM = 3 + 24 * 6 + 4
+FEATURE_DIM = 4800
+
+CASES = {}
+
+
+def case(fn):
+    """Register `fn(bench)`, yielding (params, callable) pairs to time."""
+    CASES[fn.__name__] = fn
+    return fn
+
+
+class Bench:
+    def __init__(self, device, steps, lengths, seed):
+        self.device = device
+        self.steps = steps
+        self.lengths = lengths
+        self.seed = seed
+        self._diffusion = None
+
+    def rng(self):
+        return np.random.default_rng(self.seed)
+
+    def randn(self, *shape):
+        generator = torch.Generator().manual_seed(self.seed)
+        return torch.randn(*shape, generator=generator).to(self.device)
+
+    @property
+    def diffusion(self):
+        if self._diffusion is None:
+            torch.manual_seed(self.seed)
+            model = DanceDecoder(
+                nfeats=REPR_DIM,
+                seq_len=HORIZON,
+                latent_dim=512,
+                ff_size=1024,
+                num_layers=8,
+                num_heads=8,
+                dropout=0.1,
+                cond_feature_dim=FEATURE_DIM,
+                activation=F.gelu,
+            )
+            self._diffusion = GaussianDiffusion(
+                model,
+                HORIZON,
+                REPR_DIM,
+                SMPLSkeleton(self.device),
+                schedule="cosine",
+                n_timestep=1000,
+                predict_epsilon=False,
+                loss_type="l2",
+                use_p2=False,
+                cond_drop_prob=0.25,
+                guidance_weight=2,
+            ).to(self.device).eval()
+        return self._diffusion
+
+    def poses(self, frames):
+        # a random walk of joint positions, so rendering sees motion
+        steps = self.rng().normal(scale=0.01, size=(frames, 24, 3))
+        return np.cumsum(steps, axis=0) + np.array([0, 0, 2.0])
+
+    def audio(self, seconds, sr):
+        # clicks at 120 bpm over a chord, enough structure for onset / beat tracking
+        t = np.arange(int(seconds * sr)) / sr
+        audio = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6)) / 6
+        audio[(t % 0.5) < 0.01] += 0.8
+        return audio.astype(np.float32)
+
+
+def windows(seconds):
+    # number of 5 s windows at a 2.5 s hop, as in single_music_generator
+    return max(1, int(seconds / 2.5) - 1)
+
+
+@case
+def decoder_forward(bench):
+    model = bench.diffusion.model
+    for batch in (1, 8):
+        x = bench.randn(batch, HORIZON, REPR_DIM)
+        cond = bench.randn(batch, HORIZON, FEATURE_DIM)
+        times = torch.full((batch,), 500, device=bench.device, dtype=torch.long)
+        yield {"batch": batch}, lambda: model(x, cond, times)
+
+
+@case
+def guided_forward(bench):
+    model = bench.diffusion.model
+    for batch in (1, 8):
+        x = bench.randn(batch, HORIZON, REPR_DIM)
+        cond = model.encode_cond(bench.randn(batch, HORIZON, FEATURE_DIM))
+        times = torch.full((batch,), 500, device=bench.device, dtype=torch.long)
+        yield {"batch": batch}, lambda: model.guided_forward(x, cond, times, 2.0)
+
+
+@case
+def guided_forward_cpu_backend(bench):
+    # the float guided_forward case is the reference for these numbers
+    reference = bench.diffusion.model
+    for quantized, compiled in ((True, False), (False, True)):
+        model = prepare_cpu_inference(
+            copy.deepcopy(reference), HORIZON, quantized=quantized, compiled=compiled
+        )
+        for batch in (1, 8):
+            x = bench.randn(batch, HORIZON, REPR_DIM)
+            cond = model.encode_cond(bench.randn(batch, HORIZON, FEATURE_DIM))
+            times = torch.full((batch,), 500, device=bench.device, dtype=torch.long)
+            yield {"quantized": quantized, "compiled": compiled, "batch": batch}, (
+                lambda: model.guided_forward(x, cond, times, 2.0)
+            )
+
+
+@case
+def ddim_sample(bench):
+    cond = bench.randn(1, HORIZON, FEATURE_DIM)
+    sampler = DDIMSampler(steps=bench.steps)
+    yield {"steps": bench.steps}, lambda: bench.diffusion.ddim_sample(
+        (1, HORIZON, REPR_DIM), cond, sampler=sampler
+    )
+
+
+@case
+def long_ddim_sample(bench):
+    sampler = DDIMSampler(steps=bench.steps)
+    for seconds in bench.lengths:
+        count = windows(seconds)
+        cond = bench.randn(count, HORIZON, FEATURE_DIM)
+        yield {"seconds": seconds, "windows": count, "steps": bench.steps}, (
+            lambda: bench.diffusion.long_ddim_sample(
+                (count, HORIZON, REPR_DIM), cond, sampler=sampler
+            )
+        )
+
+
+@case
+def fk(bench):
+    # the joint-by-joint reference is kept to watch the speedup of the level-parallel FK
+    smpl = bench.diffusion.smpl
+    for batch, seq in ((1, 150), (64, 150), (1, 1800)):
+        rotations = bench.randn(batch, seq, 24, 3)
+        root = bench.randn(batch, seq, 3)
+        rotations_np, root_np = rotations.cpu().numpy(), root.cpu().numpy()
+        yield {"impl": "levels", "batch": batch, "seq": seq}, lambda: smpl.forward(rotations, root)
+        yield {"impl": "numpy", "batch": batch, "seq": seq}, lambda: smpl.forward_numpy(rotations_np, root_np)
+        yield {"impl": "reference", "batch": batch, "seq": seq}, lambda: smpl.forward_reference(rotations, root)
+
+
+@case
+def normalizer(bench):
+    data = bench.randn(256, HORIZON, REPR_DIM)
+    norm = Normalizer(data)
+    for batch in (1, 64):
+        x = data[:batch]
+        yield {"batch": batch}, lambda: norm.unnormalize(norm.normalize(x))
+
+
+@case
+def baseline_features_slice(bench):
+    audio = bench.audio(5.0, baseline_features.SR)
+    yield {"seconds": 5.0}, lambda: baseline_features.extract_audio(audio)
+
+
+@case
+def baseline_features_track(bench):
+    for seconds in bench.lengths:
+        audio = bench.audio(seconds, baseline_features.SR)
+        yield {"seconds": seconds}, lambda: baseline_features.extract_track(audio)
+
+
+@case
+def render(bench):
+    for frames in (150, 600):
+        poses = bench.poses(frames)
+        yield {"backend": "fast", "frames": frames}, lambda: _render(poses, "fast")
+
+
+@case
+def render_matplotlib(bench):
+    poses = bench.poses(150)
+    yield {"backend": "matplotlib", "frames": 150}, lambda: _render(poses, "matplotlib")
+
+
+def _render(poses, backend):
+    with TemporaryDirectory() as out:
+        skeleton_render(poses, out=out, name="bench.wav", sound=False, backend=backend)
+
+
+def timeit(fn, repeats, warmup):
+    cuda = torch.cuda.is_available()
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeats):
+            if cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            fn()
+            if cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e3
+    return {
+        "median_ms": round(float(np.median(times)), 3),
+        "min_ms": round(float(times.min()), 3),
+        "mean_ms": round(float(times.mean()), 3),
+        "std_ms": round(float(times.std()), 3),
+        "repeats": repeats,
+    }
+
+
+def result_key(name, params):
+    return name + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+
+
+def run(bench, names, repeats, warmup):
+    results = {}
+    for name in names:
+        for params, fn in CASES[name](bench):
+            key = result_key(name, params)
+            results[key] = {"case": name, "params": params, **timeit(fn, repeats, warmup)}
+            print(f"{key:<60} {results[key]['median_ms']:>12.2f} ms")
+    return results
+
+
+def metadata(opt):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "device": opt.device,
+        "threads": torch.get_num_threads(),
+        "steps": opt.steps,
+        "seed": opt.seed,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every shared result, return the keys that regressed."""
+    regressions = []
+    print(f"\n{'':<60} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"{key:<60} {'-':>12} {result['median_ms']:>10.2f}ms {'new':>8}")
+            continue
+        before, after = baseline[key]["median_ms"], result["median_ms"]
+        ratio = after / before if before > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<60} {before:>10.2f}ms {after:>10.2f}ms {ratio - 1:>+7.1%}{flag}")
+    return regressions
+
+
+def parse_benchmark_opt():
+    parser = argparse.ArgumentParser(description="Benchmark the generation pipeline")
+    parser.add_argument(
+        "--cases", nargs="+", default=None, choices=sorted(CASES),
+        help="cases to run (all but render_matplotlib and guided_forward_cpu_backend if unset)",
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=10, help="sampler steps")
+    parser.add_argument(
+        "--lengths", nargs="+", type=float, default=[10.0, 30.0, 60.0],
+        help="song lengths in seconds for the long-form cases",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="write results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument(
+        "--write-baseline", action="store_true",
+        help="record the results at --baseline instead of comparing against it",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.15,
+        help="allowed slowdown of the median against the baseline",
+    )
+    opt = parser.parse_args()
+    if opt.write_baseline and opt.baseline is None:
+        parser.error("--write-baseline needs --baseline")
+    if opt.baseline is not None and not opt.write_baseline and not os.path.isfile(opt.baseline):
+        parser.error(f"no baseline at {opt.baseline}, record one with --write-baseline")
+    return opt
+
+
+def write_baseline(path, meta, results):
+    """Store `results` at `path`, keeping the recorded results of other cases."""
+    recorded = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            recorded = json.load(f)["results"]
+    recorded.update(results)
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": recorded}, f, indent=2)
+    print(f"Baseline written to {path}")
+
+
+if __name__ == "__main__":
+    opt = parse_benchmark_opt()
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    names = opt.cases or [
+        name for name in CASES if name not in ("render_matplotlib", "guided_forward_cpu_backend")
+    ]
+    bench = Bench(opt.device, opt.steps, opt.lengths, opt.seed)
+    results = run(bench, names, opt.repeats, opt.warmup)
+    if opt.out is not None:
+        with open(opt.out, "w") as f:
+            json.dump({"meta": metadata(opt), "results": results}, f, indent=2)
+        print(f"Results written to {opt.out}")
+    if opt.write_baseline:
+        write_baseline(opt.baseline, metadata(opt), results)
+    elif opt.baseline is not None:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], opt.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {opt.tolerance:.0%}")
+            sys.exit(1)
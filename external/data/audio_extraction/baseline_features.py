@@ -47,7 +47,24 @@ def extract(fpath, skip_completed=True, dest_dir="aist_baseline_feats"):
         return
 
     data, _ = librosa.load(fpath, sr=SR)
+    audio_feature = extract_audio(data, audio_name)
 
+    #np.save(save_path, audio_feature)
+    return audio_feature, save_path
+
+
+def extract_audio(data, audio_name=""):
+    """Features of one 5 s slice already decoded at SR."""
+    audio_feature = extract_track(data, audio_name)
+
+    # chop to ensure exact shape
+    audio_feature = audio_feature[:5 * FPS]
+    assert (audio_feature.shape[0] - 5 * FPS) == 0, f"expected output to be ~5s, but was {audio_feature.shape[0] / FPS}"
+    return audio_feature
+
+
+def extract_track(data, audio_name=""):
+    """(seq_len, 35) feature sequence at FPS for mono audio of any length decoded at SR."""
     envelope = librosa.onset.onset_strength(y=data, sr=SR)  # (seq_len,)
     mfcc = librosa.feature.mfcc(y=data, sr=SR, n_mfcc=20).T  # (seq_len, 20)
     chroma = librosa.feature.chroma_cens(
@@ -60,11 +77,24 @@ def extract(fpath, skip_completed=True, dest_dir="aist_baseline_feats"):
     peak_onehot = np.zeros_like(envelope, dtype=np.float32)
     peak_onehot[peak_idxs] = 1.0  # (seq_len,)
 
+    beat_idxs = beat_track(envelope, audio_name)
+    beat_onehot = np.zeros_like(envelope, dtype=np.float32)
+    beat_onehot[beat_idxs] = 1.0  # (seq_len,)
+
+    audio_feature = np.concatenate(
+        [envelope[:, None], mfcc, chroma, peak_onehot[:, None], beat_onehot[:, None]],
+        axis=-1,
+    )
+    return audio_feature
+
+
+def beat_track(envelope, audio_name=""):
+    """Beat frame indices at FPS for an onset strength envelope."""
     try:
         start_bpm = _get_tempo(audio_name)
     except:
         # determine manually
-        start_bpm = lr.beat.tempo(y=lr.load(fpath)[0])[0]
+        start_bpm = lr.beat.tempo(onset_envelope=envelope, sr=SR, hop_length=HOP_LENGTH)[0]
 
     tempo, beat_idxs = librosa.beat.beat_track(
         onset_envelope=envelope,
@@ -73,20 +103,14 @@ def extract(fpath, skip_completed=True, dest_dir="aist_baseline_feats"):
         start_bpm=start_bpm,
         tightness=100,
     )
-    beat_onehot = np.zeros_like(envelope, dtype=np.float32)
-    beat_onehot[beat_idxs] = 1.0  # (seq_len,)
-
-    audio_feature = np.concatenate(
-        [envelope[:, None], mfcc, chroma, peak_onehot[:, None], beat_onehot[:, None]],
-        axis=-1,
-    )
+    return beat_idxs
 
-    # chop to ensure exact shape
-    audio_feature = audio_feature[:5 * FPS]
-    assert (audio_feature.shape[0] - 5 * FPS) == 0, f"expected output to be ~5s, but was {audio_feature.shape[0] / FPS}"
 
-    #np.save(save_path, audio_feature)
-    return audio_feature, save_path
+def extract_beats(fpath):
+    """Beat frame indices at FPS of an audio file, as in the `beat_onehot` feature."""
+    data, _ = librosa.load(fpath, sr=SR)
+    envelope = librosa.onset.onset_strength(y=data, sr=SR)
+    return beat_track(envelope, Path(fpath).stem)
 
 
 def extract_folder(src, dest):
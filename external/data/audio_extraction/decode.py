@@ -0,0 +1,47 @@
+"""
+Decode any audio file ffmpeg can read straight to mono float32 PCM at the
+sample rate a feature extractor wants, streamed through a pipe into memory
+(no intermediate WAV, no resampling in Python).
+"""
+import subprocess
+
+import librosa as lr
+import numpy as np
+
+# seconds a decode may take, far more than any song needs
+TIMEOUT = 300
+# characters of ffmpeg's error output kept in the exception
+ERROR_TAIL = 2000
+
+
+def ffmpeg_decode_command(path, sr):
+    return [
+        "ffmpeg", "-loglevel", "error", "-nostdin",
+        "-i", path,
+        "-vn", "-ac", "1", "-ar", str(sr),
+        "-f", "f32le", "-acodec", "pcm_f32le", "pipe:1",
+    ]
+
+
+def decode_audio(path, sr, timeout=TIMEOUT):
+    """Mono float32 samples of `path` at `sr` Hz."""
+    try:
+        proc = subprocess.Popen(
+            ffmpeg_decode_command(path, sr), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        print("ffmpeg not found, decoding with librosa")
+        audio, _ = lr.load(path, sr=sr, mono=True)
+        return audio.astype(np.float32)
+    # both pipes are drained together, ffmpeg blocks once either one is full
+    try:
+        data, error = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise RuntimeError(f"ffmpeg could not decode {path}: timed out after {timeout} s")
+    if proc.returncode != 0:
+        error = error.decode(errors="replace").strip()[-ERROR_TAIL:]
+        raise RuntimeError(f"ffmpeg could not decode {path}: {error}")
+    # whole samples only, a truncated stream may end mid-sample
+    return np.frombuffer(data, dtype="<f4", count=len(data) // 4)
@@ -0,0 +1,176 @@
+import fcntl
+import glob
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from tqdm import tqdm
+
+
+def cache_key(audio, sr, feature_type, layer=None, stride=2.5, length=5.0, mode="slice", span=None):
+    """
+    Content address for the features of one decoded track under the given
+    extraction settings. Whole-track features depend on the audio around each
+    window, so those extracted from a crop of the track are keyed by its
+    (start, stop) sample `span`.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+    h.update(f"{sr}|{feature_type}|{layer}|{stride}|{length}|{mode}".encode())
+    if span is not None:
+        h.update(f"|{span[0]}:{span[1]}".encode())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk cache of per-slice audio features, keyed by `cache_key`.
+
+    Each track is stored as one (num_slices, seq_len, dim) .npy file, read back
+    memory-mapped, plus a small mask of which slices have been filled in, so a
+    partially extracted track can be completed later. Files are evicted least
+    recently used first once the cache grows past `max_bytes`.
+
+    Several processes may share a cache directory: writers and eviction hold
+    a lock file, files are replaced atomically, and a reader that loses a
+    race with them sees a cache miss.
+    """
+
+    def __init__(self, cache_dir="cached_features", max_bytes=2 * 1024 ** 3, dtype=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        # the thread lock orders this process' writers, the file lock other processes'
+        with self._lock, open(os.path.join(self.cache_dir, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".npy", base + ".mask.npy"
+
+    def get(self, key, indices):
+        """
+        Return a list with the cached feature array for each slice index, or
+        None for slices that are not cached.
+        """
+        feats_path, mask_path = self._paths(key)
+        if not os.path.exists(mask_path):
+            return [None] * len(indices)
+        try:
+            # the mask is read first, the features it points to are never replaced by fewer
+            mask = np.load(mask_path)
+            feats = np.load(feats_path, mmap_mode="r")
+            out = [
+                np.array(feats[i], dtype=np.float32) if i < len(mask) and mask[i] else None
+                for i in indices
+            ]
+            # mark as recently used
+            os.utime(feats_path)
+        except Exception as e:
+            # evicted or being rewritten by another process
+            print(f"Feature cache read failed, treating as a miss: {e}")
+            return [None] * len(indices)
+        return out
+
+    def put(self, key, num_slices, slices):
+        """Store `slices`, a dict of slice index -> feature array, for a track of `num_slices` slices."""
+        if not slices:
+            return
+        feats_path, mask_path = self._paths(key)
+        sample = next(iter(slices.values()))
+        dtype = self.dtype or sample.dtype
+        with self._locked():
+            mask, old = np.zeros(num_slices, dtype=bool), None
+            if os.path.exists(mask_path):
+                try:
+                    mask = np.load(mask_path)
+                    old = np.load(feats_path, mmap_mode="r")
+                except Exception:
+                    mask, old = np.zeros(num_slices, dtype=bool), None
+            # readers may have the current files open, so new versions are
+            # written aside and swapped in
+            tmp_feats, tmp_mask = feats_path + ".tmp", mask_path + ".tmp"
+            feats = np.lib.format.open_memmap(
+                tmp_feats,
+                mode="w+",
+                dtype=old.dtype if old is not None else dtype,
+                shape=old.shape if old is not None else (num_slices, *sample.shape),
+            )
+            if old is not None:
+                feats[:] = old
+            for i, rep in slices.items():
+                feats[i] = rep
+                mask[i] = True
+            feats.flush()
+            del feats, old
+            os.replace(tmp_feats, feats_path)
+            # the mask is swapped in last so it never points at unfilled slices
+            with open(tmp_mask, "wb") as f:
+                np.save(f, mask)
+            os.replace(tmp_mask, mask_path)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for feats_path in glob.glob(os.path.join(self.cache_dir, "*.npy")):
+            if feats_path.endswith(".mask.npy"):
+                continue
+            mask_path = feats_path[: -len(".npy")] + ".mask.npy"
+            size = os.path.getsize(feats_path)
+            if os.path.exists(mask_path):
+                size += os.path.getsize(mask_path)
+            entries.append((os.path.getmtime(feats_path), size, feats_path, mask_path))
+            total += size
+        # oldest access first
+        for _, size, feats_path, mask_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (mask_path, feats_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+
+def extract_slices(feature_func, file_list, indices, cache=None, key=None, write=True):
+    """
+    Features of file_list[i] for every i in `indices`, served from `cache` where
+    possible. Newly extracted slices are written back unless `write` is False.
+    """
+    cached = cache.get(key, indices) if cache is not None else [None] * len(indices)
+    if cache is not None:
+        print(f"{sum(rep is not None for rep in cached)}/{len(indices)} slices found in feature cache")
+    out, extracted = [], {}
+    for idx, rep in zip(indices, tqdm(cached)):
+        if rep is None:
+            rep, _ = feature_func(file_list[idx])
+            extracted[idx] = rep
+        out.append(rep)
+    if cache is not None and write:
+        cache.put(key, len(file_list), extracted)
+    return out
+
+
+def extract_windows_cached(compute, indices, num_slices, cache=None, key=None, write=True):
+    """
+    Like `extract_slices` for extractors that produce a whole range of windows
+    at once: the windows are read from `cache` if all of them are present,
+    otherwise `compute()` returns all of them and they are written back.
+    """
+    cached = cache.get(key, indices) if cache is not None else [None]
+    if all(rep is not None for rep in cached):
+        print(f"{len(indices)} windows found in feature cache")
+        return cached
+    windows = compute()
+    assert len(windows) == len(indices)
+    if cache is not None and write:
+        cache.put(key, num_slices, dict(zip(indices, windows)))
+    return list(windows)
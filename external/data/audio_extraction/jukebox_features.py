@@ -8,6 +8,10 @@ from tqdm import tqdm
 
 FPS = 30
 LAYER = 66
+SR = 44100
+# jukebox only attends over ~24 s of audio, so whole tracks are encoded in
+# chunks of this many seconds (a multiple of the 2.5 s slice stride)
+CHUNK_SECONDS = 20
 
 
 def extract(fpath, skip_completed=True, dest_dir="aist_juke_feats"):
@@ -19,10 +23,33 @@ def extract(fpath, skip_completed=True, dest_dir="aist_juke_feats"):
         return
 
     audio = jukemirlib.load_audio(fpath)
-    reps = jukemirlib.extract(audio, layers=[LAYER], downsample_target_rate=FPS)
 
     #np.save(save_path, reps[LAYER])
-    return reps[LAYER], save_path
+    return extract_audio(audio), save_path
+
+
+def extract_audio(audio):
+    """Features of mono audio already decoded at SR."""
+    reps = jukemirlib.extract(audio, layers=[LAYER], downsample_target_rate=FPS)
+    return reps[LAYER]
+
+
+def extract_track(audio, chunk_seconds=CHUNK_SECONDS):
+    """(seq_len, 4800) feature sequence at FPS for mono audio of any length decoded at SR."""
+    chunk = int(chunk_seconds * SR)
+    frames = []
+    for start in range(0, len(audio), chunk):
+        piece = audio[start : start + chunk]
+        n_frames = int(round(len(piece) / SR * FPS))
+        if n_frames == 0:
+            break
+        reps = extract_audio(piece)[:n_frames]
+        if len(reps) < n_frames:
+            # downsampling can come up a frame short, repeat the last one
+            pad = np.repeat(reps[-1:], n_frames - len(reps), axis=0)
+            reps = np.concatenate([reps, pad], axis=0)
+        frames.append(reps)
+    return np.concatenate(frames, axis=0)
 
 
 def extract_folder(src, dest):
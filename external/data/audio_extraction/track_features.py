@@ -0,0 +1,103 @@
+import librosa as lr
+import numpy as np
+
+from data.audio_extraction import baseline_features, jukebox_features
+from data.slice import num_slices, window_view
+
+FPS = 30
+EPS = 1e-6
+# baseline channels that are onset / beat one-hots rather than continuous values
+BASELINE_ONEHOTS = [33, 34]
+
+
+def _module(feature_type):
+    return jukebox_features if feature_type == "jukebox" else baseline_features
+
+
+def target_sr(feature_type):
+    """Sample rate the extractor of `feature_type` works at, decode to it to skip resampling."""
+    return _module(feature_type).SR
+
+
+def _resample(audio, sr, feature_type):
+    target_sr = _module(feature_type).SR
+    if sr != target_sr:
+        audio = lr.resample(audio, orig_sr=sr, target_sr=target_sr)
+    return audio
+
+
+def extract_windows(
+    audio, sr, feature_type, stride=2.5, length=5.0, audio_name="", validate=False
+):
+    """
+    Conditioning for every `length` s window of `audio` at a `stride` s hop.
+
+    The FPS feature sequence is computed once over the whole track and the
+    overlapping windows are returned as a (windows, length * FPS, dim) strided
+    view, instead of running the extractor on every (overlapping) slice.
+    With `validate`, the per-slice features are computed as well and the
+    difference is reported.
+    """
+    count = num_slices(len(audio), sr, stride, length)
+    window, step = int(length * FPS), int(stride * FPS)
+    if count == 0:
+        return np.zeros((0, window, 4800 if feature_type == "jukebox" else 35), np.float32)
+    track_audio = _resample(audio, sr, feature_type)
+    if feature_type == "jukebox":
+        feats = jukebox_features.extract_track(track_audio)
+    else:
+        feats = baseline_features.extract_track(track_audio, audio_name)
+    needed = (count - 1) * step + window
+    if len(feats) < needed:
+        # frame rounding at the very end of the track
+        pad = np.repeat(feats[-1:], needed - len(feats), axis=0)
+        feats = np.concatenate([feats, pad], axis=0)
+    windows = window_view(np.ascontiguousarray(feats), step, window, count)
+    if validate:
+        sliced = slice_features(audio, sr, feature_type, stride, length, audio_name)
+        compare_features(windows, sliced, feature_type)
+    return windows
+
+
+def slice_features(audio, sr, feature_type, stride=2.5, length=5.0, audio_name=""):
+    """Reference per-slice extraction, done in memory (no temporary wav files)."""
+    window, step = int(length * sr), int(stride * sr)
+    out = []
+    for idx in range(num_slices(len(audio), sr, stride, length)):
+        piece = _resample(audio[idx * step : idx * step + window], sr, feature_type)
+        if feature_type == "jukebox":
+            out.append(jukebox_features.extract_audio(piece)[: int(length * FPS)])
+        else:
+            out.append(baseline_features.extract_audio(piece, audio_name))
+    return np.stack(out)
+
+
+def compare_features(track, sliced, feature_type, rtol=0.05, edge=8):
+    """
+    Report how far whole-track features are from per-slice features, relative
+    to each channel's range. Frames within `edge` of a slice boundary are
+    expected to differ (the per-slice extractor pads there while the track
+    has real context), so the max error is taken over interior frames only.
+    For the baseline onset / beat channels the fraction of agreeing frames is
+    reported instead.
+    """
+    track = np.asarray(track)
+    continuous = list(range(track.shape[-1]))
+    stats = {}
+    if feature_type != "jukebox":
+        continuous = [c for c in continuous if c not in BASELINE_ONEHOTS]
+        onehots = track[..., BASELINE_ONEHOTS] == sliced[..., BASELINE_ONEHOTS]
+        stats["onehot_agreement"] = float(onehots.mean())
+    diff = np.abs(track[..., continuous] - sliced[..., continuous])
+    value_range = np.ptp(sliced[..., continuous], axis=(0, 1)) + EPS
+    stats["mean_rel_error"] = float((diff.mean(axis=(0, 1)) / value_range).mean())
+    stats["interior_max_rel_error"] = float(
+        (diff[:, edge:-edge].max(axis=(0, 1)) / value_range).max()
+    )
+    print(f"Whole-track vs per-slice features: {stats}")
+    if stats["mean_rel_error"] > rtol:
+        print(
+            f"Warning: whole-track features differ from per-slice features by "
+            f"{stats['mean_rel_error']:.3f} of the channel range on average (tolerance {rtol})"
+        )
+    return stats
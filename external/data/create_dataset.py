@@ -2,31 +2,27 @@ import argparse
 import os
 from pathlib import Path
 
-from audio_extraction.baseline_features import \
-    extract_folder as baseline_extract
-from audio_extraction.jukebox_features import extract_folder as jukebox_extract
 from filter_split_data import *
-from slice import *
+from pipeline import build_split
 
 
 def create_dataset(opt):
     # split the data according to the splits files
     print("Creating train / test split")
     split_data(opt.dataset_folder)
-    # slice motions/music into sliding windows to create training dataset
-    print("Slicing train data")
-    slice_aistpp(f"train/motions", f"train/wavs")
-    print("Slicing test data")
-    slice_aistpp(f"test/motions", f"test/wavs")
-    # process dataset to extract audio features
-    if opt.extract_baseline:
-        print("Extracting baseline features")
-        baseline_extract("train/wavs_sliced", "train/baseline_feats")
-        baseline_extract("test/wavs_sliced", "test/baseline_feats")
-    if opt.extract_jukebox:
-        print("Extracting jukebox features")
-        jukebox_extract("train/wavs_sliced", "train/jukebox_feats")
-        jukebox_extract("test/wavs_sliced", "test/jukebox_feats")
+    # slice motions/music into sliding windows and extract audio features,
+    # in parallel and resuming from the manifest of a previous run
+    for split in ["train", "test"]:
+        print(f"Building {split} data")
+        build_split(
+            split,
+            stride=opt.stride,
+            length=opt.length,
+            baseline=opt.extract_baseline,
+            jukebox=opt.extract_jukebox,
+            workers=opt.workers,
+            write_wavs=not opt.no_wavs,
+        )
 
 
 def parse_opt():
@@ -41,6 +37,12 @@ def parse_opt():
     )
     parser.add_argument("--extract-baseline", action="store_true")
     parser.add_argument("--extract-jukebox", action="store_true")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="worker processes (default: all cores)"
+    )
+    parser.add_argument(
+        "--no-wavs", action="store_true", help="don't write the sliced wavs used for rendering"
+    )
     opt = parser.parse_args()
     return opt
 
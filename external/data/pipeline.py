@@ -0,0 +1,152 @@
+import glob
+import json
+import os
+import pickle
+from multiprocessing import Pool
+
+import librosa as lr
+import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+
+from slice import num_slices, window_view
+
+# Output layout of a split built by this pipeline:
+#   {split}/shards/{track}.motion.npz   pos (slices x frames x 3), q (slices x frames x 72)
+#   {split}/shards/{track}.baseline.npy baseline features (slices x 150 x 35)
+#   {split}/shards/{track}.jukebox.npy  jukebox features (slices x 150 x 4800)
+#   {split}/wavs_sliced/{track}_slice{i}.wav (optional, used to render samples)
+#   {split}/manifest.json               track -> number of slices and finished stages
+MOTION_FPS = 60
+
+
+class Manifest:
+    """Records which stages are finished for each track, so interrupted builds resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tracks = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.tracks = json.load(f)
+
+    def done(self, track, stage):
+        return stage in self.tracks.get(track, {}).get("stages", [])
+
+    def slices(self, track):
+        return self.tracks[track]["slices"]
+
+    def mark(self, track, stage, slices):
+        entry = self.tracks.setdefault(track, {"slices": slices, "stages": []})
+        entry["slices"] = slices
+        if stage not in entry["stages"]:
+            entry["stages"].append(stage)
+        # write-then-rename so a crash never leaves a truncated manifest
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.tracks, f)
+        os.replace(tmp, self.path)
+
+
+def slice_track(wav, motion, shard_dir, wav_out, stride, length, baseline):
+    """Slice one track's audio and motion and optionally extract baseline features, all in memory."""
+    track = os.path.splitext(os.path.basename(wav))[0]
+    audio, sr = lr.load(wav, sr=None)
+    count = num_slices(len(audio), sr, stride, length)
+
+    data = pickle.load(open(motion, "rb"))
+    pos, q = data["pos"] / data["scale"][0], data["q"]
+    window, stride_step = int(length * MOTION_FPS), int(stride * MOTION_FPS)
+    # slice until done or until matching audio slices
+    count = min(count, max(0, (len(pos) - window) // stride_step + 1))
+    np.savez(
+        os.path.join(shard_dir, f"{track}.motion.npz"),
+        pos=window_view(pos, stride_step, window, count),
+        q=window_view(q, stride_step, window, count),
+    )
+
+    audio_window, audio_stride = int(length * sr), int(stride * sr)
+    audio_slices = window_view(audio, audio_stride, audio_window, count)
+    if wav_out is not None:
+        for idx, audio_slice in enumerate(audio_slices):
+            sf.write(os.path.join(wav_out, f"{track}_slice{idx}.wav"), audio_slice, sr)
+    if baseline:
+        from audio_extraction.baseline_features import FPS, SR, extract_audio
+
+        feats = np.zeros((count, int(length * FPS), 35), dtype=np.float32)
+        for idx, audio_slice in enumerate(audio_slices):
+            feats[idx] = extract_audio(
+                lr.resample(audio_slice, orig_sr=sr, target_sr=SR), f"{track}_slice{idx}"
+            )
+        np.save(os.path.join(shard_dir, f"{track}.baseline.npy"), feats)
+    return track, count
+
+
+def _slice_track(args):
+    return slice_track(*args)
+
+
+def build_split(
+    split, stride=0.5, length=5.0, baseline=False, jukebox=False, workers=None, write_wavs=True
+):
+    """
+    Slice `split`/wavs and `split`/motions into training windows and extract
+    features into per-track shards. Slicing and baseline extraction run on a
+    process pool; jukebox extraction runs in this process since it holds one
+    large model. Finished work is recorded in the manifest and skipped when
+    the build is run again.
+    """
+    wavs = sorted(glob.glob(f"{split}/wavs/*.wav"))
+    motions = sorted(glob.glob(f"{split}/motions/*.pkl"))
+    assert len(wavs) == len(motions)
+    shard_dir = f"{split}/shards"
+    wav_out = f"{split}/wavs_sliced" if write_wavs else None
+    os.makedirs(shard_dir, exist_ok=True)
+    if wav_out is not None:
+        os.makedirs(wav_out, exist_ok=True)
+    manifest = Manifest(f"{split}/manifest.json")
+
+    jobs = []
+    for wav, motion in zip(wavs, motions):
+        # make sure name is matching
+        track = os.path.splitext(os.path.basename(wav))[0]
+        assert track == os.path.splitext(os.path.basename(motion))[0], str((motion, wav))
+        if manifest.done(track, "slice") and (
+            not baseline or manifest.done(track, "baseline")
+        ):
+            continue
+        jobs.append((wav, motion, shard_dir, wav_out, stride, length, baseline))
+    print(f"{split}: {len(wavs) - len(jobs)} tracks already sliced, {len(jobs)} to go")
+
+    with Pool(workers) as pool:
+        for track, count in tqdm(
+            pool.imap_unordered(_slice_track, jobs), total=len(jobs)
+        ):
+            manifest.mark(track, "slice", count)
+            if baseline:
+                manifest.mark(track, "baseline", count)
+
+    if jukebox:
+        extract_jukebox_split(split, manifest, stride, length)
+
+
+def extract_jukebox_split(split, manifest, stride=0.5, length=5.0):
+    from audio_extraction.jukebox_features import FPS, SR, extract_audio
+
+    shard_dir = f"{split}/shards"
+    for wav in tqdm(sorted(glob.glob(f"{split}/wavs/*.wav"))):
+        track = os.path.splitext(os.path.basename(wav))[0]
+        if manifest.done(track, "jukebox"):
+            continue
+        count = manifest.slices(track)
+        audio, _ = lr.load(wav, sr=SR)
+        window, stride_step = int(length * SR), int(stride * SR)
+        # slices were counted at the native rate, resampling can lose a sample
+        needed = max(0, (count - 1) * stride_step + window - len(audio))
+        audio = np.pad(audio, (0, needed))
+        audio_slices = window_view(audio, stride_step, window, count)
+        feats = np.zeros((count, int(length * FPS), 4800), dtype=np.float32)
+        for idx, audio_slice in enumerate(audio_slices):
+            feats[idx] = extract_audio(audio_slice)[: int(length * FPS)]
+        np.save(os.path.join(shard_dir, f"{track}.jukebox.npy"), feats)
+        manifest.mark(track, "jukebox", count)
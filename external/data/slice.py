@@ -12,6 +12,11 @@ def slice_audio(audio_file, stride, length, out_dir):
     # stride, length in seconds
     audio, sr = lr.load(audio_file, sr=None)
     file_name = os.path.splitext(os.path.basename(audio_file))[0]
+    return slice_audio_array(audio, sr, file_name, stride, length, out_dir)
+
+
+def slice_audio_array(audio, sr, file_name, stride, length, out_dir):
+    # same as slice_audio, for audio that is already decoded
     start_idx = 0
     idx = 0
     window = int(length * sr)
@@ -24,6 +29,28 @@ def slice_audio(audio_file, stride, length, out_dir):
     return idx
 
 
+def num_slices(num_samples, sr, stride, length):
+    # number of windows slice_audio produces for audio of this length
+    window = int(length * sr)
+    stride_step = int(stride * sr)
+    if num_samples < window:
+        return 0
+    return (num_samples - window) // stride_step + 1
+
+
+def window_view(seq, stride, length, count=None):
+    """
+    Overlapping windows of a (frames, ...) array as a read-only strided view of
+    shape (count, length, ...), with window i starting at frame i * stride.
+    """
+    if count is None:
+        count = (len(seq) - length) // stride + 1
+    assert count >= 0 and (count == 0 or (count - 1) * stride + length <= len(seq))
+    shape = (count, length) + seq.shape[1:]
+    strides = (seq.strides[0] * stride,) + seq.strides
+    return np.lib.stride_tricks.as_strided(seq, shape, strides, writeable=False)
+
+
 def slice_motion(motion_file, stride, length, num_slices, out_dir):
     motion = pickle.load(open(motion_file, "rb"))
     pos, q = motion["pos"], motion["q"]
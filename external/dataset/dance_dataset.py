@@ -13,6 +13,7 @@ from pytorch3d.transforms import (RotateAxisAngle, axis_angle_to_quaternion,
                                   quaternion_to_axis_angle)
 from torch.utils.data import Dataset
 
+from dataset.feature_store import FeatureStore, build_store, npy_blocks, shard_blocks
 from dataset.preprocess import Normalizer, vectorize_many
 from dataset.quaternion import ax_to_6v
 from vis import SMPLSkeleton
@@ -29,6 +30,8 @@ class AISTPPDataset(Dataset):
         data_len: int = -1,
         include_contacts: bool = True,
         force_reload: bool = False,
+        feature_dtype: str = "float32",
+        force_store: bool = False,
     ):
         self.data_path = data_path
         self.raw_fps = 60
@@ -43,8 +46,6 @@ class AISTPPDataset(Dataset):
         self.normalizer = normalizer
         self.data_len = data_len
 
-        pickle_name = "processed_train_data.pkl" if train else "processed_test_data.pkl"
-
         backup_path = Path(backup_path)
         backup_path.mkdir(parents=True, exist_ok=True)
         # save normalizer
@@ -52,6 +53,51 @@ class AISTPPDataset(Dataset):
             pickle.dump(
                 normalizer, open(os.path.join(backup_path, "normalizer.pkl"), "wb")
             )
+        # normalized poses and features packed into one memory-mapped store per split
+        store_path = os.path.join(
+            backup_path,
+            f"{'train' if train else 'test'}_{feature_type}_{np.dtype(feature_dtype).name}_store",
+        )
+        # the test split is normalized with the train normalizer, its store is stale once that changes
+        source = {
+            "data_path": os.path.abspath(data_path),
+            "normalizer": normalizer.fingerprint() if normalizer is not None else None,
+        }
+        store = FeatureStore(store_path) if FeatureStore.exists(store_path) else None
+        if store is not None and store.source != source and not (force_reload or force_store):
+            print(f"{store_path} was built from other data or another normalizer, rebuilding...")
+            # the raw data cache is only reusable for the same data directory
+            if store.source is None or store.source["data_path"] != source["data_path"]:
+                force_reload = True
+        if force_reload or force_store or store is None or store.source != source:
+            self.build_store(store_path, backup_path, feature_dtype, force_reload, source)
+        else:
+            print("Using packed dataset...")
+        self.store = FeatureStore(store_path)
+        if self.train:
+            self.normalizer = self.store.normalizer()
+
+        self.length = len(self.store)
+        if self.data_len > 0:
+            self.length = min(self.length, self.data_len)
+        print(
+            f"Loaded {self.name} Dataset With Dimensions: Pose: {self.store.fields['poses']['shape']}, "
+            f"Features: {self.store.fields['features']['shape']} ({self.store.fields['features']['dtype']})"
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        # one copy out of the mapped pages, which also casts float16 features up
+        pose = torch.from_numpy(np.array(self.store.array("poses")[idx]))
+        feature = torch.from_numpy(
+            self.store.array("features")[idx].astype(np.float32)
+        )
+        return pose, feature, self.store.names[idx], self.store.wavs[idx]
+
+    def build_store(self, store_path, backup_path, feature_dtype, force_reload, source=None):
+        pickle_name = "processed_train_data.pkl" if self.train else "processed_test_data.pkl"
         # load raw data
         if not force_reload and pickle_name in os.listdir(backup_path):
             print("Using cached dataset...")
@@ -69,21 +115,20 @@ class AISTPPDataset(Dataset):
 
         # process data, convert to 6dof etc
         pose_input = self.process_dataset(data["pos"], data["q"])
-        self.data = {
-            "pose": pose_input,
-            "filenames": data["filenames"],
-            "wavs": data["wavs"],
-        }
         assert len(pose_input) == len(data["filenames"])
-        self.length = len(pose_input)
-
-    def __len__(self):
-        return self.length
-
-    def __getitem__(self, idx):
-        filename_ = self.data["filenames"][idx]
-        feature = torch.from_numpy(np.load(filename_))
-        return self.data["pose"][idx], feature, filename_, self.data["wavs"][idx]
+        if "shards" in data:
+            features = shard_blocks(data["shards"])
+        else:
+            features = npy_blocks(data["filenames"])
+        print(f"Packing {self.name} Dataset into {store_path}...")
+        build_store(
+            store_path,
+            data["filenames"],
+            {"poses": (None, [pose_input.numpy()]), "features": (feature_dtype, features)},
+            wavs=data["wavs"],
+            normalizer=self.normalizer,
+            source=source,
+        )
 
     def load_aistpp(self):
         # open data path
@@ -101,6 +146,11 @@ class AISTPPDataset(Dataset):
         #   |    |- motions
         #   |    |- wavs
 
+        # per-track shards written by data/pipeline.py
+        shard_path = os.path.join(split_data_path, "shards")
+        if os.path.isdir(shard_path):
+            return self.load_shards(split_data_path, shard_path)
+
         motion_path = os.path.join(split_data_path, "motions_sliced")
         sound_path = os.path.join(split_data_path, f"{self.feature_type}_feats")
         wav_path = os.path.join(split_data_path, f"wavs_sliced")
@@ -139,6 +189,43 @@ class AISTPPDataset(Dataset):
         data = {"pos": all_pos, "q": all_q, "filenames": all_names, "wavs": all_wavs}
         return data
 
+    def load_shards(self, split_data_path, shard_path):
+        feature_path = os.path.join(split_data_path, f"{self.feature_type}_feats")
+        wav_path = os.path.join(split_data_path, f"wavs_sliced")
+        motions = sorted(glob.glob(os.path.join(shard_path, "*.motion.npz")))
+
+        all_pos = []
+        all_q = []
+        all_names = []
+        all_wavs = []
+        all_shards = []
+        for motion in motions:
+            track = os.path.basename(motion)[: -len(".motion.npz")]
+            feature = os.path.join(shard_path, f"{track}.{self.feature_type}.npy")
+            assert os.path.isfile(feature), feature
+            data = np.load(motion)
+            all_pos.append(data["pos"])
+            all_q.append(data["q"])
+            for idx in range(len(data["pos"])):
+                name = f"{track}_slice{idx}"
+                all_names.append(os.path.join(feature_path, name + ".npy"))
+                all_wavs.append(os.path.join(wav_path, name + ".wav"))
+                all_shards.append((feature, idx))
+
+        all_pos = np.concatenate(all_pos)  # N x seq x 3
+        all_q = np.concatenate(all_q)  # N x seq x (joint * 3)
+        # downsample the motions to the data fps
+        all_pos = all_pos[:, :: self.data_stride, :]
+        all_q = all_q[:, :: self.data_stride, :]
+        data = {
+            "pos": all_pos,
+            "q": all_q,
+            "filenames": all_names,
+            "wavs": all_wavs,
+            "shards": all_shards,
+        }
+        return data
+
     def process_dataset(self, root_pos, local_q):
         # FK skeleton
         smpl = SMPLSkeleton()
@@ -189,12 +276,6 @@ class AISTPPDataset(Dataset):
         assert not torch.isnan(global_pose_vec_input).any()
         data_name = "Train" if self.train else "Test"
 
-        # cut the dataset
-        if self.data_len > 0:
-            global_pose_vec_input = global_pose_vec_input[: self.data_len]
-
-        global_pose_vec_input = global_pose_vec_input
-
         print(f"{data_name} Dataset Motion Features Dim: {global_pose_vec_input.shape}")
 
         return global_pose_vec_input
@@ -207,10 +288,12 @@ class OrderedMusicDataset(Dataset):
         train: bool = False,
         feature_type: str = "baseline",
         data_name: str = "aist",
+        feature_dtype: str = "float32",
     ):
         self.data_path = data_path
         self.data_fps = 30
         self.feature_type = feature_type
+        self.feature_dtype = feature_dtype
         self.test_list = set(
             [
                 "mLH4",
@@ -250,12 +333,11 @@ class OrderedMusicDataset(Dataset):
             start = random.randint(0, max_start)
             seq_slice = seq[start : start + batch_size]
 
-        # now we have a batch of filenames
-        filenames = [os.path.join(self.music_path, x + ".npy") for x in seq_slice]
-        # get the features
-        features = np.array([np.load(x) for x in filenames])
+        # the slices of a song are consecutive rows of the store
+        start = self.store.row(seq_slice[0])
+        features = self.store.array("features")[start : start + len(seq_slice)]
 
-        return torch.Tensor(features), seq_slice
+        return torch.from_numpy(features.astype(np.float32)), seq_slice
 
     def load_music(self):
         # open data path
@@ -289,6 +371,21 @@ class OrderedMusicDataset(Dataset):
             fname = os.path.splitext(os.path.basename(features))[0]
             all_names.append(fname)
         all_names = sorted(all_names, key=cmp_to_key(stringintcmp))
+        store_path = f"{music_path.rstrip('/')}_{np.dtype(self.feature_dtype).name}_store"
+        if FeatureStore.exists(store_path) and FeatureStore(store_path).names == all_names:
+            self.store = FeatureStore(store_path)
+        else:
+            print(f"Packing {music_path} into {store_path}...")
+            self.store = build_store(
+                store_path,
+                all_names,
+                {
+                    "features": (
+                        self.feature_dtype,
+                        npy_blocks(os.path.join(music_path, x + ".npy") for x in all_names),
+                    )
+                },
+            )
         data_dict = {}
         for name in all_names:
             k = "".join(name.split("_")[:-1])
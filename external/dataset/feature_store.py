@@ -0,0 +1,127 @@
+import itertools
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+# Layout of a store directory:
+#   {field}.npy      one contiguous array per field, rows in index order
+#                    (e.g. poses: N x 150 x 151, features: N x 150 x 4800)
+#   index.json       names and wavs of the rows, shape and dtype of every field,
+#                    and what the store was built from (see `source`)
+#   normalizer.pkl   (optional) the Normalizer the poses were normalized with
+INDEX = "index.json"
+NORMALIZER = "normalizer.pkl"
+
+
+class FeatureStore:
+    """
+    Read side of a packed store. Arrays are memory-mapped on first use, so a
+    sample is a slice of the page cache rather than a file open, and forked
+    DataLoader workers share the pages instead of unpickling copies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as f:
+            index = json.load(f)
+        self.names = index["names"]
+        self.wavs = index["wavs"]
+        self.fields = index["fields"]
+        # e.g. the data directory and normalizer the store was built from,
+        # a store whose source differs from the caller's is stale
+        self.source = index.get("source")
+        self._arrays = {}
+        self._rows = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, INDEX))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # workers map the arrays themselves
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def array(self, field):
+        if field not in self._arrays:
+            self._arrays[field] = np.load(
+                os.path.join(self.path, f"{field}.npy"), mmap_mode="r"
+            )
+        return self._arrays[field]
+
+    def row(self, name):
+        if self._rows is None:
+            self._rows = {name: idx for idx, name in enumerate(self.names)}
+        return self._rows[name]
+
+    def normalizer(self):
+        path = os.path.join(self.path, NORMALIZER)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def build_store(path, names, fields, wavs=None, normalizer=None, source=None):
+    """
+    Pack `fields` into a store at `path`. Each field maps to a (dtype, blocks)
+    pair, `blocks` yielding arrays of consecutive rows (a whole array, one
+    array per shard or one row per file), so the sources are copied in
+    without being held in memory together. dtype None keeps the source dtype.
+    `source` (JSON) records what the store was built from.
+    The store is written to a temporary directory and moved into place once
+    complete, so an interrupted build is never picked up.
+    """
+    tmp = path.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    index = {
+        "names": list(names),
+        "wavs": list(wavs) if wavs is not None else [None] * len(names),
+        "fields": {},
+        "source": source,
+    }
+    for field, (dtype, blocks) in fields.items():
+        blocks = iter(blocks)
+        first = next(blocks)
+        dtype = np.dtype(dtype if dtype is not None else first.dtype)
+        shape = (len(names), *first.shape[1:])
+        out = np.lib.format.open_memmap(
+            os.path.join(tmp, f"{field}.npy"), mode="w+", dtype=dtype, shape=shape
+        )
+        start = 0
+        for block in itertools.chain([first], blocks):
+            out[start : start + len(block)] = block
+            start += len(block)
+        assert start == len(names), f"{field}: {start} rows for {len(names)} names"
+        out.flush()
+        del out
+        index["fields"][field] = {"shape": list(shape), "dtype": dtype.name}
+    if normalizer is not None:
+        with open(os.path.join(tmp, NORMALIZER), "wb") as f:
+            pickle.dump(normalizer, f)
+    with open(os.path.join(tmp, INDEX), "w") as f:
+        json.dump(index, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return FeatureStore(path)
+
+
+def npy_blocks(filenames):
+    """One row per .npy file, for the per-slice `*_feats` directories."""
+    for filename in filenames:
+        yield np.load(filename)[None]
+
+
+def shard_blocks(shards):
+    """Rows of (shard path, row) pairs, read a whole shard at a time."""
+    for path, rows in itertools.groupby(shards, key=lambda shard: shard[0]):
+        shard = np.load(path, mmap_mode="r")
+        yield shard[[row for _, row in rows]]
@@ -1,4 +1,5 @@
 import glob
+import hashlib
 import os
 import re
 from pathlib import Path
@@ -42,6 +43,31 @@ class Normalizer:
         x = torch.clip(x, -1, 1)  # clip to force compatibility
         return self.scaler.inverse_transform(x).reshape((batch, seq, ch))
 
+    def state_dict(self):
+        """The fitted scaler parameters, all that is needed to (un)normalize."""
+        return {
+            "feature_range": tuple(self.scaler.feature_range),
+            "clip": self.scaler.clip,
+            "scale": self.scaler.scale_.cpu(),
+            "min": self.scaler.min_.cpu(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        normalizer = cls.__new__(cls)
+        normalizer.scaler = MinMaxScaler(tuple(state["feature_range"]), clip=state["clip"])
+        normalizer.scaler.scale_ = state["scale"].float()
+        normalizer.scaler.min_ = state["min"].float()
+        return normalizer
+
+    def fingerprint(self):
+        """Hash of the fitted parameters, equal for normalizers that normalize alike."""
+        state = self.state_dict()
+        h = hashlib.sha1(repr((state["feature_range"], state["clip"])).encode())
+        for key in ("scale", "min"):
+            h.update(state[key].double().numpy().tobytes())
+        return h.hexdigest()
+
 
 def vectorize_many(data):
     # given a list of batch x seqlen x joints? x channels, flatten all to batch x seqlen x -1, concatenate
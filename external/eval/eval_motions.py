@@ -0,0 +1,152 @@
+"""
+Evaluate directories of generated motions in one pass.
+
+Motion files are split into batches that a process pool loads, pads, runs
+FK on and scores with the vectorized metrics of eval/metrics.py (PFC, beat alignment,
+foot skate, jerk). The per-file scores and a per-directory summary are
+written as tables, CSV or parquet (needs pandas and pyarrow) by extension:
+
+    python eval/eval_motions.py --motion_path ckpt_a/motions ckpt_b/motions \\
+        --music_dir data/test/wavs --out scores.parquet
+
+writes scores.parquet and scores_summary.parquet. Beat alignment needs the
+music: a motion named `<prefix>_<song>` is matched to `<music_dir>/<song>.wav`,
+and the motion is assumed to start with the song.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+# also runnable as `python eval/eval_motions.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from eval import metrics
+from motion_format import forward_kinematics, load_motion, motion_paths
+
+METRICS = ["pfc", "beat_align", "foot_skate", "jerk_mean", "jerk_max"]
+
+
+def find_music(motion_path, music_dir):
+    """The song of a motion, trying ever shorter suffixes of its name."""
+    if music_dir is None:
+        return None
+    parts = os.path.splitext(os.path.basename(motion_path))[0].split("_")
+    for start in range(len(parts)):
+        path = os.path.join(music_dir, "_".join(parts[start:]) + ".wav")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def music_beats(path):
+    from data.audio_extraction.baseline_features import extract_beats
+
+    return path, extract_beats(path)
+
+
+def score_batch(items):
+    """Rows of scores for a batch of (source, motion path, music beats or None)."""
+    motions = [load_motion(path) for _, path, _ in items]
+    # FK once for the whole padded batch, padding repeats the last frame
+    poses, lengths = metrics.pad([motion["smpl_poses"] for motion in motions])
+    trans, _ = metrics.pad([motion["smpl_trans"] for motion in motions])
+    joints = forward_kinematics(poses, trans)
+    jerk_mean, jerk_max = metrics.jerk(joints, lengths)
+    scores = {
+        "pfc": metrics.pfc(joints, lengths),
+        "beat_align": metrics.beat_alignment(joints, lengths, [beats for _, _, beats in items]),
+        "foot_skate": metrics.foot_skate(joints, lengths),
+        "jerk_mean": jerk_mean,
+        "jerk_max": jerk_max,
+    }
+    return [
+        {
+            "source": source,
+            "file": os.path.basename(path),
+            "frames": int(length),
+            **{name: float(scores[name][row]) for name in METRICS},
+        }
+        for row, ((source, path, _), length) in enumerate(zip(items, lengths))
+    ]
+
+
+def evaluate(sources, music_dir=None, batch_size=64, workers=None):
+    """
+    Score every motion in the `sources` directories. Returns the per-file
+    rows and a summary row (count, mean and std of every metric) per source.
+    """
+    files = [(source, path) for source in sources for path in motion_paths(source)]
+    songs = {path: find_music(path, music_dir) for _, path in files}
+    workers = workers or os.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        # beats once per song, motions of the same song share them
+        unique = sorted({song for song in songs.values() if song is not None})
+        beats = dict(tqdm(pool.imap_unordered(music_beats, unique), total=len(unique), desc="beats"))
+        items = [(source, path, beats.get(songs[path])) for source, path in files]
+        batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+        rows = []
+        for batch_rows in tqdm(pool.imap(score_batch, batches), total=len(batches), desc="motions"):
+            rows.extend(batch_rows)
+    return rows, summarize(rows, sources)
+
+
+def summarize(rows, sources):
+    summary = []
+    for source in sources:
+        selected = [row for row in rows if row["source"] == source]
+        entry = {"source": source, "count": len(selected)}
+        for name in METRICS:
+            values = np.array([row[name] for row in selected], dtype=float)
+            values = values[~np.isnan(values)]
+            entry[f"{name}_mean"] = float(values.mean()) if len(values) else float("nan")
+            entry[f"{name}_std"] = float(values.std()) if len(values) else float("nan")
+        summary.append(entry)
+    return summary
+
+
+def write_table(rows, path):
+    if not rows:
+        return
+    if path.endswith(".parquet"):
+        import pandas as pd
+
+        pd.DataFrame(rows).to_parquet(path, index=False)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def summary_path(path):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_summary{ext}"
+
+
+def parse_eval_opt():
+    parser = argparse.ArgumentParser(description="Score directories of generated motions")
+    parser.add_argument(
+        "--motion_path", nargs="+", default=["motions/"],
+        help="directories of saved motions, e.g. one per checkpoint",
+    )
+    parser.add_argument("--music_dir", type=str, default=None, help="songs, for beat alignment")
+    parser.add_argument("--out", type=str, default="motion_scores.csv", help=".csv or .parquet")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=None, help="processes, all cores if unset")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_eval_opt()
+    rows, summary = evaluate(opt.motion_path, opt.music_dir, opt.batch_size, opt.workers)
+    write_table(rows, opt.out)
+    write_table(summary, summary_path(opt.out))
+    for entry in summary:
+        print(
+            f"{entry['source']}: {entry['count']} motions, "
+            + ", ".join(f"{name} {entry[f'{name}_mean']:.4f}" for name in METRICS)
+        )
@@ -1,54 +1,30 @@
 import argparse
-import glob
 import os
-import pickle
+import random
+import sys
 
 import numpy as np
 from tqdm import tqdm
 
+# also runnable as `python eval/eval_pfc.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from eval import metrics
+from motion_format import load_motion, motion_paths
 
-def calc_physical_score(dir):
-    scores = []
-    names = []
-    accelerations = []
-    up_dir = 2  # z is up
-    flat_dirs = [i for i in range(3) if i != up_dir]
-    DT = 1 / 30
 
-    it = glob.glob(os.path.join(dir, "*.pkl"))
+def calc_physical_score(dir, batch_size=64):
+    """Mean PFC of (up to 1000 of) the motions in `dir`, see eval_motions.py for the full set of metrics."""
+    it = motion_paths(dir)
     if len(it) > 1000:
         it = random.sample(it, 1000)
-    for pkl in tqdm(it):
-        info = pickle.load(open(pkl, "rb"))
-        joint3d = info["full_pose"]
-        root_v = (joint3d[1:, 0, :] - joint3d[:-1, 0, :]) / DT  # root velocity (S-1, 3)
-        root_a = (root_v[1:] - root_v[:-1]) / DT  # (S-2, 3) root accelerations
-        # clamp the up-direction of root acceleration
-        root_a[:, up_dir] = np.maximum(root_a[:, up_dir], 0)  # (S-2, 3)
-        # l2 norm
-        root_a = np.linalg.norm(root_a, axis=-1)  # (S-2,)
-        scaling = root_a.max()
-        root_a /= scaling
-
-        foot_idx = [7, 10, 8, 11]
-        feet = joint3d[:, foot_idx]  # foot positions (S, 4, 3)
-        foot_v = np.linalg.norm(
-            feet[2:, :, flat_dirs] - feet[1:-1, :, flat_dirs], axis=-1
-        )  # (S-2, 4) horizontal velocity
-        foot_mins = np.zeros((len(foot_v), 2))
-        foot_mins[:, 0] = np.minimum(foot_v[:, 0], foot_v[:, 1])
-        foot_mins[:, 1] = np.minimum(foot_v[:, 2], foot_v[:, 3])
-
-        foot_loss = (
-            foot_mins[:, 0] * foot_mins[:, 1] * root_a
-        )  # min leftv * min rightv * root_a (S-2,)
-        foot_loss = foot_loss.mean()
-        scores.append(foot_loss)
-        names.append(pkl)
-        accelerations.append(foot_mins[:, 0].mean())
+    scores = []
+    for start in tqdm(range(0, len(it), batch_size)):
+        motions = [load_motion(path, joints=True)["full_pose"] for path in it[start : start + batch_size]]
+        scores.append(metrics.pfc(*metrics.pad(motions)))
 
-    out = np.mean(scores) * 10000
+    out = np.mean(np.concatenate(scores))
     print(f"{dir} has a mean PFC of {out}")
+    return out
 
 
 def parse_eval_opt():
@@ -0,0 +1,116 @@
+"""
+Motion quality metrics, vectorized over a batch of motions.
+
+Every function takes joint positions padded to a common length,
+`joints` (B x S x 24 x 3, z up, meters, 30 fps), and the true number of
+frames of each motion, `lengths` (B,), and returns one value per motion.
+"""
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+FPS = 30
+UP = 2  # z is up
+FLAT = [i for i in range(3) if i != UP]
+FOOT_JOINTS = [7, 10, 8, 11]  # left ankle, left toes, right ankle, right toes
+
+
+def pad(motions):
+    """Stack joint position arrays of different lengths, returns (joints, lengths)."""
+    lengths = np.array([len(motion) for motion in motions])
+    joints = np.zeros((len(motions), lengths.max(), *motions[0].shape[1:]), dtype=np.float32)
+    for row, motion in enumerate(motions):
+        joints[row, : len(motion)] = motion
+        # repeat the last frame, so differences over the padding are zero
+        joints[row, len(motion) :] = motion[-1]
+    return joints, lengths
+
+
+def frame_mask(lengths, frames):
+    """(B x frames) mask of the valid entries of a sequence cut `S - frames` short."""
+    return np.arange(frames)[None] < (lengths[:, None] - (lengths.max() - frames))
+
+
+def masked_mean(values, mask):
+    return (values * mask).sum(1) / np.maximum(mask.sum(1), 1)
+
+
+def pfc(joints, lengths):
+    """
+    Physical foot contact score of every motion, as in eval_pfc: the root
+    acceleration (upwards clamped to positive, normalized by its max)
+    weighted by the slowest horizontal foot speed of each foot. x10000 so
+    the mean over motions is the PFC reported by eval_pfc.
+    """
+    dt = 1 / FPS
+    root_v = (joints[:, 1:, 0] - joints[:, :-1, 0]) / dt
+    root_a = (root_v[:, 1:] - root_v[:, :-1]) / dt  # B x S-2 x 3
+    root_a[..., UP] = np.maximum(root_a[..., UP], 0)
+    root_a = np.linalg.norm(root_a, axis=-1)
+    mask = frame_mask(lengths, root_a.shape[1])
+    root_a /= np.maximum((root_a * mask).max(1, keepdims=True), 1e-12)
+
+    feet = joints[:, :, FOOT_JOINTS][..., FLAT]
+    foot_v = np.linalg.norm(feet[:, 2:] - feet[:, 1:-1], axis=-1)  # B x S-2 x 4
+    left = np.minimum(foot_v[..., 0], foot_v[..., 1])
+    right = np.minimum(foot_v[..., 2], foot_v[..., 3])
+    return masked_mean(left * right * root_a, mask) * 10000
+
+
+def foot_skate(joints, lengths, height=0.05):
+    """
+    Mean horizontal speed (m/s) of the foot joints while they touch the
+    ground, i.e. are within `height` of the lowest foot position of the motion.
+    """
+    feet = joints[:, :, FOOT_JOINTS]
+    speed = np.linalg.norm(feet[:, 1:, :, FLAT] - feet[:, :-1, :, FLAT], axis=-1) * FPS
+    mask = frame_mask(lengths, speed.shape[1])[..., None]
+    valid = frame_mask(lengths, feet.shape[1])[..., None]
+    floor = np.where(valid, feet[..., UP], np.inf).min(axis=(1, 2))
+    # a foot is in contact over a step if it is on the ground at both ends
+    ground = feet[..., UP] < floor[:, None, None] + height
+    contact = ground[:, 1:] & ground[:, :-1] & mask
+    return (speed * contact).sum((1, 2)) / np.maximum(contact.sum((1, 2)), 1)
+
+
+def jerk(joints, lengths):
+    """Mean and max over frames of the mean joint jerk (m/s^3)."""
+    third = np.diff(joints, n=3, axis=1) * FPS ** 3
+    magnitude = np.linalg.norm(third, axis=-1).mean(-1)  # B x S-3
+    mask = frame_mask(lengths, magnitude.shape[1])
+    return masked_mean(magnitude, mask), np.where(mask, magnitude, 0).max(1)
+
+
+def motion_beats(joints, lengths, sigma=5):
+    """
+    Kinematic beats of every motion: local minima of the smoothed mean joint
+    speed, as in the beat alignment score of Bailando.
+    """
+    speed = np.linalg.norm(joints[:, 1:] - joints[:, :-1], axis=-1).mean(-1)
+    valid = frame_mask(lengths, speed.shape[1])
+    # extend every row past its end with its last speed, so the filter sees
+    # the same ("nearest") boundary as for the motion on its own
+    last = speed[np.arange(len(speed)), np.maximum(lengths - 2, 0)]
+    speed = np.where(valid, speed, last[:, None])
+    speed = gaussian_filter1d(speed, sigma, axis=1, mode="nearest")
+    minima = (speed[:, 1:-1] < speed[:, :-2]) & (speed[:, 1:-1] < speed[:, 2:])
+    minima &= valid[:, 1:-1]
+    # the speed between frames i and i + 1 is attributed to frame i + 1
+    return [np.flatnonzero(row) + 2 for row in minima]
+
+
+def beat_alignment(joints, lengths, music_beats, sigma=3):
+    """
+    Beat alignment score: for every music beat, a Gaussian of the distance
+    in frames to the nearest kinematic beat, averaged. `music_beats` holds a
+    beat frame array per motion, None where the music is unknown (NaN score).
+    """
+    scores = np.full(len(joints), np.nan)
+    for row, (beats, music) in enumerate(zip(motion_beats(joints, lengths), music_beats)):
+        if music is None or len(beats) == 0:
+            continue
+        music = music[music < lengths[row]]
+        if len(music) == 0:
+            continue
+        distance = np.abs(music[:, None] - beats[None]).min(1)
+        scores[row] = np.exp(-(distance ** 2) / (2 * sigma ** 2)).mean()
+    return scores
@@ -0,0 +1,34 @@
+"""
+Export the slim inference artifact of a training checkpoint: only the EMA
+weights and the normalizer's scaler parameters, loaded memory-mapped by
+EDGE.from_inference_checkpoint (and picked up by model_registry when it sits
+next to the checkpoint).
+
+    python export_checkpoint.py --checkpoint checkpoint.pt --dtype float16
+"""
+import argparse
+import os
+
+import torch
+
+from EDGE import export_inference_checkpoint
+
+DTYPES = {"float32": None, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default="checkpoint.pt")
+    parser.add_argument(
+        "--out", type=str, default=None,
+        help="artifact path, <checkpoint>.inference.pt if unset",
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=sorted(DTYPES),
+        help="dtype the weights are stored in, they are cast back to float32 on load",
+    )
+    opt = parser.parse_args()
+    out = export_inference_checkpoint(opt.checkpoint, opt.out, DTYPES[opt.dtype])
+    print(
+        f"Wrote {out} ({os.path.getsize(out) / 2 ** 20:.1f} MB, "
+        f"checkpoint was {os.path.getsize(opt.checkpoint) / 2 ** 20:.1f} MB)"
+    )
@@ -0,0 +1,248 @@
+"""
+Skeleton video rendering without matplotlib.
+
+The 24 joints are projected with NumPy, the bones are rasterized into
+preallocated RGB frame buffers, and the frames are piped as raw video into a
+single ffmpeg process, which also muxes in the audio. Rasterization can be
+split across worker processes in chunks of frames (see `configure`).
+"""
+import multiprocessing
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+
+from vis import smpl_parents
+
+_config = {"workers": 1}
+_pool = None
+_pool_lock = threading.Lock()
+
+# matplotlib's default color cycle, matching the line colors of the
+# matplotlib renderer (one line per joint, in joint order)
+BONE_COLORS = np.array(
+    [
+        [31, 119, 180],
+        [255, 127, 14],
+        [44, 160, 44],
+        [214, 39, 40],
+        [148, 103, 189],
+        [140, 86, 75],
+        [227, 119, 194],
+        [127, 127, 127],
+        [188, 189, 34],
+        [23, 190, 207],
+    ],
+    dtype=np.uint8,
+)
+FLOOR_COLOR = np.array([226, 217, 226], dtype=np.uint8)
+CONTACT_COLOR = np.array([214, 39, 40], dtype=np.uint8)  # foot on the ground
+SWING_COLOR = np.array([44, 160, 44], dtype=np.uint8)  # foot in the air
+FOOT_JOINTS = [7, 8, 10, 11]
+
+_bones = np.array([(i, p) for i, p in enumerate(smpl_parents) if p != -1])
+_bone_colors = BONE_COLORS[_bones[:, 0] % len(BONE_COLORS)]
+# same scene as the matplotlib renderer: a 3 m cube centered at z = 2.5 with
+# the floor at z = 1, seen from matplotlib's default elevation and azimuth
+CENTER = np.array([0.0, 0.0, 2.5])
+AXRANGE = 3.0
+FLOOR_Z = 1.0
+ELEV, AZIM = 30, -60
+
+
+def _disk(radius):
+    dy, dx = np.mgrid[-radius : radius + 1, -radius : radius + 1]
+    keep = dx ** 2 + dy ** 2 <= radius ** 2 + radius
+    return np.stack((dy[keep], dx[keep]), axis=-1)
+
+
+def project(points, size, elev=ELEV, azim=AZIM):
+    """Orthographic projection of (..., 3) world points to (..., 2) (row, col) pixel coordinates."""
+    width, height = size
+    elev, azim = np.radians(elev), np.radians(azim)
+    right = np.array([-np.sin(azim), np.cos(azim), 0.0])
+    up = np.array(
+        [-np.sin(elev) * np.cos(azim), -np.sin(elev) * np.sin(azim), np.cos(elev)]
+    )
+    # the cube's projected diagonal is at most sqrt(3) ranges across
+    scale = min(width, height) / (AXRANGE * np.sqrt(3))
+    rel = points - CENTER
+    col = width / 2 + scale * rel @ right
+    row = height / 2 - scale * rel @ up
+    return np.stack((row, col), axis=-1)
+
+
+def background(size):
+    """White frame with the floor quad filled in."""
+    width, height = size
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    half = AXRANGE / 2
+    corners = np.array(
+        [[-half, -half], [half, -half], [half, half], [-half, half]], dtype=float
+    )
+    corners = project(
+        np.concatenate([corners, np.full((4, 1), FLOOR_Z)], axis=1), size
+    )
+    rows, cols = np.mgrid[0:height, 0:width]
+    pixels = np.stack((rows, cols), axis=-1).astype(float)
+    # inside a convex polygon: on the same side of every edge
+    edges = np.roll(corners, -1, axis=0) - corners
+    rel = pixels[:, :, None] - corners
+    cross = edges[:, 0] * rel[..., 1] - edges[:, 1] * rel[..., 0]
+    inside = np.all(cross >= 0, axis=-1) | np.all(cross <= 0, axis=-1)
+    frame[inside] = FLOOR_COLOR
+    return frame
+
+
+_backgrounds = {}
+
+
+def rasterize(pixels, contact, size, thickness=1, foot_radius=3):
+    """
+    Draw F frames of projected joints, pixels is (F, 24, 2) and contact is
+    (F, 4) booleans for the feet, returns (F, H, W, 3) uint8 frames.
+    """
+    width, height = size
+    if size not in _backgrounds:
+        _backgrounds[size] = background(size)
+    frames = np.empty((len(pixels), height, width, 3), dtype=np.uint8)
+    frames[:] = _backgrounds[size]
+    frame_idx = np.arange(len(pixels))
+
+    # bones: sample each segment once per pixel of its length, then stamp a disk
+    start, end = pixels[:, _bones[:, 0]], pixels[:, _bones[:, 1]]
+    steps = int(np.ceil(np.abs(end - start).max(initial=0))) + 1
+    t = np.linspace(0, 1, steps)[None, None, :, None]
+    points = start[:, :, None] + t * (end - start)[:, :, None]  # F x B x S x 2
+    points = np.rint(points).astype(np.int64)[:, :, :, None] + _disk(thickness)
+    f = np.broadcast_to(frame_idx[:, None, None, None], points.shape[:-1])
+    color = np.broadcast_to(_bone_colors[None, :, None, None], (*points.shape[:-1], 3))
+    _draw(frames, f, points, color)
+
+    # feet, colored by contact state
+    feet = np.rint(pixels[:, FOOT_JOINTS]).astype(np.int64)[:, :, None] + _disk(foot_radius)
+    f = np.broadcast_to(frame_idx[:, None, None], feet.shape[:-1])
+    color = np.where(contact[:, :, None, None], CONTACT_COLOR, SWING_COLOR)
+    color = np.broadcast_to(color, (*feet.shape[:-1], 3))
+    _draw(frames, f, feet, color)
+    return frames
+
+
+def _draw(frames, f, points, color):
+    _, height, width, _ = frames.shape
+    rows, cols = points[..., 0], points[..., 1]
+    visible = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    frames[f[visible], rows[visible], cols[visible]] = color[visible]
+
+
+def _rasterize_chunk(args):
+    return rasterize(*args).tobytes()
+
+
+def contact_labels(poses, contact=None, threshold=0.95):
+    """Per-frame foot contact for joints 7, 8, 10, 11, predicted if given, else from foot velocity."""
+    if contact is not None:
+        return contact > threshold
+    feet = poses[:, FOOT_JOINTS]
+    feetv = np.zeros(feet.shape[:2])
+    feetv[:-1] = np.linalg.norm(feet[1:] - feet[:-1], axis=-1)
+    return feetv < 0.01
+
+
+def configure(workers=None):
+    """Set the number of rasterizer processes renders use when not given `workers`."""
+    if workers is not None:
+        _config["workers"] = workers
+
+
+def _shared_pool(workers):
+    # one pool per process, created on first use and shared by all renders;
+    # spawned rather than forked, forking a multithreaded server can deadlock
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.get_context("spawn").Pool(workers)
+        return _pool
+
+
+def ffmpeg_command(outname, size, fps, audio=None, audio_offset=0.0):
+    width, height = size
+    cmd = [
+        "ffmpeg", "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps),
+        "-i", "-",
+    ]
+    if audio is not None:
+        if audio_offset:
+            cmd += ["-ss", f"{audio_offset:.6f}"]
+        cmd += ["-i", audio, "-shortest", "-c:a", "aac", "-q:a", "4"]
+    if outname.endswith(".gif"):
+        cmd += ["-loop", "0"]
+    else:
+        cmd += ["-c:v", "libx264", "-crf", "26", "-pix_fmt", "yuv420p"]
+    return cmd + [outname]
+
+
+def render_video(
+    poses,
+    outname,
+    audio=None,
+    contact=None,
+    audio_offset=0.0,
+    fps=30,
+    size=(640, 480),
+    workers=None,
+    chunk_size=64,
+):
+    """
+    Render (frames, 24, 3) joint positions to `outname` (.mp4, or .gif without
+    audio), muxing in `audio` from `audio_offset` seconds on if given. Frames
+    are rasterized in chunks of `chunk_size`, in this process or, with more
+    than one `workers` (default set by `configure`, 1), on a pool of worker
+    processes shared by all renders, sized by the first render that uses it.
+    """
+    poses = np.asarray(poses)
+    contact = contact_labels(poses, contact)
+    pixels = project(poses, size)
+    chunks = [
+        (pixels[i : i + chunk_size], contact[i : i + chunk_size], size)
+        for i in range(0, len(poses), chunk_size)
+    ]
+    if workers is None:
+        workers = _config["workers"]
+    # daemonic processes (e.g. p_map workers) cannot start a pool of their own
+    if multiprocessing.current_process().daemon:
+        workers = 1
+
+    # ffmpeg's errors go to a file, a pipe could fill up while the frames are written
+    with tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(
+            ffmpeg_command(outname, size, fps, audio, audio_offset),
+            stdin=subprocess.PIPE,
+            stderr=errors,
+        )
+        broken = False
+        try:
+            if workers > 1 and len(chunks) > 1:
+                for frames in _shared_pool(workers).imap(_rasterize_chunk, chunks):
+                    proc.stdin.write(frames)
+            else:
+                for chunk in chunks:
+                    proc.stdin.write(_rasterize_chunk(chunk))
+        except BrokenPipeError:
+            # ffmpeg exited early, its error output says why
+            broken = True
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+        if returncode != 0 or broken:
+            errors.seek(0)
+            message = errors.read().decode(errors="replace").strip()
+            raise RuntimeError(
+                f"ffmpeg exited with code {returncode} while writing {outname}: {message}"
+            )
+    return outname
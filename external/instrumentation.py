@@ -0,0 +1,228 @@
+"""
+Lightweight per-stage timing for the generation pipeline.
+
+Code marks its stages with `with stage("features"):` and times loop
+iterations with a `StepTimer("denoise", total)`. Every stage duration goes into a
+process-wide latency histogram (see `snapshot`). Additionally, every Trace
+made active on the current thread with `use_traces` records the stage and is
+told about progress, so a server can show real per-job progress and where
+the time of a request went. Stages run with no active trace only feed the
+histograms.
+"""
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import torch
+except ImportError:  # the server can report metrics without the model stack
+    torch = None
+
+# latency histogram bucket upper bounds, in seconds
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")]
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if self.count == 0:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "max": round(self.max, 4),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                ("+Inf" if bound == float("inf") else str(bound)): count
+                for bound, count in zip(self.buckets, self.counts)
+            },
+        }
+
+
+def observe(name, seconds):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(seconds)
+
+
+def snapshot():
+    """Aggregated latency histograms of all stages recorded in this process."""
+    with _lock:
+        return {name: hist.to_dict() for name, hist in sorted(_histograms.items())}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def peak_rss_mb():
+    # the high-water mark of the whole process, ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb():
+    """Current resident set size of the process, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() / 2 ** 20
+
+
+def memory_mb(cuda):
+    return {"rss": rss_mb(), "cuda": torch.cuda.memory_allocated() / 2 ** 20 if cuda else None}
+
+
+class Trace:
+    """
+    Stage timings of one job. `on_progress(stage, done, total)` is called when
+    a stage starts (0 of 1) and ends (1 of 1), and for every `step`.
+
+    Every stage also records the resident (and CUDA allocated) memory of the
+    process when it ended and how much that changed over the stage. These
+    are process-wide, so with concurrent jobs they include the others' use.
+    """
+
+    def __init__(self, name=None, on_progress=None):
+        self.name = name
+        self.on_progress = on_progress
+        self.stages = []
+        self.created = time.time()
+        # stage -> (index, count) while it runs as one of several parts, see progress_part
+        self.parts = {}
+
+    def progress(self, stage, done, total):
+        if stage in self.parts:
+            index, count = self.parts[stage]
+            done, total = index * total + done, count * total
+        if self.on_progress is not None:
+            try:
+                self.on_progress(stage, done, total)
+            except Exception as e:
+                print(f"Progress callback failed: {e}")
+
+    def record(self, name, seconds, **info):
+        self.stages.append({"stage": name, "seconds": round(seconds, 4), **info})
+
+    def summary(self):
+        totals = {}
+        for entry in self.stages:
+            totals[entry["stage"]] = totals.get(entry["stage"], 0) + entry["seconds"]
+        return {
+            "stages": self.stages,
+            "totals": {name: round(seconds, 4) for name, seconds in totals.items()},
+        }
+
+
+def current_traces():
+    return getattr(_local, "traces", ())
+
+
+@contextmanager
+def use_traces(*traces):
+    """Make `traces` receive the stages and progress reported on this thread."""
+    previous = current_traces()
+    _local.traces = previous + tuple(t for t in traces if t not in previous)
+    try:
+        yield
+    finally:
+        _local.traces = previous
+
+
+@contextmanager
+def progress_part(name, index, count):
+    """
+    Report the progress of stage `name` within this block as part `index` of
+    `count`, e.g. the denoising of one chunk of a song's windows, so the
+    job's progress runs once over all parts instead of once per part.
+    """
+    traces = current_traces()
+    for trace in traces:
+        trace.parts[name] = (index, count)
+    try:
+        yield
+    finally:
+        for trace in traces:
+            trace.parts.pop(name, None)
+
+
+@contextmanager
+def stage(name):
+    traces = current_traces()
+    for trace in traces:
+        trace.progress(name, 0, 1)
+    cuda = torch is not None and torch.cuda.is_available()
+    # current usage rather than peaks: the peak counters are process-wide, so
+    # nested stages and other threads would reset and share them
+    before = memory_mb(cuda)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe(name, seconds)
+        info = {}
+        for key, value in memory_mb(cuda).items():
+            if value is not None:
+                info[f"{key}_mb"] = round(value, 1)
+                if before[key] is not None:
+                    info[f"{key}_delta_mb"] = round(value - before[key], 1)
+        for trace in traces:
+            trace.record(name, seconds, **info)
+            trace.progress(name, 1, 1)
+
+
+class StepTimer:
+    """
+    Times the iterations of a loop (e.g. denoising steps): each call to `step`
+    closes the previous iteration, which goes into the `<name>_step` histogram,
+    and reports `done` of `total` to the active traces.
+    """
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.traces = current_traces()
+        self.last = time.perf_counter()
+
+    def step(self, done):
+        now = time.perf_counter()
+        observe(f"{self.name}_step", now - self.last)
+        self.last = now
+        for trace in self.traces:
+            trace.progress(self.name, done, self.total)
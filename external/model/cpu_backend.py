@@ -0,0 +1,164 @@
+"""
+Opt-in CPU inference path for DanceDecoder.
+
+`prepare_cpu_inference` rewrites an eval-only decoder in place:
+- the rotary cos / sin tables are precomputed for the fixed horizon,
+- nn.MultiheadAttention is replaced by an equivalent module with separate
+  q / k / v nn.Linear projections (the stock module keeps them in one raw
+  parameter that dynamic quantization cannot reach) and fused attention,
+- the nn.Linear layers of the decoder stack get dynamic int8 quantization
+  with per-channel weight scales,
+- optionally, forward is captured with torch.compile, falling back to eager
+  if compilation is not possible on the host.
+
+Only the decoder stack is quantized: it runs on every frame token at every
+denoising step and holds almost all of the time, while the music encoder
+runs once per generation (cond_projection alone, 4800 -> 512, is by far the
+most error-prone layer) and the time MLP / FiLM layers see one row per
+sample. torch.compile does not fuse the quantized ops and was slower than
+the quantized model alone in our measurements, so it is off by default.
+
+`parity_check` measures how far the result moves from the float model, as
+joint positions after FK, so the speedup can be trusted.
+"""
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class FastAttention(nn.Module):
+    """Drop-in for a batch_first nn.MultiheadAttention at inference, without attention masks."""
+
+    def __init__(self, attn):
+        super().__init__()
+        assert attn.batch_first and attn._qkv_same_embed_dim
+        dim = attn.embed_dim
+        self.num_heads = attn.num_heads
+        weights = attn.in_proj_weight.detach().chunk(3)
+        biases = attn.in_proj_bias.detach().chunk(3)
+        self.q_proj, self.k_proj, self.v_proj = (
+            _linear(weight, bias) for weight, bias in zip(weights, biases)
+        )
+        self.out_proj = _linear(attn.out_proj.weight.detach(), attn.out_proj.bias.detach())
+        self.embed_dim = dim
+
+    def forward(self, query, key, value, attn_mask=None, key_padding_mask=None, need_weights=False):
+        assert attn_mask is None and key_padding_mask is None and not need_weights
+        batch, length, _ = query.shape
+        q = self._heads(self.q_proj(query))
+        k = self._heads(self.k_proj(key))
+        v = self._heads(self.v_proj(value))
+        out = F.scaled_dot_product_attention(q, k, v)
+        out = out.transpose(1, 2).reshape(batch, length, self.embed_dim)
+        return self.out_proj(out), None
+
+    def _heads(self, x):
+        batch, length, _ = x.shape
+        return x.view(batch, length, self.num_heads, -1).transpose(1, 2)
+
+
+def _linear(weight, bias):
+    linear = nn.Linear(weight.shape[1], weight.shape[0], device="meta")
+    linear.weight = nn.Parameter(weight.clone())
+    linear.bias = nn.Parameter(bias.clone())
+    return linear
+
+
+def quantize(decoder):
+    """
+    Dynamic int8 quantization of the nn.Linear layers in the decoder stack
+    (weights int8 per output channel, activations quantized per call).
+    """
+    try:
+        from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+    except ImportError:
+        warnings.warn("torch.ao.quantization is not available, DanceDecoder stays in float")
+        return decoder
+    spec = {
+        name: per_channel_dynamic_qconfig
+        for name, module in decoder.named_modules()
+        if name.startswith("seqTransDecoder.")
+        and ".film" not in name
+        and isinstance(module, nn.Linear)
+    }
+    with warnings.catch_warnings():
+        # eager-mode quantization is deprecated in recent torch releases, but still works
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        return quantize_dynamic(decoder, spec, dtype=torch.qint8, inplace=True)
+
+
+def compile_forward(decoder):
+    """
+    Route `decoder.forward` (which guided_forward calls) through torch.compile.
+    If compiling fails on the first call the eager forward is used from then on.
+    """
+    eager = decoder.forward
+    compiled = torch.compile(eager)
+
+    def forward(*args, **kwargs):
+        nonlocal compiled
+        if compiled is not None:
+            try:
+                return compiled(*args, **kwargs)
+            except Exception as e:
+                warnings.warn(f"torch.compile failed, running DanceDecoder eagerly: {e}")
+                compiled = None
+        return eager(*args, **kwargs)
+
+    decoder.forward = forward
+    return decoder
+
+
+def prepare_cpu_inference(decoder, seq_len=150, quantized=True, compiled=False):
+    """Rewrite an eval-only DanceDecoder for CPU inference, in place, see the module docstring."""
+    decoder.eval()
+    if decoder.rotary is not None:
+        # self-attention runs over seq_len frames / music tokens, cross
+        # attention over the music tokens plus the two time tokens
+        for length in (seq_len, seq_len + 2):
+            decoder.rotary.precompute(length)
+    for module in list(decoder.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.MultiheadAttention):
+                setattr(module, name, FastAttention(child))
+    if quantized:
+        decoder = quantize(decoder)
+    if compiled:
+        decoder = compile_forward(decoder)
+    return decoder
+
+
+@torch.no_grad()
+def parity_check(reference, candidate, diffusion, normalizer, batch=4, timesteps=(999, 500, 100, 10), seed=0):
+    """
+    Predict x0 with both decoders for the same random inputs at several
+    noise levels and compare the joint positions after FK. Returns the max
+    and mean joint position error (in meters) and the max difference of the
+    normalized outputs.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    seq_len, nfeats = reference.null_cond_embed.shape[1], reference.input_projection.in_features
+    feature_dim = reference.cond_projection.in_features
+    x = torch.randn(batch, seq_len, nfeats, generator=generator)
+    cond = torch.randn(batch, seq_len, feature_dim, generator=generator)
+    max_error, errors, max_output = 0.0, [], 0.0
+    for t in timesteps:
+        times = torch.full((batch,), t, dtype=torch.long)
+        outputs, joints = [], []
+        for decoder in (reference, candidate):
+            out = decoder.guided_forward(x, cond, times, diffusion.guidance_weight).clamp(-1, 1)
+            pos, q, _ = diffusion.unpack_samples(out.clone(), normalizer, "cpu")
+            outputs.append(out)
+            joints.append(diffusion.smpl.forward(q, pos))
+        error = (joints[0] - joints[1]).norm(dim=-1)
+        max_error = max(max_error, error.max().item())
+        errors.append(error.mean().item())
+        max_output = max(max_output, (outputs[0] - outputs[1]).abs().max().item())
+    return {
+        "max_joint_error": max_error,
+        "mean_joint_error": sum(errors) / len(errors),
+        "max_output_error": max_output,
+    }
@@ -1,6 +1,5 @@
 import copy
 import os
-import pickle
 from pathlib import Path
 from functools import partial
 
@@ -15,8 +14,12 @@ from pytorch3d.transforms import (axis_angle_to_quaternion,
 from tqdm import tqdm
 
 from dataset.quaternion import ax_from_6v, quat_slerp
+from instrumentation import stage
+from motion_format import EXTENSION as MOTION_EXTENSION
+from motion_format import write_motion
 from vis import skeleton_render
 
+from .samplers import DDIMSampler, sample_in_chunks
 from .utils import extract, make_beta_schedule
 
 def identity(t, *args, **kwargs):
@@ -40,6 +43,55 @@ class EMA:
         return old * self.beta + (1 - self.beta) * new
 
 
+class LongFormStitcher:
+    """
+    Stitches windows that each overlap the previous one by half into one
+    sequence, incrementally: root positions are cross-faded linearly and
+    joint rotations slerped over every overlap. `push` takes the next
+    windows (b x s x 3 positions, b x s x 24 x 3 axis-angle rotations) and
+    returns the frames that are final so far, `finish` the remaining ones.
+    """
+
+    def __init__(self):
+        self.last = None
+
+    def push(self, pos, q):
+        s = pos.shape[1]
+        assert s % 2 == 0
+        half = s // 2
+        out_pos, out_q = [], []
+        if self.last is None:
+            out_pos.append(pos[0, :half])
+            out_q.append(q[0, :half])
+        else:
+            pos = torch.cat((self.last[0][None], pos))
+            q = torch.cat((self.last[1][None], q))
+        if len(pos) > 1:
+            # stitch position using linear interp
+            fade = torch.linspace(0, 1, half, device=pos.device)[None, :, None]
+            merged_pos = pos[:-1, half:] * (1 - fade) + pos[1:, :half] * fade
+            out_pos.append(merged_pos.reshape(-1, pos.shape[-1]))
+
+            # stitch joint angles with slerp
+            left, right = q[:-1, half:], q[1:, :half]
+            # convert to quat
+            left, right = (
+                axis_angle_to_quaternion(left),
+                axis_angle_to_quaternion(right),
+            )
+            merged = quat_slerp(left, right, fade)  # (b-1) x half x ...
+            # convert back
+            merged = quaternion_to_axis_angle(merged)
+            out_q.append(merged.reshape(-1, *q.shape[2:]))
+        self.last = (pos[-1], q[-1])
+        return torch.cat(out_pos), torch.cat(out_q)
+
+    def finish(self):
+        pos, q = self.last
+        half = pos.shape[0] // 2
+        return pos[half:], q[half:]
+
+
 class GaussianDiffusion(nn.Module):
     def __init__(
         self,
@@ -229,7 +281,8 @@ class GaussianDiffusion(nn.Module):
         start_point = self.n_timestep if start_point is None else start_point
         batch_size = shape[0]
         x = torch.randn(shape, device=device) if noise is None else noise.to(device)
-        cond = cond.to(device)
+        # the music encoding does not change between steps, encode it once
+        cond = self.model.encode_cond(cond.to(device))
 
         if return_diffusion:
             diffusion = [x]
@@ -248,84 +301,39 @@ class GaussianDiffusion(nn.Module):
             return x
         
     @torch.no_grad()
-    def ddim_sample(self, shape, cond, **kwargs):
-        batch, device, total_timesteps, sampling_timesteps, eta = shape[0], self.betas.device, self.n_timestep, 50, 1
-
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
-
-        x = torch.randn(shape, device = device)
-        cond = cond.to(device)
-
-        x_start = None
-
-        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
-            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
-            pred_noise, x_start, *_ = self.model_predictions(x, cond, time_cond, clip_x_start = self.clip_denoised)
-
-            if time_next < 0:
-                x = x_start
-                continue
-
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
-
-            noise = torch.randn_like(x)
+    def ddim_sample(self, shape, cond, sampler=None, noise=None, **kwargs):
+        """
+            sampler : a model.samplers.Sampler, defaults to 50 step DDIM with eta = 1
+        """
+        sampler = sampler if sampler is not None else DDIMSampler()
+        return sampler.sample(self, shape, cond, noise=noise)
 
-            x = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
-        return x
-    
     @torch.no_grad()
-    def long_ddim_sample(self, shape, cond, **kwargs):
-        batch, device, total_timesteps, sampling_timesteps, eta = shape[0], self.betas.device, self.n_timestep, 50, 1
-        
-        if batch == 1:
-            return self.ddim_sample(shape, cond)
-
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        weights = np.clip(np.linspace(0, self.guidance_weight * 2, sampling_timesteps), None, self.guidance_weight)
-        time_pairs = list(zip(times[:-1], times[1:], weights)) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
-
-        x = torch.randn(shape, device = device)
-        cond = cond.to(device)
-        
-        assert batch > 1
-        assert x.shape[1] % 2 == 0
-        half = x.shape[1] // 2
-
-        x_start = None
-
-        for time, time_next, weight in tqdm(time_pairs, desc = 'sampling loop time step'):
-            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
-            pred_noise, x_start, *_ = self.model_predictions(x, cond, time_cond, weight=weight, clip_x_start = self.clip_denoised) 
-
-            if time_next < 0:
-                x = x_start
-                continue
-
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
-
-            noise = torch.randn_like(x)
-
-            x = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
-            
-            if time > 0:
-                # the first half of each sequence is the second half of the previous one
-                x[1:, :half] = x[:-1, half:]
-        return x
+    def long_ddim_sample(
+        self, shape, cond, segments=None, sampler=None, noise=None, prefixes=None, **kwargs
+    ):
+        """
+            segments : [ (start, stop), ... ] row ranges of independent songs
+            packed into one batch; overlap stitching never crosses a segment
+            boundary. Defaults to a single song spanning the whole batch.
+            Given segments, every row is sampled the same way however many
+            rows the batch holds, so a batched job does not depend on the others.
+            prefixes : { row : clean motion } to inpaint into the first frames
+            of these rows, e.g. the end of the previously sampled chunk
+        """
+        batch = shape[0]
+        if batch == 1 and not prefixes and segments is None:
+            return self.ddim_sample(shape, cond, sampler=sampler, noise=noise)
+
+        sampler = sampler if sampler is not None else DDIMSampler()
+        return sampler.sample(
+            self,
+            shape,
+            cond,
+            segments=segments or [(0, batch)],
+            noise=noise,
+            prefixes=prefixes,
+        )
 
     @torch.no_grad()
     def inpaint_loop(
@@ -341,7 +349,8 @@ class GaussianDiffusion(nn.Module):
 
         batch_size = shape[0]
         x = torch.randn(shape, device=device) if noise is None else noise.to(device)
-        cond = cond.to(device)
+        # the music encoding does not change between steps, encode it once
+        cond = self.model.encode_cond(cond.to(device))
         if return_diffusion:
             diffusion = [x]
 
@@ -381,7 +390,6 @@ class GaussianDiffusion(nn.Module):
 
         batch_size = shape[0]
         x = torch.randn(shape, device=device) if noise is None else noise.to(device)
-        cond = cond.to(device)
         if return_diffusion:
             diffusion = [x]
 
@@ -398,6 +406,8 @@ class GaussianDiffusion(nn.Module):
             )
         assert batch_size > 1
         half = x.shape[1] // 2
+        # the music encoding does not change between steps, encode it once
+        cond = self.model.encode_cond(cond.to(device))
 
         start_point = self.n_timestep if start_point is None else start_point
         for i in tqdm(reversed(range(0, start_point))):
@@ -539,6 +549,39 @@ class GaussianDiffusion(nn.Module):
         t = torch.full((batch_size,), timestep, device=x.device).long()
         return self.q_sample(x, t) if timestep > 0 else x
 
+    def long_ddim_sample_chunked(self, shape, cond, chunk_size, sampler=None):
+        """
+            Like long_ddim_sample, but denoises at most `chunk_size` windows
+            at a time, each chunk inpainted to continue the previous one.
+            Yields the (cpu) samples chunk by chunk.
+        """
+        def sample_chunk(cond_chunk, prefix):
+            return self.long_ddim_sample(
+                (len(cond_chunk), *shape[1:]),
+                cond_chunk,
+                sampler=sampler,
+                prefixes={0: prefix} if prefix is not None else None,
+            ).detach().cpu()
+
+        return sample_in_chunks(sample_chunk, cond, chunk_size)
+
+    def unpack_samples(self, samples, normalizer, device):
+        """Normalized samples to root positions, axis-angle joint rotations and contact labels."""
+        samples = normalizer.unnormalize(samples)
+
+        if samples.shape[2] == 151:
+            sample_contact, samples = torch.split(
+                samples, (4, samples.shape[2] - 4), dim=2
+            )
+        else:
+            sample_contact = None
+        b, s, c = samples.shape
+        pos = samples[:, :, :3].to(device)  # np.zeros((sample.shape[0], 3))
+        q = samples[:, :, 3:].reshape(b, s, 24, 6)
+        # go 6d to ax
+        q = ax_from_6v(q).to(device)
+        return pos, q, sample_contact
+
     def render_sample(
         self,
         shape,
@@ -554,126 +597,100 @@ class GaussianDiffusion(nn.Module):
         constraint=None,
         sound_folder="ood_sliced",
         start_point=None,
-        render=True
+        render=True,
+        sampler=None,
+        render_backend="fast",
+        chunk_size=None,
+        motion_dtype="float32",
+        audio=None,
     ):
+        """
+            shape : sample shape to denoise, or already denoised samples
+            (in long mode also a list of consecutive chunks of windows)
+            chunk_size : in long mode, denoise at most this many windows at a
+            time (see long_ddim_sample_chunked) so memory stays bounded
+            motion_dtype : dtype of the rotations in the .motion files written
+            to fk_out, float32 or float16
+            audio : in long mode, (path, offset in seconds) of the source audio
+            to mux in instead of stitching the slice wavs in `name`
+        """
         if isinstance(shape, tuple):
-            if mode == "inpaint":
-                func_class = self.inpaint_loop
-            elif mode == "normal":
-                func_class = self.ddim_sample
-            elif mode == "long":
-                func_class = self.long_ddim_sample
+            if mode == "long" and chunk_size is not None:
+                samples = self.long_ddim_sample_chunked(
+                    shape, cond, chunk_size, sampler=sampler
+                )
             else:
-                assert False, "Unrecognized inference mode"
-            samples = (
-                func_class(
-                    shape,
-                    cond,
-                    noise=noise,
-                    constraint=constraint,
-                    start_point=start_point,
+                if mode == "inpaint":
+                    func_class = self.inpaint_loop
+                elif mode == "normal":
+                    func_class = self.ddim_sample
+                elif mode == "long":
+                    func_class = self.long_ddim_sample
+                else:
+                    assert False, "Unrecognized inference mode"
+                kwargs = {"sampler": sampler} if mode != "inpaint" else {}
+                samples = (
+                    func_class(
+                        shape,
+                        cond,
+                        noise=noise,
+                        constraint=constraint,
+                        start_point=start_point,
+                        **kwargs,
+                    )
+                    .detach()
+                    .cpu()
                 )
-                .detach()
-                .cpu()
-            )
         else:
             samples = shape
 
-        samples = normalizer.unnormalize(samples)
-
-        if samples.shape[2] == 151:
-            sample_contact, samples = torch.split(
-                samples, (4, samples.shape[2] - 4), dim=2
-            )
-        else:
-            sample_contact = None
-        # do the FK all at once
-        b, s, c = samples.shape
-        pos = samples[:, :, :3].to(cond.device)  # np.zeros((sample.shape[0], 3))
-        q = samples[:, :, 3:].reshape(b, s, 24, 6)
-        # go 6d to ax
-        q = ax_from_6v(q).to(cond.device)
-
         if mode == "long":
-            b, s, c1, c2 = q.shape
-            assert s % 2 == 0
-            half = s // 2
-            if b > 1:
-                # if long mode, stitch position using linear interp
-
-                fade_out = torch.ones((1, s, 1)).to(pos.device)
-                fade_in = torch.ones((1, s, 1)).to(pos.device)
-                fade_out[:, half:, :] = torch.linspace(1, 0, half)[None, :, None].to(
-                    pos.device
-                )
-                fade_in[:, :half, :] = torch.linspace(0, 1, half)[None, :, None].to(
-                    pos.device
-                )
-
-                pos[:-1] *= fade_out
-                pos[1:] *= fade_in
-
-                full_pos = torch.zeros((s + half * (b - 1), 3)).to(pos.device)
-                idx = 0
-                for pos_slice in pos:
-                    full_pos[idx : idx + s] += pos_slice
-                    idx += half
-
-                # stitch joint angles with slerp
-                slerp_weight = torch.linspace(0, 1, half)[None, :, None].to(pos.device)
-
-                left, right = q[:-1, half:], q[1:, :half]
-                # convert to quat
-                left, right = (
-                    axis_angle_to_quaternion(left),
-                    axis_angle_to_quaternion(right),
+            # chunks of consecutive windows, stitched and FK'd as they arrive
+            chunks = [samples] if torch.is_tensor(samples) else samples
+            stitcher = LongFormStitcher()
+            full_pos, full_q, full_pose = [], [], []
+
+            def emit(pos, q):
+                full_pos.append(pos)
+                full_q.append(q)
+                with stage("fk"):
+                    pose = self.smpl.forward(q[None], pos[None])
+                    full_pose.append(pose.detach().cpu().numpy()[0])
+
+            for chunk in chunks:
+                pos, q, _ = self.unpack_samples(chunk, normalizer, cond.device)
+                emit(*stitcher.push(pos, q))
+            emit(*stitcher.finish())
+            full_pos = torch.cat(full_pos)
+            full_q = torch.cat(full_q)
+            full_pose = np.concatenate(full_pose)  # s, 24, 3
+            with stage("render"):
+                skeleton_render(
+                    full_pose,
+                    epoch=f"{epoch}",
+                    out=render_out,
+                    name=name,
+                    sound=sound,
+                    stitch=True,
+                    sound_folder=sound_folder,
+                    render=render,
+                    backend=render_backend,
+                    audio=audio,
                 )
-                merged = quat_slerp(left, right, slerp_weight)  # (b-1) x half x ...
-                # convert back
-                merged = quaternion_to_axis_angle(merged)
-
-                full_q = torch.zeros((s + half * (b - 1), c1, c2)).to(pos.device)
-                full_q[:half] += q[0, :half]
-                idx = half
-                for q_slice in merged:
-                    full_q[idx : idx + half] += q_slice
-                    idx += half
-                full_q[idx : idx + half] += q[-1, half:]
-
-                # unsqueeze for fk
-                full_pos = full_pos.unsqueeze(0)
-                full_q = full_q.unsqueeze(0)
-            else:
-                full_pos = pos
-                full_q = q
-            full_pose = (
-                self.smpl.forward(full_q, full_pos).detach().cpu().numpy()
-            )  # b, s, 24, 3
-            # squeeze the batch dimension away and render
-            skeleton_render(
-                full_pose[0],
-                epoch=f"{epoch}",
-                out=render_out,
-                name=name,
-                sound=sound,
-                stitch=True,
-                sound_folder=sound_folder,
-                render=render
-            )
             if fk_out is not None:
-                outname = f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}.pkl'
+                outname = f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}{MOTION_EXTENSION}'
                 Path(fk_out).mkdir(parents=True, exist_ok=True)
-                pickle.dump(
-                    {
-                        "smpl_poses": full_q.squeeze(0).reshape((-1, 72)).cpu().numpy(),
-                        "smpl_trans": full_pos.squeeze(0).cpu().numpy(),
-                        "full_pose": full_pose[0],
-                    },
-                    open(os.path.join(fk_out, outname), "wb"),
+                write_motion(
+                    os.path.join(fk_out, outname),
+                    full_q.reshape((-1, 72)).cpu().numpy(),
+                    full_pos.cpu().numpy(),
+                    dtype=motion_dtype,
                 )
             return
 
-        poses = self.smpl.forward(q, pos).detach().cpu().numpy()
+        pos, q, sample_contact = self.unpack_samples(samples, normalizer, cond.device)
+        with stage("fk"):
+            poses = self.smpl.forward(q, pos).detach().cpu().numpy()
         sample_contact = (
             sample_contact.detach().cpu().numpy()
             if sample_contact is not None
@@ -691,25 +708,25 @@ class GaussianDiffusion(nn.Module):
                 name=filename,
                 sound=sound,
                 contact=contact,
+                backend=render_backend,
             )
 
-        p_map(inner, enumerate(poses))
+        with stage("render"):
+            p_map(inner, enumerate(poses))
 
         if fk_out is not None and mode != "long":
             Path(fk_out).mkdir(parents=True, exist_ok=True)
-            for num, (qq, pos_, filename, pose) in enumerate(zip(q, pos, name, poses)):
+            for num, (qq, pos_, filename) in enumerate(zip(q, pos, name)):
                 path = os.path.normpath(filename)
                 pathparts = path.split(os.sep)
                 pathparts[-1] = pathparts[-1].replace("npy", "wav")
                 # path is like "data/train/features/name"
                 pathparts[2] = "wav_sliced"
                 audioname = os.path.join(*pathparts)
-                outname = f"{epoch}_{num}_{pathparts[-1][:-4]}.pkl"
-                pickle.dump(
-                    {
-                        "smpl_poses": qq.reshape((-1, 72)).cpu().numpy(),
-                        "smpl_trans": pos_.cpu().numpy(),
-                        "full_pose": pose,
-                    },
-                    open(f"{fk_out}/{outname}", "wb"),
+                outname = f"{epoch}_{num}_{pathparts[-1][:-4]}{MOTION_EXTENSION}"
+                write_motion(
+                    os.path.join(fk_out, outname),
+                    qq.reshape((-1, 72)).cpu().numpy(),
+                    pos_.cpu().numpy(),
+                    dtype=motion_dtype,
                 )
@@ -1,4 +1,4 @@
-from typing import Any, Callable, List, Optional, Union
+from typing import Any, Callable, List, NamedTuple, Optional, Union
 
 import numpy as np
 import torch
@@ -12,6 +12,13 @@ from model.rotary_embedding_torch import RotaryEmbedding
 from model.utils import PositionalEncoding, SinusoidalPosEmb, prob_mask_like
 
 
+class EncodedCond(NamedTuple):
+    """Music conditioning from `DanceDecoder.encode_cond`, reusable across denoising steps."""
+
+    tokens: Tensor  # b x seq x latent, output of the cond encoder
+    hidden: Tensor  # b x latent, pooled projection used for FiLM
+
+
 class DenseFiLM(nn.Module):
     """Feature-wise linear modulation (FiLM) generator."""
 
@@ -328,14 +335,58 @@ class DanceDecoder(nn.Module):
         
         self.final_layer = nn.Linear(latent_dim, output_feats)
 
-    def guided_forward(self, x, cond_embed, times, guidance_weight):
-        unc = self.forward(x, cond_embed, times, cond_drop_prob=1)
-        conditioned = self.forward(x, cond_embed, times, cond_drop_prob=0)
-
+    def guided_forward(self, x, cond_embed, times, guidance_weight, fused=True):
+        """
+        Classifier-free guidance. With `fused` the conditional and
+        unconditional branches run as one batch of 2B through the decoder,
+        and a branch whose weight is zero (guidance_weight 0 or 1) is skipped.
+        """
+        if not fused:
+            unc = self.forward(x, cond_embed, times, cond_drop_prob=1)
+            conditioned = self.forward(x, cond_embed, times, cond_drop_prob=0)
+            return unc + (conditioned - unc) * guidance_weight
+
+        if guidance_weight == 1:
+            return self.forward(x, cond_embed, times, cond_drop_prob=0)
+        if guidance_weight == 0:
+            return self.forward(x, cond_embed, times, cond_drop_prob=1)
+
+        batch_size = x.shape[0]
+        cond = self.encode_cond(cond_embed)
+        # first half conditional, second half unconditional
+        keep_mask = torch.arange(2 * batch_size, device=x.device) < batch_size
+        output = self.forward(
+            torch.cat((x, x)),
+            EncodedCond(*(torch.cat((c, c)) for c in cond)),
+            torch.cat((times, times)),
+            keep_mask=keep_mask,
+        )
+        conditioned, unc = output.chunk(2)
         return unc + (conditioned - unc) * guidance_weight
 
+    def encode_cond(self, cond_embed):
+        """
+        Encode the music features once, the result can be passed to `forward`
+        in place of `cond_embed` for every denoising step and guidance branch.
+        """
+        if isinstance(cond_embed, EncodedCond):
+            return cond_embed
+        cond_tokens = self.cond_projection(cond_embed)
+        # encode tokens
+        cond_tokens = self.abs_pos_encoding(cond_tokens)
+        cond_tokens = self.cond_encoder(cond_tokens)
+
+        mean_pooled_cond_tokens = cond_tokens.mean(dim=-2)
+        cond_hidden = self.non_attn_cond_projection(mean_pooled_cond_tokens)
+        return EncodedCond(cond_tokens, cond_hidden)
+
     def forward(
-        self, x: Tensor, cond_embed: Tensor, times: Tensor, cond_drop_prob: float = 0.0
+        self,
+        x: Tensor,
+        cond_embed: Union[Tensor, EncodedCond],
+        times: Tensor,
+        cond_drop_prob: float = 0.0,
+        keep_mask: Optional[Tensor] = None,
     ):
         batch_size, device = x.shape[0], x.device
 
@@ -344,22 +395,18 @@ class DanceDecoder(nn.Module):
         # add the positional embeddings of the input sequence to provide temporal information
         x = self.abs_pos_encoding(x)
 
-        # create music conditional embedding with conditional dropout
-        keep_mask = prob_mask_like((batch_size,), 1 - cond_drop_prob, device=device)
+        # create music conditional embedding with conditional dropout,
+        # or with an explicit per-row mask (True keeps the music)
+        if keep_mask is None:
+            keep_mask = prob_mask_like((batch_size,), 1 - cond_drop_prob, device=device)
         keep_mask_embed = rearrange(keep_mask, "b -> b 1 1")
         keep_mask_hidden = rearrange(keep_mask, "b -> b 1")
 
-        cond_tokens = self.cond_projection(cond_embed)
-        # encode tokens
-        cond_tokens = self.abs_pos_encoding(cond_tokens)
-        cond_tokens = self.cond_encoder(cond_tokens)
+        cond_tokens, cond_hidden = self.encode_cond(cond_embed)
 
         null_cond_embed = self.null_cond_embed.to(cond_tokens.dtype)
         cond_tokens = torch.where(keep_mask_embed, cond_tokens, null_cond_embed)
 
-        mean_pooled_cond_tokens = cond_tokens.mean(dim=-2)
-        cond_hidden = self.non_attn_cond_projection(mean_pooled_cond_tokens)
-
         # create the diffusion timestep embedding, add the extra music projection
         t_hidden = self.time_mlp(times)
 
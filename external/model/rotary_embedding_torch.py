@@ -100,15 +100,29 @@ class RotaryEmbedding(nn.Module):
             raise ValueError(f"unknown modality {freqs_for}")
 
         self.cache = dict()
+        # seq_len -> (cos, sin) tables, see precompute
+        self.tables = dict()
 
         if learned_freq:
             self.freqs = nn.Parameter(freqs)
         else:
             self.register_buffer("freqs", freqs)
 
+    def precompute(self, seq_len, device=None, dtype=torch.float32):
+        """
+        Tabulate cos / sin of the rotation angles of a fixed sequence length,
+        so rotating a sequence of that length is two multiplies and an add.
+        """
+        freqs = self.forward(torch.arange(seq_len, device=device))
+        self.tables[seq_len] = (freqs.cos().to(dtype), freqs.sin().to(dtype))
+
     def rotate_queries_or_keys(self, t, seq_dim=-2):
         device = t.device
         seq_len = t.shape[seq_dim]
+        table = self.tables.get(seq_len)
+        if table is not None and seq_dim == -2 and table[0].shape[-1] == t.shape[-1]:
+            cos, sin = table
+            return t * cos + rotate_half(t) * sin
         freqs = self.forward(
             lambda: torch.arange(seq_len, device=device), cache_key=seq_len
         )
@@ -0,0 +1,262 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from instrumentation import StepTimer, progress_part, stage
+
+
+def stitch_indices(segments, device):
+    # rows whose first half is tied to the second half of the previous row,
+    # i.e. every row of a segment except its first
+    dst = [i for start, stop in segments for i in range(start + 1, stop)]
+    dst = torch.tensor(dst, device=device, dtype=torch.long)
+    return dst, dst - 1
+
+
+class Sampler:
+    """
+    Few-step sampling loop over a trained GaussianDiffusion.
+
+    `sample` draws `shape` motions for `cond`. With `segments` the rows are
+    treated as overlapping windows of one or more songs (see
+    `GaussianDiffusion.long_ddim_sample`): the first half of every window is
+    tied to the second half of the previous one, and the guidance weight is
+    ramped up over the first half of the steps. `prefixes` maps a row to
+    clean (normalized) motion its first frames are inpainted with, which is
+    how a chunk of windows continues the previous chunk.
+    """
+
+    name = None
+    # with the 1000 step schedule EDGE is trained with
+    max_steps = 1000
+
+    def __init__(self, steps):
+        assert steps >= 1
+        self.steps = steps
+
+    @property
+    def key(self):
+        """Hashable config, jobs with equal keys can share a batch."""
+        return (self.name, self.steps)
+
+    def timesteps(self, diffusion):
+        # [T-1, ..., 0, -1], -1 marks the final step to x0
+        times = torch.linspace(-1, diffusion.n_timestep - 1, steps=self.steps + 1)
+        return list(reversed(times.int().tolist()))
+
+    def guidance_weights(self, diffusion, segments):
+        if segments is None:
+            return [diffusion.guidance_weight] * self.steps
+        return np.clip(
+            np.linspace(0, diffusion.guidance_weight * 2, self.steps),
+            None,
+            diffusion.guidance_weight,
+        ).tolist()
+
+    @torch.no_grad()
+    def sample(self, diffusion, shape, cond, segments=None, noise=None, prefixes=None):
+        device = diffusion.betas.device
+        x = torch.randn(shape, device=device) if noise is None else noise.to(device)
+        # the music encoding does not change between steps or guidance branches, encode it once
+        cond = diffusion.model.encode_cond(cond.to(device))
+        constraints = []
+        if segments is not None:
+            assert x.shape[1] % 2 == 0
+            half = x.shape[1] // 2
+            dst, src = stitch_indices(segments, device)
+
+            def stitch(x, time):
+                # the first half of each sequence is the second half of the previous one
+                x[dst, :half] = x[src, half:]
+
+            constraints.append(stitch)
+        if prefixes:
+            rows = torch.tensor(list(prefixes), device=device, dtype=torch.long)
+            values = torch.stack([p.to(device) for p in prefixes.values()])
+            length = values.shape[1]
+            # one fixed noise draw, so deterministic samplers stay deterministic
+            eps = torch.randn_like(values)
+
+            def inpaint(x, time):
+                alpha = diffusion.alphas_cumprod[time]
+                x[rows, :length] = alpha.sqrt() * values + (1 - alpha).sqrt() * eps
+
+            constraints.append(inpaint)
+
+        def constrain(x, time):
+            for constraint in constraints:
+                constraint(x, time)
+
+        with stage("denoise"):
+            x = self.loop(
+                diffusion,
+                x,
+                cond,
+                self.guidance_weights(diffusion, segments),
+                constrain if constraints else None,
+            )
+        if prefixes:
+            # like inpaint_loop, the known frames are kept exactly
+            x[rows, :length] = values
+        return x
+
+    def loop(self, diffusion, x, cond, weights, constrain):
+        """
+        Denoise x; `constrain(x, t)`, if given, is applied in place after
+        every step that does not end at x0, with t the step's target timestep.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(map(str, self.key[1:]))})"
+
+
+class DDIMSampler(Sampler):
+    """DDIM over `steps` evenly spaced timesteps, `eta` = 0 is deterministic and 1 matches DDPM noise."""
+
+    name = "ddim"
+
+    def __init__(self, steps=50, eta=1.0):
+        super().__init__(steps)
+        self.eta = eta
+
+    @property
+    def key(self):
+        return (self.name, self.steps, self.eta)
+
+    def loop(self, diffusion, x, cond, weights, constrain):
+        times = self.timesteps(diffusion)
+        time_pairs = list(zip(times[:-1], times[1:], weights))
+        batch, device = x.shape[0], x.device
+        timer = StepTimer("denoise", len(time_pairs))
+
+        for i, (time, time_next, weight) in enumerate(
+            tqdm(time_pairs, desc="sampling loop time step")
+        ):
+            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+            pred_noise, x_start = diffusion.model_predictions(
+                x, cond, time_cond, weight=weight, clip_x_start=diffusion.clip_denoised
+            )
+            timer.step(i + 1)
+
+            if time_next < 0:
+                x = x_start
+                continue
+
+            alpha = diffusion.alphas_cumprod[time]
+            alpha_next = diffusion.alphas_cumprod[time_next]
+
+            sigma = self.eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+            c = (1 - alpha_next - sigma ** 2).sqrt()
+
+            noise = torch.randn_like(x)
+
+            x = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
+
+            if constrain is not None and time > 0:
+                constrain(x, time_next)
+        return x
+
+
+class DPMSolverPPSampler(Sampler):
+    """
+    DPM-Solver++(2M) in data (x0) prediction form (Lu et al. 2022), a
+    deterministic second order multistep solver that gives usable samples
+    in 10-20 steps.
+    """
+
+    name = "dpm++"
+    # every step needs a distinct timestep, t = 0 included
+    max_steps = 999
+
+    def __init__(self, steps=20):
+        super().__init__(steps)
+
+    def timesteps(self, diffusion):
+        # [T-1, ..., 0], the solver lands on t = 0 instead of jumping to x0
+        if self.steps >= diffusion.n_timestep:
+            raise ValueError(
+                f"{self.name} takes fewer than {diffusion.n_timestep} steps, got {self.steps}"
+            )
+        times = torch.linspace(0, diffusion.n_timestep - 1, steps=self.steps + 1)
+        return list(reversed(times.round().long().tolist()))
+
+    def loop(self, diffusion, x, cond, weights, constrain):
+        times = self.timesteps(diffusion)
+        alphas_cumprod = diffusion.alphas_cumprod.double()
+        alpha_t = alphas_cumprod.sqrt()
+        sigma_t = (1 - alphas_cumprod).sqrt()
+        lambda_t = alpha_t.log() - sigma_t.log()
+        batch, device = x.shape[0], x.device
+        timer = StepTimer("denoise", len(weights))
+
+        x0_prev, h_prev = None, None
+        for i, weight in enumerate(tqdm(weights, desc="sampling loop time step")):
+            time, time_next = times[i], times[i + 1]
+            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+            _, x0 = diffusion.model_predictions(
+                x, cond, time_cond, weight=weight, clip_x_start=diffusion.clip_denoised
+            )
+            timer.step(i + 1)
+
+            h = (lambda_t[time_next] - lambda_t[time]).item()
+            ratio = (sigma_t[time_next] / sigma_t[time]).item()
+            scale = (alpha_t[time_next] * -np.expm1(-h)).item()
+            if x0_prev is None or i == len(weights) - 1:
+                # first order (DDIM) update to start, and on the last step for stability
+                d = x0
+            else:
+                r = h_prev / h
+                d = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * x0_prev
+            x = ratio * x + scale * d
+            x0_prev, h_prev = x0, h
+
+            if constrain is not None and time_next > 0:
+                constrain(x, time_next)
+        return x
+
+
+SAMPLERS = {
+    DDIMSampler.name: DDIMSampler,
+    DPMSolverPPSampler.name: DPMSolverPPSampler,
+}
+
+
+def get_sampler(name="ddim", steps=None, eta=None):
+    """Build a sampler from request-style parameters, None means the sampler's default."""
+    if name not in SAMPLERS:
+        raise ValueError(f"Unknown sampler {name!r}, expected one of {sorted(SAMPLERS)}")
+    kwargs = {}
+    if steps is not None:
+        steps = int(steps)
+        max_steps = SAMPLERS[name].max_steps
+        if not 1 <= steps <= max_steps:
+            raise ValueError(f"{name} steps must be between 1 and {max_steps}, got {steps}")
+        kwargs["steps"] = steps
+    if eta is not None:
+        if name != DDIMSampler.name:
+            raise ValueError("eta only applies to the ddim sampler")
+        eta = float(eta)
+        if not 0 <= eta <= 1:
+            raise ValueError(f"eta must be between 0 and 1, got {eta}")
+        kwargs["eta"] = eta
+    return SAMPLERS[name](**kwargs)
+
+
+def sample_in_chunks(sample_fn, cond, chunk_size):
+    """
+    Denoise the overlapping windows of one song `chunk_size` windows at a
+    time, so memory and per-step latency do not grow with song length.
+    `sample_fn(cond_chunk, prefix)` samples one chunk; every chunk after the
+    first gets the second half of the previous chunk's last window as
+    `prefix`, to be inpainted into its first window. Yields the samples of
+    each chunk in order. Denoising progress is reported over all chunks.
+    """
+    assert chunk_size >= 1
+    prefix = None
+    count = -(-len(cond) // chunk_size)
+    for index, start in enumerate(range(0, len(cond), chunk_size)):
+        with progress_part("denoise", index, count):
+            chunk = sample_fn(cond[start : start + chunk_size], prefix)
+        prefix = chunk[-1, chunk.shape[1] // 2 :]
+        yield chunk
@@ -0,0 +1,167 @@
+import os
+import threading
+import warnings
+
+import numpy as np
+import torch
+
+from batch_scheduler import BatchScheduler
+from EDGE import EDGE, inference_checkpoint_path
+
+# directory of this file, used to resolve relative checkpoint paths
+EXTERNAL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_models = {}
+_schedulers = {}
+_lock = threading.Lock()
+# separate from _lock, loading jukebox takes minutes and must not hold up model lookups
+_jukebox_lock = threading.Lock()
+_jukebox_ready = False
+_scheduler_config = {"max_batch_size": 64, "max_wait": 0.05, "max_queue": 32}
+_model_config = {"cpu_backend": False}
+
+
+def resolve_checkpoint(checkpoint_path):
+    # relative checkpoints are looked up next to this file so callers don't
+    # depend on the current working directory
+    if os.path.isabs(checkpoint_path) or os.path.exists(checkpoint_path):
+        return os.path.abspath(checkpoint_path)
+    return os.path.join(EXTERNAL_DIR, checkpoint_path)
+
+
+def get_model(feature_type, checkpoint_path="checkpoint.pt"):
+    """
+    Return the shared, eval-mode EDGE instance for a feature type / checkpoint.
+
+    The model is built on first use and kept resident for the lifetime of the
+    process, so every generation job after the first only pays for sampling.
+    """
+    key = (feature_type, resolve_checkpoint(checkpoint_path))
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _lock:
+        # another thread may have finished loading while we waited
+        model = _models.get(key)
+        if model is None:
+            model = load_model(feature_type, key[1])
+            _models[key] = model
+    return model
+
+
+def _outdated(inference_path, checkpoint_path):
+    # an artifact older than its checkpoint was exported from an earlier training run
+    if inference_path == checkpoint_path or not os.path.exists(checkpoint_path):
+        return False
+    if os.path.getmtime(checkpoint_path) <= os.path.getmtime(inference_path):
+        return False
+    warnings.warn(
+        f"{checkpoint_path} is newer than its inference artifact {inference_path}, "
+        "loading the full checkpoint; re-run export_checkpoint.py"
+    )
+    return True
+
+
+def load_model(feature_type, checkpoint_path):
+    """
+    Build an eval-mode EDGE, from the checkpoint's exported inference artifact
+    (see export_checkpoint.py) if there is one and it is not older than the
+    checkpoint, else from the full training checkpoint.
+    """
+    inference_path = inference_checkpoint_path(checkpoint_path)
+    if os.path.exists(inference_path) and not _outdated(inference_path, checkpoint_path):
+        print(f"Loading EDGE inference model ({feature_type}) from {inference_path}...")
+        model = EDGE.from_inference_checkpoint(
+            inference_path, cpu_backend=_model_config["cpu_backend"]
+        )
+        if model.feature_type != feature_type:
+            raise ValueError(
+                f"{inference_path} holds a {model.feature_type} model, not {feature_type}"
+            )
+        return model
+    print(f"Loading EDGE model ({feature_type}) from {checkpoint_path}...")
+    model = EDGE(feature_type, checkpoint_path)
+    model.eval()
+    if _model_config["cpu_backend"] and model.device.type == "cpu":
+        model.use_cpu_backend()
+    return model
+
+
+def configure_models(cpu_backend=None):
+    """Set the options used by models loaded after this call."""
+    if cpu_backend is not None:
+        _model_config["cpu_backend"] = cpu_backend
+
+
+def configure_scheduler(max_batch_size=None, max_wait=None, max_queue=None):
+    """Set the batching and queueing limits used by schedulers created after this call."""
+    if max_batch_size is not None:
+        _scheduler_config["max_batch_size"] = max_batch_size
+    if max_wait is not None:
+        _scheduler_config["max_wait"] = max_wait
+    if max_queue is not None:
+        _scheduler_config["max_queue"] = max_queue
+
+
+def get_scheduler(feature_type, checkpoint_path="checkpoint.pt"):
+    """Return the BatchScheduler that serializes and merges sampling for a shared model."""
+    key = (feature_type, resolve_checkpoint(checkpoint_path))
+    scheduler = _schedulers.get(key)
+    if scheduler is not None:
+        return scheduler
+    model = get_model(feature_type, checkpoint_path)
+    with _lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = BatchScheduler(model, **_scheduler_config)
+            _schedulers[key] = scheduler
+    return scheduler
+
+
+def preload_jukebox():
+    """Load the jukemirlib VQ-VAE / prior weights once instead of on first extract."""
+    global _jukebox_ready
+    if _jukebox_ready:
+        return
+    with _jukebox_lock:
+        if not _jukebox_ready:
+            from data.audio_extraction.jukebox_features import LAYER, FPS
+            import jukemirlib
+
+            print("Loading jukebox weights...")
+            # jukemirlib loads its weights lazily on the first extract call;
+            # one second of silence is enough to trigger it
+            jukemirlib.extract(
+                np.zeros(44100, dtype=np.float32),
+                layers=[LAYER],
+                downsample_target_rate=FPS,
+            )
+            _jukebox_ready = True
+
+
+@torch.no_grad()
+def warmup(feature_types=("jukebox",), checkpoint_path="checkpoint.pt"):
+    """
+    Load every requested model (and jukebox if needed) and run a single
+    denoising call so lazy initialisation happens before the first request.
+    """
+    for feature_type in feature_types:
+        if feature_type == "jukebox":
+            preload_jukebox()
+        model = get_model(feature_type, checkpoint_path)
+        decoder = model.diffusion.model
+        feature_dim = decoder.cond_projection.in_features
+        device = model.device
+        x = torch.randn((1, model.horizon, model.repr_dim), device=device)
+        cond = torch.zeros((1, model.horizon, feature_dim), device=device)
+        times = torch.zeros((1,), device=device, dtype=torch.long)
+        decoder.guided_forward(x, cond, times, model.diffusion.guidance_weight)
+
+
+def clear():
+    """Drop the cached models and stop their schedulers, later calls load them again."""
+    with _lock:
+        for scheduler in _schedulers.values():
+            scheduler.close()
+        _schedulers.clear()
+        _models.clear()
@@ -0,0 +1,239 @@
+"""
+Export generated motions to BVH and binary glTF without the FBX SDK.
+
+The `smpl_poses` / `smpl_trans` saved by `render_sample` are converted for
+all frames and joints at once: one batched axis-angle -> Euler / quaternion
+conversion and array writes, instead of a keyframe call per joint, axis and
+frame. As in SMPL-to-FBX, the motion is rotated from the z-up dataset frame
+to y-up for Blender, three.js etc.
+
+    python motion_export.py --input_dir motions --output_dir exports --formats bvh glb
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+from tqdm import tqdm
+
+from motion_format import load_motion, motion_paths
+from vis import smpl_offsets, smpl_parents
+
+# the joint names of the SMPL rig in SMPL-to-FBX/ybot.fbx, so exports retarget
+# the same way as the FBX files did
+JOINT_NAMES = [
+    "m_avg_Pelvis",
+    "m_avg_L_Hip",
+    "m_avg_R_Hip",
+    "m_avg_Spine1",
+    "m_avg_L_Knee",
+    "m_avg_R_Knee",
+    "m_avg_Spine2",
+    "m_avg_L_Ankle",
+    "m_avg_R_Ankle",
+    "m_avg_Spine3",
+    "m_avg_L_Foot",
+    "m_avg_R_Foot",
+    "m_avg_Neck",
+    "m_avg_L_Collar",
+    "m_avg_R_Collar",
+    "m_avg_Head",
+    "m_avg_L_Shoulder",
+    "m_avg_R_Shoulder",
+    "m_avg_L_Elbow",
+    "m_avg_R_Elbow",
+    "m_avg_L_Wrist",
+    "m_avg_R_Wrist",
+    "m_avg_L_Hand",
+    "m_avg_R_Hand",
+]
+FORMATS = ("bvh", "glb")
+FPS = 30
+# -90 degrees about the x axis, z-up -> y-up
+Y_UP = R.from_quat([-0.7071068, 0, 0, 0.7071068])
+
+_children = [[j for j, p in enumerate(smpl_parents) if p == i] for i in range(len(smpl_parents))]
+
+
+def to_y_up(poses, trans):
+    """
+    Local joint rotations (N x 24 Rotation, joint-major within a frame) and
+    root translation (N x 3), rotated to y-up.
+    """
+    frames = len(poses)
+    rotations = R.from_rotvec(poses.reshape(-1, 3).astype(np.float64))
+    root = np.arange(frames) * len(JOINT_NAMES)
+    quats = rotations.as_quat()
+    quats[root] = (Y_UP * rotations[root]).as_quat()
+    return R.from_quat(quats), Y_UP.apply(trans)
+
+
+def write_bvh(path, poses, trans, fps=FPS, scale=100.0):
+    """
+    Write a BVH file. Positions are multiplied by `scale`, the default gives
+    centimeters, which most BVH importers assume.
+    """
+    rotations, trans = to_y_up(poses, trans)
+    # ZXY is the usual BVH channel order, intrinsic so Z is applied first
+    euler = rotations.as_euler("ZXY", degrees=True).reshape(len(poses), -1)
+    offsets = np.asarray(smpl_offsets) * scale
+
+    lines = ["HIERARCHY"]
+
+    def joint(idx, depth):
+        indent = "\t" * depth
+        kind = "ROOT" if smpl_parents[idx] == -1 else "JOINT"
+        lines.append(f"{indent}{kind} {JOINT_NAMES[idx]}")
+        lines.append(f"{indent}{{")
+        lines.append(f"{indent}\tOFFSET " + " ".join(f"{v:.6f}" for v in offsets[idx]))
+        if kind == "ROOT":
+            lines.append(
+                f"{indent}\tCHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation"
+            )
+        else:
+            lines.append(f"{indent}\tCHANNELS 3 Zrotation Xrotation Yrotation")
+        for child in _children[idx]:
+            joint(child, depth + 1)
+        if not _children[idx]:
+            lines.append(f"{indent}\tEnd Site")
+            lines.append(f"{indent}\t{{")
+            lines.append(f"{indent}\t\tOFFSET 0.000000 0.000000 0.000000")
+            lines.append(f"{indent}\t}}")
+        lines.append(f"{indent}}}")
+
+    joint(0, 0)
+    lines += ["MOTION", f"Frames: {len(poses)}", f"Frame Time: {1 / fps:.8f}"]
+    # channel values in hierarchy order, which is the joint order of SMPL
+    # except that children are visited depth first
+    order = []
+    stack = [0]
+    while stack:
+        idx = stack.pop()
+        order.append(idx)
+        stack.extend(reversed(_children[idx]))
+    euler = euler.reshape(len(poses), -1, 3)[:, order].reshape(len(poses), -1)
+    values = np.concatenate([trans * scale, euler], axis=1)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+        np.savetxt(f, values, fmt="%.6f")
+    return path
+
+
+def write_glb(path, poses, trans, fps=FPS):
+    """
+    Write a binary glTF 2.0 file: a node per joint (rest offsets as
+    translations) bound in a skin, and one animation with a rotation channel
+    per joint plus the root translation.
+    """
+    rotations, trans = to_y_up(poses, trans)
+    frames, joints = len(poses), len(JOINT_NAMES)
+    quats = rotations.as_quat().reshape(frames, joints, 4)
+    # keep consecutive quaternions in the same hemisphere, for viewers that
+    # interpolate them component-wise instead of by slerp
+    flip = np.sum(quats[1:] * quats[:-1], axis=-1) < 0
+    sign = np.where(np.cumsum(flip, axis=0) % 2 == 1, -1.0, 1.0)
+    quats[1:] *= sign[..., None]
+
+    offsets = np.asarray(smpl_offsets, dtype=np.float64)
+    rest = np.zeros_like(offsets)
+    for idx, parent in enumerate(smpl_parents):
+        rest[idx] = offsets[idx] + (rest[parent] if parent != -1 else 0)
+    inverse_bind = np.tile(np.eye(4), (joints, 1, 1))
+    inverse_bind[:, :3, 3] = -rest
+    times = np.arange(frames, dtype=np.float32) / fps
+
+    # column-major matrices, as glTF expects
+    blobs = [
+        times,
+        inverse_bind.transpose(0, 2, 1).astype(np.float32),
+        trans.astype(np.float32),
+        np.ascontiguousarray(quats.transpose(1, 0, 2), dtype=np.float32),
+    ]
+    buffer_views, accessors, offset = [], [], 0
+    for blob in blobs:
+        buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": blob.nbytes})
+        offset += blob.nbytes  # float32 data, so views stay 4-byte aligned
+    binary = b"".join(blob.tobytes() for blob in blobs)
+
+    def accessor(view, count, kind, byte_offset=0, **extra):
+        accessors.append(
+            {
+                "bufferView": view,
+                "byteOffset": byte_offset,
+                "componentType": 5126,  # FLOAT
+                "count": count,
+                "type": kind,
+                **extra,
+            }
+        )
+        return len(accessors) - 1
+
+    time_acc = accessor(0, frames, "SCALAR", min=[0.0], max=[float(times[-1])])
+    bind_acc = accessor(1, joints, "MAT4")
+    trans_acc = accessor(2, frames, "VEC3")
+    samplers = [{"input": time_acc, "output": trans_acc, "interpolation": "LINEAR"}]
+    channels = [{"sampler": 0, "target": {"node": 0, "path": "translation"}}]
+    for idx in range(joints):
+        rot_acc = accessor(3, frames, "VEC4", byte_offset=idx * frames * 16)
+        samplers.append({"input": time_acc, "output": rot_acc, "interpolation": "LINEAR"})
+        channels.append({"sampler": idx + 1, "target": {"node": idx, "path": "rotation"}})
+
+    nodes = []
+    for idx in range(joints):
+        node = {"name": JOINT_NAMES[idx], "translation": offsets[idx].tolist()}
+        if _children[idx]:
+            node["children"] = _children[idx]
+        nodes.append(node)
+    gltf = {
+        "asset": {"version": "2.0", "generator": "EDGE motion_export"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": nodes,
+        "skins": [{"joints": list(range(joints)), "inverseBindMatrices": bind_acc, "skeleton": 0}],
+        "animations": [{"name": "dance", "samplers": samplers, "channels": channels}],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": buffer_views,
+        "accessors": accessors,
+    }
+    content = json.dumps(gltf, separators=(",", ":")).encode()
+    content += b" " * (-len(content) % 4)
+    binary += b"\0" * (-len(binary) % 4)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(content) + 8 + len(binary)))
+        f.write(struct.pack("<I4s", len(content), b"JSON"))
+        f.write(content)
+        f.write(struct.pack("<I4s", len(binary), b"BIN\0"))
+        f.write(binary)
+    return path
+
+
+WRITERS = {"bvh": write_bvh, "glb": write_glb}
+
+
+def export_motion(motion_path, out_dir, formats=FORMATS, fps=FPS):
+    """Export one motion file (or legacy pickle) to `out_dir`, returns {format: path}."""
+    motion = load_motion(motion_path)
+    poses, trans = motion["smpl_poses"], motion["smpl_trans"]
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(motion_path))[0]
+    return {
+        fmt: WRITERS[fmt](os.path.join(out_dir, f"{stem}.{fmt}"), poses, trans, fps=fps)
+        for fmt in formats
+    }
+
+
+def parse_export_opt():
+    parser = argparse.ArgumentParser(description="Export motions to BVH / glTF")
+    parser.add_argument("--input_dir", type=str, default="SMPL-to-FBX/motions")
+    parser.add_argument("--output_dir", type=str, default="exports")
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--fps", type=int, default=FPS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_export_opt()
+    for path in tqdm(motion_paths(opt.input_dir)):
+        export_motion(path, opt.output_dir, opt.formats, opt.fps)
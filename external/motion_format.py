@@ -0,0 +1,152 @@
+"""
+Versioned binary container for generated motions (`.motion`).
+
+Layout, little endian:
+    header   32 bytes: magic b"EDGEMOTN", version (u16), pose dtype code (u8),
+             a pad byte, frame count (u32), fps (f32), 12 reserved bytes
+    records  one per frame: smpl_poses (72 axis-angle values in the pose
+             dtype, float32 or float16) then smpl_trans (3 x float32)
+
+Every frame is a fixed-size record, so any frame range is a contiguous slice
+of a memory map. Joint positions are not stored, `MotionFile.joints` runs FK
+on the frames that are asked for.
+
+Older outputs were pickles of smpl_poses / smpl_trans / full_pose, `load_motion`
+and `motion_paths` read those as well.
+"""
+import glob
+import os
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b"EDGEMOTN"
+VERSION = 1
+EXTENSION = ".motion"
+HEADER = struct.Struct("<8sHBxIf12x")
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+JOINTS = 24
+
+_skeleton = None
+
+
+def record_dtype(pose_dtype):
+    return np.dtype([("poses", pose_dtype, (JOINTS * 3,)), ("trans", "<f4", (3,))])
+
+
+def write_motion(path, poses, trans, fps=30, dtype="float32"):
+    """
+    Write `poses` (N x 72 or N x 24 x 3 axis-angle) and `trans` (N x 3) to a
+    .motion file. dtype float16 halves the size of the rotations, which
+    moves joints by about a millimeter; translations stay float32.
+    """
+    pose_dtype = np.dtype(dtype).newbyteorder("<")
+    if pose_dtype not in DTYPE_CODES:
+        raise ValueError(f"unsupported motion dtype {dtype}, use float32 or float16")
+    poses = np.asarray(poses).reshape(len(poses), JOINTS * 3)
+    trans = np.asarray(trans).reshape(len(trans), 3)
+    assert len(poses) == len(trans), "poses and trans must have the same number of frames"
+    records = np.empty(len(poses), dtype=record_dtype(pose_dtype))
+    records["poses"] = poses
+    records["trans"] = trans
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, DTYPE_CODES[pose_dtype], len(poses), fps))
+        f.write(records.tobytes())
+    os.replace(tmp, path)
+    return path
+
+
+class MotionFile:
+    """Reader of a .motion file, records are memory-mapped on first access."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a motion file")
+        _, version, code, self.frames, self.fps = HEADER.unpack(header)
+        if version > VERSION:
+            raise ValueError(f"{path} has version {version}, this code reads up to {VERSION}")
+        self.dtype = DTYPES[code]
+        self._records = None
+
+    def __len__(self):
+        return self.frames
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = np.memmap(
+                self.path,
+                dtype=record_dtype(self.dtype),
+                mode="r",
+                offset=HEADER.size,
+                shape=(self.frames,),
+            )
+        return self._records
+
+    def poses(self, start=None, stop=None):
+        """Axis-angle rotations (n x 72, float32) of frames [start, stop)."""
+        return self.records["poses"][start:stop].astype(np.float32)
+
+    def trans(self, start=None, stop=None):
+        """Root translations (n x 3) of frames [start, stop)."""
+        return np.array(self.records["trans"][start:stop])
+
+    def joints(self, start=None, stop=None):
+        """Joint positions (n x 24 x 3) of frames [start, stop), by FK."""
+        return forward_kinematics(self.poses(start, stop), self.trans(start, stop))
+
+
+def forward_kinematics(poses, trans):
+    """
+    Joint positions (... x N x 24 x 3) of axis-angle poses (... x N x 72)
+    and root translations (... x N x 3), e.g. of a padded batch of motions.
+    """
+    global _skeleton
+    if _skeleton is None:
+        # vis pulls in torch / pytorch3d, which only FK needs
+        from vis import SMPLSkeleton
+
+        _skeleton = SMPLSkeleton("cpu")
+    poses = np.asarray(poses, dtype=np.float32)
+    shape = poses.shape[:-1]
+    poses = poses.reshape(-1, shape[-1], JOINTS, 3)
+    trans = np.asarray(trans, dtype=np.float32).reshape(-1, shape[-1], 3)
+    return _skeleton.forward_numpy(poses, trans).reshape(*shape, JOINTS, 3)
+
+
+def load_motion(path, joints=False):
+    """
+    {"smpl_poses", "smpl_trans"} of a .motion file or a legacy pickle, plus
+    "full_pose" (the joint positions) with `joints`.
+    """
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        motion = {
+            "smpl_poses": np.asarray(data["smpl_poses"]),
+            "smpl_trans": np.asarray(data["smpl_trans"]),
+        }
+        if joints:
+            motion["full_pose"] = data.get("full_pose")
+            if motion["full_pose"] is None:
+                motion["full_pose"] = forward_kinematics(motion["smpl_poses"], motion["smpl_trans"])
+        return motion
+    motion_file = MotionFile(path)
+    motion = {"smpl_poses": motion_file.poses(), "smpl_trans": motion_file.trans()}
+    if joints:
+        motion["full_pose"] = forward_kinematics(motion["smpl_poses"], motion["smpl_trans"])
+    return motion
+
+
+def motion_paths(directory, pattern="*"):
+    """Sorted .motion files and legacy pickles in `directory` matching `pattern`."""
+    return sorted(
+        glob.glob(os.path.join(directory, pattern + EXTENSION))
+        + glob.glob(os.path.join(directory, pattern + ".pkl"))
+    )
@@ -11,12 +11,19 @@ import torch
 from tqdm import tqdm
 
 from args import parse_test_opt
-from data.slice import slice_audio
-from EDGE import EDGE
+from instrumentation import stage
+from data.slice import num_slices, slice_audio_array
+from model_registry import get_model
+from model.samplers import SAMPLERS, get_sampler, sample_in_chunks
+from motion_format import motion_paths
 from data.audio_extraction.baseline_features import extract as baseline_extract
 from data.audio_extraction.jukebox_features import extract as juke_extract
+from data.audio_extraction.jukebox_features import LAYER
+from data.audio_extraction.feature_cache import cache_key, extract_slices, extract_windows_cached
+from data.audio_extraction.track_features import extract_windows, target_sr
+from data.audio_extraction.decode import decode_audio
 
-def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_save_dir=None, checkpoint_path="checkpoint.pt", feature_type="jukebox", generation_id=None):
+def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_save_dir=None, checkpoint_path="checkpoint.pt", feature_type="jukebox", generation_id=None, scheduler=None, feature_cache=None, feature_mode="track", validate_features=False, sampler=None, sample_length=None, chunk_size=16, motion_dtype="float32"):
     """
     Generate dance motion from a single audio file
     
@@ -26,6 +33,21 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
         motion_save_dir (str): Directory to save motion files for FBX conversion
         checkpoint_path (str): Path to the model checkpoint
         feature_type (str): Type of features to extract ("jukebox" or "baseline")
+        scheduler (BatchScheduler): Optional scheduler that batches the diffusion
+            sampling with other concurrent jobs (sampled directly if None)
+        feature_cache (FeatureCache): Optional cache of extracted features, so a
+            repeated upload of the same audio skips feature extraction
+        feature_mode (str): "track" to extract features once over the selected
+            audio and window them, "slice" to run the extractor on every slice
+        validate_features (bool): In "track" mode, also compute the per-slice
+            features and report how far apart the two are
+        sampler (Sampler): Diffusion sampler from model.samplers.get_sampler,
+            e.g. a 10-20 step one for previews (50 step DDIM if None)
+        sample_length (float): Seconds of audio to dance to, a random crop of
+            the song (the whole song if None)
+        chunk_size (int): Number of 5 second windows denoised at a time, so
+            memory stays constant with song length (all at once if None)
+        motion_dtype (str): "float32" or "float16" rotations in the saved .motion file
     
     Returns:
         dict: Dictionary containing paths to generated files
@@ -53,60 +75,70 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
     
     # Setup feature extraction function
     feature_func = juke_extract if feature_type == "jukebox" else baseline_extract
-    sample_length = 60  # Reduced to 1 minute for faster generation
-    sample_size = int(sample_length / 2.5) - 1
-    
-    # Create temporary directory for audio slicing
-    temp_dir = TemporaryDirectory()
-    temp_dirname = temp_dir.name
     
     try:
         print(f"Processing audio file: {audio_file_path}")
         
-        # Slice the audio file into 2.5 second chunks
-        print("Slicing audio...")
-        slice_audio(audio_file_path, 2.5, 5.0, temp_dirname)
+        # One decode, straight to mono at the extractor's sample rate; the 5 second
+        # windows at a 2.5 second hop are views of this array
+        with stage("decode"):
+            sr = target_sr(feature_type)
+            audio = decode_audio(audio_file_path, sr)
+        input_name = os.path.splitext(os.path.basename(audio_file_path))[0]
+        layer = LAYER if feature_type == "jukebox" else None
+        total_slices = num_slices(len(audio), sr, 2.5, 5.0)
         
-        # Get all sliced files
-        import glob
-        from functools import cmp_to_key
-        
-        # Sort function for slice files
-        key_func = lambda x: int(os.path.splitext(x)[0].split("_")[-1].split("slice")[-1])
-        def stringintcmp_(a, b):
-            aa, bb = "".join(a.split("_")[:-1]), "".join(b.split("_")[:-1])
-            ka, kb = key_func(a), key_func(b)
-            if aa < bb:
-                return -1
-            if aa > bb:
-                return 1
-            if ka < kb:
-                return -1
-            if ka > kb:
-                return 1
-            return 0
-        stringintkey = cmp_to_key(stringintcmp_)
-        
-        file_list = sorted(glob.glob(f"{temp_dirname}/*.wav"), key=stringintkey)
-        
-        if len(file_list) < sample_size:
-            print(f"Warning: Audio file too short. Only {len(file_list)} chunks available, need {sample_size}")
-            sample_size = len(file_list)
+        sample_size = total_slices if sample_length is None else int(sample_length / 2.5) - 1
+        if total_slices < sample_size:
+            print(f"Warning: Audio file too short. Only {total_slices} chunks available, need {sample_size}")
+            sample_size = total_slices
         
         # Randomly sample a chunk or use the beginning if file is short
-        if len(file_list) <= sample_size:
+        if total_slices <= sample_size:
             rand_idx = 0
-            selected_files = file_list
         else:
-            rand_idx = random.randint(0, len(file_list) - sample_size)
-            selected_files = file_list[rand_idx : rand_idx + sample_size]
+            rand_idx = random.randint(0, total_slices - sample_size)
+        indices = range(rand_idx, rand_idx + sample_size)
+        # the slices only name the outputs, the video muxes the source audio from this offset
+        selected_files = [f"{input_name}_slice{idx}.wav" for idx in indices]
+        audio_offset = rand_idx * int(2.5 * sr) / sr
         
         # Extract features for selected audio chunks
         print("Extracting audio features...")
-        cond_list = []
-        for file in tqdm(selected_files):
-            reps, _ = feature_func(file)
-            cond_list.append(reps)
+        with stage("features"):
+            if feature_mode == "track":
+                # one extraction over the selected audio, windowed afterwards
+                stride_step, window = int(2.5 * sr), int(5.0 * sr)
+                start = rand_idx * stride_step
+                stop = start + (sample_size - 1) * stride_step + window
+                # the features of a crop differ from those of the same windows in
+                # the whole track, so a crop is cached on its own
+                whole = sample_size == total_slices
+                cond_list = extract_windows_cached(
+                    lambda: extract_windows(
+                        audio[start:stop], sr, feature_type, audio_name=input_name, validate=validate_features
+                    ),
+                    indices if whole else range(sample_size),
+                    total_slices if whole else sample_size,
+                    cache=feature_cache,
+                    key=cache_key(
+                        audio, sr, feature_type, layer, 2.5, 5.0, feature_mode,
+                        span=None if whole else (start, stop),
+                    ),
+                )
+            else:
+                # the per-slice extractors read files, so only this mode writes slice wavs
+                with TemporaryDirectory() as temp_dirname:
+                    with stage("slice"):
+                        slice_audio_array(audio, sr, input_name, 2.5, 5.0, temp_dirname)
+                    file_list = [os.path.join(temp_dirname, f"{input_name}_slice{idx}.wav") for idx in range(total_slices)]
+                    cond_list = extract_slices(
+                        feature_func,
+                        file_list,
+                        indices,
+                        cache=feature_cache,
+                        key=cache_key(audio, sr, feature_type, layer, 2.5, 5.0, feature_mode),
+                    )
         
         cond_tensor = torch.from_numpy(np.array(cond_list))
         
@@ -126,14 +158,28 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
         if cond_tensor.is_meta:
             raise RuntimeError("Condition tensor is a meta tensor - cannot proceed with generation")
         
-        # Load the EDGE model
-        print("Loading EDGE model...")
-        model = EDGE(feature_type, checkpoint_path)
-        model.eval()
+        # Get the shared EDGE model (loaded once per process)
+        with stage("model_load"):
+            model = get_model(feature_type, checkpoint_path)
         
         # Generate dance
         print("Generating dance...")
         data_tuple = (None, cond_tensor, selected_files)
+        if scheduler is not None:
+            # includes the wait for a batch slot, the denoising itself is timed as "denoise"
+            with stage("sample"):
+                if chunk_size is None:
+                    samples = scheduler.sample(cond_tensor, sampler)
+                else:
+                    samples = list(
+                        sample_in_chunks(
+                            lambda cond, prefix: scheduler.sample(cond, sampler, prefix),
+                            cond_tensor,
+                            chunk_size,
+                        )
+                    )
+        else:
+            samples = None
         
         # Create output filename based on input
         input_filename = os.path.splitext(os.path.basename(audio_file_path))[0]
@@ -146,7 +192,12 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
             output_dir, 
             render_count=-1, 
             fk_out=motion_save_dir, 
-            render=True
+            render=True,
+            samples=samples,
+            sampler=sampler,
+            chunk_size=chunk_size,
+            motion_dtype=motion_dtype,
+            audio=(audio_file_path, audio_offset)
         )
         
         # Clean up
@@ -157,7 +208,7 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
         import glob
         
         video_files = glob.glob(os.path.join(output_dir, f"*{generation_id}*.mp4"))
-        motion_files = glob.glob(os.path.join(motion_save_dir, f"*{generation_id}*.pkl"))
+        motion_files = motion_paths(motion_save_dir, f"*{generation_id}*")
         
         video_path = video_files[0] if video_files else None
         motion_path = motion_files[0] if motion_files else None
@@ -180,9 +231,6 @@ def generate_dance_from_single_file(audio_file_path, output_dir=None, motion_sav
     except Exception as e:
         print(f"Error during dance generation: {str(e)}")
         raise e
-    finally:
-        # Clean up temporary directory
-        temp_dir.cleanup()
 
 def main():
     """Command line interface for single file processing"""
@@ -194,6 +242,14 @@ def main():
     parser.add_argument("--motion_save_dir", type=str, default="SMPL-to-FBX/motions", help="Directory to save motion files")
     parser.add_argument("--checkpoint", type=str, default="checkpoint.pt", help="Path to model checkpoint")
     parser.add_argument("--feature_type", type=str, default="jukebox", choices=["jukebox", "baseline"], help="Feature extraction type")
+    parser.add_argument("--feature_mode", type=str, default="track", choices=["track", "slice"], help="Extract features once per track or once per slice")
+    parser.add_argument("--validate_features", action="store_true", help="Compare whole-track features against per-slice features")
+    parser.add_argument("--sampler", type=str, default="ddim", choices=sorted(SAMPLERS), help="Diffusion sampler")
+    parser.add_argument("--steps", type=int, default=None, help="Number of sampling steps (sampler default if unset)")
+    parser.add_argument("--eta", type=float, default=None, help="DDIM noise scale, 0 is deterministic")
+    parser.add_argument("--sample_length", type=float, default=None, help="Seconds of the song to dance to, a random crop (whole song if unset)")
+    parser.add_argument("--chunk_size", type=int, default=16, help="Windows denoised at a time, 0 for all at once")
+    parser.add_argument("--motion_dtype", type=str, default="float32", choices=["float32", "float16"], help="Precision of the rotations in the saved motion")
     
     args = parser.parse_args()
     
@@ -203,7 +259,13 @@ def main():
             output_dir=args.output_dir,
             motion_save_dir=args.motion_save_dir,
             checkpoint_path=args.checkpoint,
-            feature_type=args.feature_type
+            feature_type=args.feature_type,
+            feature_mode=args.feature_mode,
+            validate_features=args.validate_features,
+            sampler=get_sampler(args.sampler, args.steps, args.eta),
+            sample_length=args.sample_length,
+            chunk_size=args.chunk_size or None,
+            motion_dtype=args.motion_dtype
         )
         
         print("\nGeneration completed successfully!")
@@ -6,15 +6,22 @@ from tempfile import TemporaryDirectory
 import random
 
 import jukemirlib
+import librosa as lr
 import numpy as np
 import torch
 from tqdm import tqdm
 
 from args import parse_test_opt
-from data.slice import slice_audio
+from data.slice import slice_audio_array
 from EDGE import EDGE
+from model.samplers import get_sampler
 from data.audio_extraction.baseline_features import extract as baseline_extract
 from data.audio_extraction.jukebox_features import extract as juke_extract
+from data.audio_extraction.jukebox_features import LAYER
+from data.audio_extraction.feature_cache import (FeatureCache, cache_key,
+                                                 extract_slices,
+                                                 extract_windows_cached)
+from data.audio_extraction.track_features import extract_windows
 
 # sort filenames that look like songname_slice{number}.ext
 key_func = lambda x: int(os.path.splitext(x)[0].split("_")[-1].split("slice")[-1])
@@ -45,66 +52,72 @@ def test(opt):
     temp_dir_list = []
     all_cond = []
     all_filenames = []
-    if opt.use_cached_features:
-        print("Using precomputed features")
-        # all subdirectories
-        dir_list = glob.glob(os.path.join(opt.feature_cache_dir, "*/"))
-        for dir in dir_list:
-            file_list = sorted(glob.glob(f"{dir}/*.wav"), key=stringintkey)
-            juke_file_list = sorted(glob.glob(f"{dir}/*.npy"), key=stringintkey)
-            assert len(file_list) == len(juke_file_list)
-            # random chunk after sanity check
-            rand_idx = random.randint(0, len(file_list) - sample_size)
-            file_list = file_list[rand_idx : rand_idx + sample_size]
-            juke_file_list = juke_file_list[rand_idx : rand_idx + sample_size]
-            cond_list = [np.load(x) for x in juke_file_list]
-            all_filenames.append(file_list)
-            all_cond.append(torch.from_numpy(np.array(cond_list)))
-    else:
-        print("Computing features for input music")
-        for wav_file in glob.glob(os.path.join(opt.music_dir, "*.wav")):
-            # create temp folder (or use the cache folder if specified)
-            if opt.cache_features:
-                songname = os.path.splitext(os.path.basename(wav_file))[0]
-                save_dir = os.path.join(opt.feature_cache_dir, songname)
-                Path(save_dir).mkdir(parents=True, exist_ok=True)
-                dirname = save_dir
-            else:
-                temp_dir = TemporaryDirectory()
-                temp_dir_list.append(temp_dir)
-                dirname = temp_dir.name
-            # slice the audio file
-            print(f"Slicing {wav_file}")
-            slice_audio(wav_file, 2.5, 5.0, dirname)
-            file_list = sorted(glob.glob(f"{dirname}/*.wav"), key=stringintkey)
-            # randomly sample a chunk of length at most sample_size
-            rand_idx = random.randint(0, len(file_list) - sample_size)
-            cond_list = []
-            # generate juke representations
-            print(f"Computing features for {wav_file}")
-            for idx, file in enumerate(tqdm(file_list)):
-                # if not caching then only calculate for the interested range
-                if (not opt.cache_features) and (not (rand_idx <= idx < rand_idx + sample_size)):
-                    continue
-                # audio = jukemirlib.load_audio(file)
-                # reps = jukemirlib.extract(
-                #     audio, layers=[66], downsample_target_rate=30
-                # )[66]
-                reps, _ = feature_func(file)
-                # save reps
-                if opt.cache_features:
-                    featurename = os.path.splitext(file)[0] + ".npy"
-                    np.save(featurename, reps)
-                # if in the random range, put it into the list of reps we want
-                # to actually use for generation
-                if rand_idx <= idx < rand_idx + sample_size:
-                    cond_list.append(reps)
-            cond_list = torch.from_numpy(np.array(cond_list))
-            all_cond.append(cond_list)
-            all_filenames.append(file_list[rand_idx : rand_idx + sample_size])
+    # content-addressed feature cache: --use_cached_features reads from it,
+    # --cache_features also stores newly computed features in it
+    cache = None
+    if opt.use_cached_features or opt.cache_features:
+        cache = FeatureCache(opt.feature_cache_dir)
+    layer = LAYER if opt.feature_type == "jukebox" else None
+    print("Computing features for input music")
+    for wav_file in glob.glob(os.path.join(opt.music_dir, "*.wav")):
+        temp_dir = TemporaryDirectory()
+        temp_dir_list.append(temp_dir)
+        dirname = temp_dir.name
+        # slice the audio file
+        print(f"Slicing {wav_file}")
+        audio, sr = lr.load(wav_file, sr=None)
+        songname = os.path.splitext(os.path.basename(wav_file))[0]
+        slice_audio_array(audio, sr, songname, 2.5, 5.0, dirname)
+        file_list = sorted(glob.glob(f"{dirname}/*.wav"), key=stringintkey)
+        # randomly sample a chunk of length at most sample_size
+        rand_idx = random.randint(0, len(file_list) - sample_size)
+        # if caching then calculate every slice, otherwise only the interested range
+        if opt.cache_features:
+            indices = range(len(file_list))
+        else:
+            indices = range(rand_idx, rand_idx + sample_size)
+        # generate juke representations
+        print(f"Computing features for {wav_file}")
+        key = cache_key(audio, sr, opt.feature_type, layer, 2.5, 5.0, opt.feature_mode)
+        if opt.feature_mode == "track":
+            # extract once over the audio covering the windows, then window it
+            start = indices[0] * int(2.5 * sr)
+            stop = start + (len(indices) - 1) * int(2.5 * sr) + int(5.0 * sr)
+            whole = len(indices) == len(file_list)
+            if not whole:
+                # features of a crop depend on the crop, they are cached on their own
+                key = cache_key(
+                    audio, sr, opt.feature_type, layer, 2.5, 5.0, opt.feature_mode, span=(start, stop)
+                )
+            reps = extract_windows_cached(
+                lambda: extract_windows(
+                    audio[start:stop],
+                    sr,
+                    opt.feature_type,
+                    audio_name=songname,
+                    validate=opt.validate_features,
+                ),
+                indices if whole else range(len(indices)),
+                len(file_list) if whole else len(indices),
+                cache=cache,
+                key=key,
+                write=opt.cache_features,
+            )
+        else:
+            reps = extract_slices(
+                feature_func, file_list, indices, cache=cache, key=key, write=opt.cache_features
+            )
+        # put the random range into the list of reps we want to actually use for generation
+        cond_list = [
+            rep for idx, rep in zip(indices, reps) if rand_idx <= idx < rand_idx + sample_size
+        ]
+        cond_list = torch.from_numpy(np.array(cond_list))
+        all_cond.append(cond_list)
+        all_filenames.append(file_list[rand_idx : rand_idx + sample_size])
 
     model = EDGE(opt.feature_type, opt.checkpoint)
     model.eval()
+    sampler = get_sampler(opt.sampler, opt.steps, opt.eta)
 
     # directory for optionally saving the dances for eval
     fk_out = None
@@ -115,7 +128,14 @@ def test(opt):
     for i in range(len(all_cond)):
         data_tuple = None, all_cond[i], all_filenames[i]
         model.render_sample(
-            data_tuple, "test", opt.render_dir, render_count=-1, fk_out=fk_out, render=not opt.no_render
+            data_tuple,
+            "test",
+            opt.render_dir,
+            render_count=-1,
+            fk_out=fk_out,
+            render=not opt.no_render,
+            sampler=sampler,
+            motion_dtype=opt.motion_dtype,
         )
     print("Done")
     torch.cuda.empty_cache()
@@ -14,6 +14,8 @@ from pytorch3d.transforms import (axis_angle_to_quaternion, quaternion_apply,
                                   quaternion_multiply)
 from tqdm import tqdm
 
+from instrumentation import stage
+
 smpl_joints = [
     "root",  # 0
     "lhip",  # 1
@@ -168,11 +170,24 @@ def skeleton_render(
     stitch=False,
     sound_folder="ood_sliced",
     contact=None,
-    render=True
+    render=True,
+    backend="fast",
+    audio=None,
 ):
+    """
+    backend: "fast" rasterizes with NumPy and streams the frames into ffmpeg
+    (see fast_render.py), "matplotlib" draws a 3D FuncAnimation via a GIF.
+    audio: with `stitch`, (path, offset in seconds) of the source audio the
+    slices in `name` were cut from, muxed in directly instead of stitching
+    the slice wavs; `name` then only names the outputs.
+    """
+    assert backend in ("fast", "matplotlib"), f"Unknown render backend {backend}"
     if render:
-        # generate the pose with FK
         Path(out).mkdir(parents=True, exist_ok=True)
+    if render and backend == "fast":
+        from fast_render import render_video
+    if render and backend == "matplotlib":
+        # generate the pose with FK
         num_steps = poses.shape[0]
         
         fig = plt.figure()
@@ -218,24 +233,34 @@ def skeleton_render(
         if render:
             temp_dir = TemporaryDirectory()
             gifname = os.path.join(temp_dir.name, f"{epoch}.gif")
-            anim.save(gifname)
+            if backend == "matplotlib":
+                with stage("rasterize"):
+                    anim.save(gifname)
 
+        audio_offset = 0.0
+        if stitch and audio is not None:
+            audioname, audio_offset = audio
+            outname = os.path.join(
+                out,
+                f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}.mp4',
+            )
         # stitch wavs
-        if stitch:
+        elif stitch:
             assert type(name) == list  # must be a list of names to do stitching
-            name_ = [os.path.splitext(x)[0] + ".wav" for x in name]
-            audio, sr = lr.load(name_[0], sr=None)
-            ll, half = len(audio), len(audio) // 2
-            total_wav = np.zeros(ll + half * (len(name_) - 1))
-            total_wav[:ll] = audio
-            idx = ll
-            for n_ in name_[1:]:
-                audio, sr = lr.load(n_, sr=None)
-                total_wav[idx : idx + half] = audio[half:]
-                idx += half
-            # save a dummy spliced audio
-            audioname = f"{temp_dir.name}/tempsound.wav" if render else os.path.join(out, f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}.wav')
-            sf.write(audioname, total_wav, sr)
+            with stage("stitch_audio"):
+                name_ = [os.path.splitext(x)[0] + ".wav" for x in name]
+                audio, sr = lr.load(name_[0], sr=None)
+                ll, half = len(audio), len(audio) // 2
+                total_wav = np.zeros(ll + half * (len(name_) - 1))
+                total_wav[:ll] = audio
+                idx = ll
+                for n_ in name_[1:]:
+                    audio, sr = lr.load(n_, sr=None)
+                    total_wav[idx : idx + half] = audio[half:]
+                    idx += half
+                # save a dummy spliced audio
+                audioname = f"{temp_dir.name}/tempsound.wav" if render else os.path.join(out, f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}.wav')
+                sf.write(audioname, total_wav, sr)
             outname = os.path.join(
                 out,
                 f'{epoch}_{"_".join(os.path.splitext(os.path.basename(name[0]))[0].split("_")[:-1])}.mp4',
@@ -247,20 +272,76 @@ def skeleton_render(
             outname = os.path.join(
                 out, f"{epoch}_{os.path.splitext(os.path.basename(name))[0]}.mp4"
             )
-        if render:
-            out = os.system(
-                f"ffmpeg -loglevel error -stream_loop 0 -y -i {gifname} -i {audioname} -shortest -c:v libx264 -crf 26 -c:a aac -q:a 4 {outname}"
-            )
+        # encode the video and mux in the audio (the fast backend rasterizes here too)
+        if render and backend == "fast":
+            with stage("mux"):
+                render_video(poses, outname, audio=audioname, contact=contact, audio_offset=audio_offset)
+        elif render:
+            with stage("mux"):
+                out = os.system(
+                    f"ffmpeg -loglevel error -stream_loop 0 -y -i {gifname} -ss {audio_offset} -i {audioname} -shortest -c:v libx264 -crf 26 -c:a aac -q:a 4 {outname}"
+                )
     else:
         if render:
             # actually save the gif
             path = os.path.normpath(name)
             pathparts = path.split(os.sep)
             gifname = os.path.join(out, f"{pathparts[-1][:-4]}.gif")
-            anim.save(gifname, savefig_kwargs={"transparent": True, "facecolor": "none"},)
+            if backend == "fast":
+                render_video(poses, gifname, contact=contact)
+            else:
+                anim.save(gifname, savefig_kwargs={"transparent": True, "facecolor": "none"},)
     plt.close()
 
 
+def _rodrigues(x, y, z, xp):
+    """
+    Rotation matrices for the axis-angle components x, y, z (any shape),
+    returned as a (3, 3, *shape) array of torch or NumPy (`xp`).
+    """
+    # the epsilon keeps the gradient of sqrt finite for zero rotations
+    angle = xp.sqrt(x * x + y * y + z * z + 1e-20)
+    # sin(t) / t and (1 - cos(t)) / t^2 via the normalized sinc, smooth at t = 0
+    a = xp.sinc(angle / np.pi)
+    b = 0.5 * xp.sinc(angle / (2 * np.pi)) ** 2
+    return xp.stack(
+        (
+            xp.stack((1 - b * (y * y + z * z), b * x * y - a * z, b * x * z + a * y)),
+            xp.stack((b * x * y + a * z, 1 - b * (x * x + z * z), b * y * z - a * x)),
+            xp.stack((b * x * z - a * y, b * y * z + a * x, 1 - b * (x * x + y * y))),
+        )
+    )
+
+
+def _level_fk(rotations, root_positions, offsets, levels, level_order, xp):
+    """
+    Level-parallel FK shared by the torch and NumPy paths. Everything is kept
+    joints-first, (J, 3, 3, N, L) for rotations and (J, 3, N, L) for
+    positions, so gathering parents and the 3x3 products are plain
+    elementwise ops over contiguous (N, L) planes.
+    """
+    if xp is torch:
+        cat, transpose = torch.cat, torch.permute
+    else:
+        cat, transpose = np.concatenate, np.transpose
+    # N x L x J x 3 -> J x 3 x 3 x N x L
+    local = _rodrigues(*(transpose(rotations[..., i], (2, 0, 1)) for i in range(3)), xp)
+    local = transpose(local, (2, 0, 1, 3, 4))
+
+    rotations_world = local[:1]
+    positions_world = transpose(root_positions, (2, 0, 1))[None]
+    out = [positions_world]
+    for joints, parent_idx in levels:
+        parent_rotations = rotations_world[parent_idx]
+        offset = offsets[joints][:, None, :, None, None]
+        positions_world = (parent_rotations * offset).sum(2) + positions_world[parent_idx]
+        rotations_world = (parent_rotations[:, :, :, None] * local[joints][:, None]).sum(2)
+        out.append(positions_world)
+    # J x 3 x N x L -> N x L x J x 3
+    positions = cat(out)[level_order]
+    return transpose(positions, (2, 3, 0, 1))
+
+
 class SMPLSkeleton:
     def __init__(
         self, device=None,
@@ -286,9 +367,60 @@ class SMPLSkeleton:
             if parent != -1:
                 self._children[parent].append(i)
 
+        # group the joints by depth in the kinematic tree so FK can process
+        # a whole level at once; each level stores its joints and the index
+        # of each joint's parent within the previous level
+        depth = np.zeros(len(self._parents), dtype=int)
+        for i, parent in enumerate(self._parents):
+            if parent != -1:
+                assert parent < i, "parents must precede their children"
+                depth[i] = depth[parent] + 1
+        levels = [np.flatnonzero(depth == d) for d in range(depth.max() + 1)]
+        assert len(levels[0]) == 1, "expected a single root"
+        self._levels = []
+        for prev, joints in zip(levels[:-1], levels[1:]):
+            parent_idx = np.searchsorted(prev, self._parents[joints])
+            self._levels.append((joints, parent_idx))
+        # undo the level ordering at the end
+        self._level_order = np.argsort(np.concatenate(levels))
+
     def forward(self, rotations, root_positions):
         """
         Perform forward kinematics using the given trajectory and local rotations.
+        Arguments (where N = batch size, L = sequence length, J = number of joints):
+         -- rotations: (N, L, J, 3) tensor of axis-angle rotations describing the local rotations of each joint.
+         -- root_positions: (N, L, 3) tensor describing the root joint positions.
+        All joints at the same depth of the tree are transformed at once, so the
+        Python loop runs once per tree level instead of once per joint.
+        """
+        assert len(rotations.shape) == 4
+        assert len(root_positions.shape) == 3
+        offsets = self._offsets.to(device=rotations.device, dtype=rotations.dtype)
+        return _level_fk(
+            rotations, root_positions, offsets, self._levels, self._level_order, torch
+        )
+
+    def forward_numpy(self, rotations, root_positions):
+        """
+        NumPy version of `forward` for CPU-only post-processing, takes and
+        returns arrays of the same shapes.
+        """
+        assert len(rotations.shape) == 4
+        assert len(root_positions.shape) == 3
+        rotations = np.asarray(rotations)
+        offsets = self._offsets.cpu().numpy().astype(rotations.dtype)
+        return _level_fk(
+            rotations,
+            np.asarray(root_positions, dtype=rotations.dtype),
+            offsets,
+            self._levels,
+            self._level_order,
+            np,
+        )
+
+    def forward_reference(self, rotations, root_positions):
+        """
+        Joint-by-joint quaternion FK, kept as the reference for `forward`.
         Arguments (where N = batch size, L = sequence length, J = number of joints):
          -- rotations: (N, L, J, 3) tensor of axis-angle rotations describing the local rotations of each joint.
          -- root_positions: (N, L, 3) tensor describing the root joint positions.
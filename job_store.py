@@ -0,0 +1,215 @@
+"""
+SQLite-backed job and artifact store for dance_server.py
+
+Jobs (status, progress, result) and the files that belong to uploads and
+generations live in one database file in WAL mode, so any number of server
+worker processes can share them and every lookup is an indexed query
+instead of a directory glob. A sweeper thread in each worker evicts the
+files of finished jobs by age and total size; the database makes sure only
+one worker sweeps at a time.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    upload_id TEXT,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    stage TEXT,
+    error TEXT,
+    result TEXT,
+    timings TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at);
+
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_owner ON artifacts (owner, kind);
+CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed_at);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('last_sweep', 0);
+"""
+
+JSON_FIELDS = ('result', 'timings')
+ACTIVE = ('queued', 'processing')
+
+
+class JobStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        # one connection per thread, sqlite3 connections are not shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # Jobs
+
+    def create_job(self, job_id, upload_id=None, message=None):
+        now = time.time()
+        self._conn().execute(
+            'INSERT INTO jobs (id, upload_id, status, progress, message, created_at, updated_at) '
+            'VALUES (?, ?, ?, 0, ?, ?, ?)',
+            (job_id, upload_id, 'queued', message, now, now)
+        )
+
+    def update_job(self, job_id, **fields):
+        """Set columns of a job, `result` and `timings` are stored as JSON"""
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self._conn().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def get_job(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for name in JSON_FIELDS:
+            job[name] = json.loads(job[name]) if job[name] is not None else None
+        return job
+
+    def status_counts(self):
+        rows = self._conn().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return {status: count for status, count in rows}
+
+    def delete_job(self, job_id):
+        """Remove a job with its files"""
+        self.evict_owner(job_id)
+        self._conn().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    # Artifacts
+
+    def add_artifact(self, owner, kind, path):
+        now = time.time()
+        self._conn().execute(
+            'INSERT OR REPLACE INTO artifacts (path, owner, kind, size, created_at, accessed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (os.path.abspath(path), owner, kind, os.path.getsize(path), now, now)
+        )
+
+    def find_artifact(self, owner, kind):
+        row = self._conn().execute(
+            'SELECT path FROM artifacts WHERE owner = ? AND kind = ?', (owner, kind)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def touch(self, owner):
+        """Mark the files of an upload / generation as recently used"""
+        self._conn().execute(
+            'UPDATE artifacts SET accessed_at = ? WHERE owner = ?', (time.time(), owner)
+        )
+
+    def evict_owner(self, owner):
+        paths = [
+            row[0] for row in
+            self._conn().execute('SELECT path FROM artifacts WHERE owner = ?', (owner,))
+        ]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            # per-generation directories are removed once empty
+            directory = os.path.dirname(path)
+            if os.path.basename(directory) == owner:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        self._conn().execute('DELETE FROM artifacts WHERE owner = ?', (owner,))
+        return len(paths)
+
+    # Eviction
+
+    def sweep(self, ttl, max_bytes, stale_after):
+        """
+        Evict, oldest use first, the uploads and generations not used for
+        `ttl` seconds and then more until the files total at most
+        `max_bytes`; jobs that are still queued or processing are kept.
+        Jobs stuck in those states for `stale_after` seconds (their worker
+        died) are marked as failed. Returns the number of evicted owners.
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            f"UPDATE jobs SET status = 'error', error = 'Interrupted', message = 'Error: Interrupted', "
+            f"updated_at = ? WHERE status IN {ACTIVE} AND updated_at < ?",
+            (now, now - stale_after)
+        )
+        owners = conn.execute(
+            'SELECT owner, MAX(accessed_at) AS used, SUM(size) AS size FROM artifacts '
+            f"WHERE owner NOT IN (SELECT id FROM jobs WHERE status IN {ACTIVE}) "
+            f"AND owner NOT IN (SELECT upload_id FROM jobs WHERE status IN {ACTIVE} AND upload_id IS NOT NULL) "
+            'GROUP BY owner ORDER BY used'
+        ).fetchall()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+        evicted = 0
+        for owner, used, size in owners:
+            if used >= now - ttl and total <= max_bytes:
+                break
+            self.evict_owner(owner)
+            # the job row goes with its files, uploads have none
+            conn.execute('DELETE FROM jobs WHERE id = ?', (owner,))
+            total -= size
+            evicted += 1
+        conn.execute(
+            f"DELETE FROM jobs WHERE status NOT IN {ACTIVE} AND updated_at < ? "
+            'AND id NOT IN (SELECT owner FROM artifacts)',
+            (now - ttl,)
+        )
+        return evicted
+
+    def claim_sweep(self, interval):
+        """True for the one caller that may sweep now, across all processes"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "UPDATE meta SET value = ? WHERE key = 'last_sweep' AND value <= ?",
+            (now, now - interval)
+        )
+        return cursor.rowcount == 1
+
+    def start_sweeper(self, interval, ttl, max_bytes, stale_after):
+        def run():
+            while True:
+                try:
+                    if self.claim_sweep(interval):
+                        evicted = self.sweep(ttl, max_bytes, stale_after)
+                        if evicted:
+                            print(f"Sweeper evicted the files of {evicted} uploads / generations")
+                except Exception as e:
+                    print(f"Sweeper error: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread